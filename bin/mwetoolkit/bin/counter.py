@@ -29,6 +29,7 @@
     Web through Google's Web Search interface (-w or -u options). Yahoo's Web 
     Search interface (-y option) is not supported anymore as they shut their 
     free search API down in April 2011, just after merging with Microsoft ;-)
+    Frequencies may be searched in several corpora at once.
 
     For more information, call the script with no parameter and read the
     usage instructions.
@@ -40,30 +41,45 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import sys
+import os
 import re
-import subprocess
+import gc
+import multiprocessing
+import collections
+import cPickle
+import functools
+import threading
 
 from libs.base.frequency import Frequency
 from libs.base.googleFreq import GoogleFreq
 from libs.base.googleFreqUniv import GoogleFreqUniv
+from libs.base.localFreq import LocalFreq
+from libs.base.webFreq import TokenBucket
+from libs.base.web1tFreq import Web1TFreq
 from libs.base.corpus_size import CorpusSize
 from libs.util import read_options, treat_options_simplest, \
         verbose, error, warn
-from libs.base.__common import DEFAULT_LANG
+from libs.base.__common import DEFAULT_LANG, WEB_MAX_REQUESTS, \
+        WEB_REQUESTS_PER_SECOND
 from libs import filetype
-from libs.filetype.indexlib import Index, ATTRIBUTE_SEPARATOR
+from libs.filetype.indexlib import Index, ShardedIndex, ATTRIBUTE_SEPARATOR, \
+        SHARD_MANIFEST_EXT
 
 ################################################################################
 # GLOBALS    
 
 usage_string = """Usage: 
     
-python {program} [-w | -u <id> | -T <dir> | -i <index-corpus>] OPTIONS <candidates>
+python {program} [-w | -u <id> | -L <table> | -T <dir> | -i <index-corpus>]... OPTIONS <candidates>
 
 -i <index-corpus> OR --index <index-corpus>
     Calculate frequencies of individual words in given corpus.
     The corpus must be given as the path to the `.info` file
-    in a BinaryIndex instance.
+    in a BinaryIndex instance, or to the `.shards` manifest of a
+    sharded index (see `index.py --shards`), whose frequencies are
+    the sums of the frequencies in each shard. If the index has count
+    tables made by `index.py --count-table`, ngrams are looked up in them
+    instead of being searched in the suffix arrays.
 
 -y OR --yahoo
     Search for frequencies in the Web using Yahoo Web Search as approximator for
@@ -79,16 +95,34 @@ python {program} [-w | -u <id> | -T <dir> | -i <index-corpus>] OPTIONS <candidat
     URL and ID. The ID must be registered with a static IP address at:
     http://research.google.com/university/search/
 
+-L <table> OR --local <table>
+    Same as -w, but the search engine is simulated with a local table of
+    ngram counts, to test or benchmark Web counting without any Internet
+    connection (see --latency and --error-rate). <table> is either a text
+    file with one ngram and its count per line, separated by a tab, or the
+    `.info` file (or `.shards` manifest) of an index, whose surface forms
+    are counted. Queries are cached in local_cache.dat, apart for each
+    <table> and modification time of <table> (see --no-cache).
+
 -T <dir> OR --web1t <dir>
     Use Google's Web 1T 5-gram corpus. <dir> is the a directory containing the
     union of the contents of the data/ directories of each corpus CD as
-    distributed by Google.
+    distributed by Google. The first time n-grams of a given length are
+    counted, a block index of their files is built, so that each n-gram is
+    then found by reading a single block (see --web1t-index).
 
 The <candidates> input file must be in one of the filetype
 formats accepted by the `--candidates-from` switch.
 
-You must choose exactly one of -u, -w or -i
-(more than one is not allowed at the same time).
+You must choose at least one of -u, -w, -L, -T or -i. Several of them may be
+given (e.g. -i twice, for two different indices, and -T), in which case each
+word and ngram gets one frequency per source, named after the source, and
+one corpus size per source is added to the header. All the sources are
+searched at the same time, within a single pass over the candidates.
+
+The candidates are output once the whole <candidates> file has been read:
+the distinct words and ngrams of all candidates are collected first, and
+each of them is searched only once.
 
     
 OPTIONS may be:
@@ -139,6 +173,52 @@ OPTIONS may be:
 
 -o OR --old
     Use the old (slower) Python indexer, even when the C indexer is available.
+
+-j <n> OR --jobs <n>
+    With a sharded index, query up to <n> shards at the same time, in
+    separate processes. With -T --scan, read up to <n> corpus files at the
+    same time. By default, uses as many jobs as there are processors.
+    With -w, -u or -L, send up to <n> queries at the same time (default: 4).
+
+--rate <n>
+    With -w, -u or -L, send at most <n> queries per second on average.
+    Default: 2.
+    Queries that fail are sent again later, waiting twice as long after each
+    failure.
+
+--latency <s>
+    With -L, make each query take <s> seconds. Default: 0.
+
+--error-rate <p>
+    With -L, make each query fail with probability <p>. Default: 0.
+
+--no-cache
+    With -L, send every query, without reading or writing the cache, so
+    that each run goes through the latency and errors of the queries.
+
+--web1t-index <dir>
+    With -T, keep the block index of the Web 1T corpus in <dir> instead of
+    the corpus directory, e.g. if the corpus directory is read-only. The
+    index takes about as much space as the gzipped corpus files.
+
+--scan
+    With -T, count all the n-grams of the candidates in one pass over the
+    corpus files that contain some of them, without using the block index.
+    This is faster than the block index for very large candidate lists, and
+    needs no space for an index.
+
+--memo <n>
+    Keep the frequencies of the <n> most recently searched words and ngrams
+    in memory, so that they are not searched again for the next candidate
+    files. Default: 100000. The number of frequencies found in memory is
+    reported in verbose mode.
+
+--memo-file <file>
+    Load the kept frequencies (see --memo) from <file> at start, and save
+    them to <file> at the end, so that they are reused by the next runs on
+    the same corpus. The frequencies of each source are kept separately, and
+    are ignored if they were written for another corpus (e.g. if the index
+    has changed) or for other options among -s and -g.
     
 {common_options}
 """
@@ -147,19 +227,24 @@ OPTIONS may be:
     #Generate indices only for the specified attributes. <attrs> is a
     #colon-separated list of attributes (e.g. lemma:pos:lemma+pos).
 
-index = None  # Index()
-suffix_array = None  # SuffixArray()
-
-get_freq_function = None
-freq_name = "?"
-web_freq = None
-the_corpus_size = -1
+sources = []  # FrequencySource() of each -i, -w, -u, -L or -T option
+web_freq = None  # GoogleFreq(), GoogleFreqUniv() or LocalFreq()
+web1t_index_path = None
+scan_web1t = False
 low_limit = -1
 up_limit = -1
 count_vars = False
 count_joint_frequency = True
 count_bigrams = False
 language = DEFAULT_LANG
+max_jobs = multiprocessing.cpu_count()
+web_jobs = WEB_MAX_REQUESTS
+web_rate = WEB_REQUESTS_PER_SECOND
+local_latency = 0
+local_error_rate = 0
+local_cache = True
+memo_size = 100000
+memo_path = None
 
 filetype_corpus_ext = "BinaryIndex"
 filetype_candidates_ext = None
@@ -175,235 +260,427 @@ class CounterPrinter(filetype.ChainedInputHandler):
             self.chain = self.make_printer(info, output_filetype_ext)
         self.chain.before_file(fileobj, info)
         self.entity_counter = 0
+        self.pending = []  # (candidate, info, ngrams to count)
 
     def handle_meta(self, meta, info={}):
-        """Adds a `CorpusSize` meta-information to the header and prints the 
-        header. The corpus size is important to allow the calculation of 
-        statistical Association Measures by the `feat_association.py` script.
+        """Adds a `CorpusSize` meta-information for each frequency source to
+        the header and prints the header. The corpus size is important to
+        allow the calculation of statistical Association Measures by the
+        `feat_association.py` script.
         
         @param meta The `Meta` header that is being read from the XML file.        
         """
-        global freq_name, the_corpus_size
-        meta.add_corpus_size(CorpusSize(name=freq_name, value=the_corpus_size))
+        global sources
+        for source in sources:
+            meta.add_corpus_size(CorpusSize(name=source.name,
+                                            value=source.corpus_size))
         self.chain.handle_meta(meta, info)
 
     def handle_candidate(self, candidate, info={}):
-        """For each candidate, searches for the individual word frequencies of the
-        base ngram. The corresponding function, for a corpus index or for yahoo,
-        will be called, depending on the -i or -w/-u options. The frequencies 
-        are added as a child element of the word and then the candidate is 
-        printed.
+        """Keeps the candidate until the end of the file, along with the
+        ngrams whose frequencies must be added to it: the base ngram of the
+        candidate or, with -a, its variations.
         
         @param candidate The `Candidate` that is being read from the XML file.
         """
         global low_limit, up_limit
         global count_vars
+        ngrams = []
         if ( self.entity_counter >= low_limit or low_limit < 0 ) and \
                 ( self.entity_counter <= up_limit or up_limit < 0 ):
-            if count_vars:
-                for var in candidate.vars:
-                    append_counters(var)
-            else:
-                append_counters(candidate)
-        self.chain.handle_candidate(candidate, info)
+            ngrams = candidate.vars if count_vars else [candidate]
+        self.pending.append((candidate, info, ngrams))
         self.entity_counter += 1
 
+    def after_file(self, fileobj, info={}):
+        """Adds the frequencies of all the candidates of the file at once
+        (see `append_counters`), then prints the candidates.
+        """
+        try:
+            append_counters([ngram
+                             for (candidate, c_info, ngrams) in self.pending
+                             for ngram in ngrams])
+            for (candidate, c_info, ngrams) in self.pending:
+                self.chain.handle_candidate(candidate, c_info)
+        finally:
+            self.pending = []
+        super(CounterPrinter, self).after_file(fileobj, info)
+
 
 ################################################################################
 
-def append_counters(ngram):
+class FrequencySource(object):
+    r"""A corpus or search engine in which frequencies are searched. Each
+    source adds its own `Frequency`, named `name`, to the words and ngrams,
+    and its own `CorpusSize` to the header.
+
+    @param get_freqs Function that returns the list of the frequencies of a
+    list of ngrams, each one a list of entries made by `build_entry`.
+
+    @param build_entry Function that returns the entry searched for a word,
+    given its surface form, lemma and POS.
+
+    @param signature A string that identifies the corpus and the kind of
+    entries, so that kept frequencies are only reused for the same corpus
+    and entries (see `FrequencyMemo`).
+
+    @param close Function called once all the frequencies are searched.
     """
-        Calls the frequency function for each word of the n-gram as well as for
-        the n-gram as a whole. The result is appended to the frequency list
-        of the `Ngram` given as input.
+    def __init__(self, name, corpus_size, get_freqs, build_entry,
+                 signature, close=None):
+        self.name = name
+        self.corpus_size = corpus_size
+        self.get_freqs = get_freqs
+        self.build_entry = build_entry
+        self.signature = signature
+        self.memo = None  # FrequencyMemo()
+        self._close = close
+
+    def search(self, queries):
+        """Returns the frequency of each query `(add, surfaces, lemmas, pos)`
+        (see `counter_queries`). The distinct entries of the queries are
+        collected first, and those that are not in the `FrequencyMemo` are
+        searched in a single call to `get_freqs`.
+        """
+        entries = [tuple(map(self.build_entry, surfaces, lemmas, pos))
+                   for (add, surfaces, lemmas, pos) in queries]
+        distinct = list(set(entries))
+        verbose("Searching %d distinct ngrams for %d frequencies in %s"
+                % (len(distinct), len(entries), self.name))
+        freq_values = dict(zip(distinct, self.memo.search(distinct,
+                                                          self.get_freqs)))
+        return [freq_values[entry] for entry in entries]
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+################################################################################
+
+class FrequencyMemo(object):
+    r"""Keeps the frequencies of the `size` most recently searched words
+    and ngrams of a source, identified by their tuple of entries (see
+    `build_entry`). The kept frequencies may be loaded from and saved to a
+    file (see `load_memos`), along with the `signature` of the source.
+    """
+    def __init__(self, size, signature, entries=None):
+        self.size = size
+        self.signature = signature
+        self.entries = collections.OrderedDict()  # Least recent first
+        self.hits = 0
+        self.misses = 0
+        if entries:
+            self.entries.update(entries[len(entries) - size:])
+
+    def search(self, ngrams, get_freqs):
+        """Returns the frequencies of the `ngrams` (tuples of entries).
+        Those that are not kept are searched in a single call to
+        `get_freqs`, which takes a list of ngrams (lists of entries).
+        """
+        missing = [ngram for ngram in ngrams if ngram not in self.entries]
+        self.hits += len(ngrams) - len(missing)
+        self.misses += len(missing)
+        found = {}
+        if missing:
+            found = dict(zip(missing, get_freqs(map(list, missing))))
+        freq_values = []
+        for ngram in ngrams:
+            freq_value = found.get(ngram)
+            if freq_value is None:
+                freq_value = self.entries.pop(ngram)
+            self.entries[ngram] = freq_value
+            freq_values.append(freq_value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return freq_values
+
+    def report(self, name):
+        """Reports the hits and misses in verbose mode."""
+        searched = self.hits + self.misses
+        verbose("Frequency memo of %s: %d hits, %d misses (%.1f%% hits), "
+                "%d kept" % (name, self.hits, self.misses,
+                             100 * self.hits / searched if searched else 0,
+                             len(self.entries)))
+
+
+################################################################################
+
+def load_memos(path):
+    """
+        Returns the frequencies kept in the file `path` by `save_memos`, as a
+        dict mapping the signature of each source to its list of `(ngram,
+        frequency)` pairs, least recent first. Returns an empty dict if the
+        file does not exist.
+    """
+    if not os.path.isfile(path):
+        return {}
+    memo_file = open(path, "rb")
+    memos = cPickle.load(memo_file)
+    memo_file.close()
+    if isinstance(memos, tuple):  # Saved for a single source
+        memos = dict([memos])
+    return memos
+
+
+################################################################################
+
+def save_memos(path, memos):
+    """
+        Saves the frequencies kept by the `FrequencyMemo`s in `memos` to the
+        file `path`, along with those kept for other sources in that file.
+    """
+    kept = load_memos(path)
+    for memo in memos:
+        kept[memo.signature] = memo.entries.items()
+    memo_file = open(path + ".tmp", "wb")
+    cPickle.dump(kept, memo_file, cPickle.HIGHEST_PROTOCOL)
+    memo_file.close()
+    os.rename(path + ".tmp", path)
+
+
+################################################################################
+
+def append_counters(ngrams):
+    """
+        Adds the frequencies of each word of the n-grams, of the n-grams as
+        a whole and, if the option "--bigrams" is active, of each bigram in
+        the n-grams, in each frequency source. The frequencies are searched
+        in two phases: the distinct entries (see `build_entry`) of all these
+        words and n-grams are collected first, and those that are not in the
+        `FrequencyMemo` of the source are searched in a single call to its
+        frequency function. Thus, each word or n-gram is only searched once
+        per source, however many candidates it appears in.
+
+        @param ngrams The list of `Ngram`s that are being counted.
+    """
+    global sources
+    queries = [query for ngram in ngrams for query in counter_queries(ngram)]
+    for (source, freq_values) in zip(sources, search_sources(queries)):
+        for ((add, surfaces, lemmas, pos), freq_value) in zip(queries,
+                                                              freq_values):
+            add(Frequency(source.name, freq_value))
+
+
+################################################################################
+
+def search_sources(queries):
+    """
+        Returns the list of the frequencies of the `queries` (see
+        `counter_queries`) in each source. The sources are searched at the
+        same time, each one in a thread of its own, since they mostly wait
+        for the Web, the disk, the C n-gram counting library or their worker
+        processes.
+    """
+    global sources
+    if len(sources) == 1:
+        return [sources[0].search(queries)]
+    results = [None] * len(sources)
+    failures = []
+    def search(number):
+        try:
+            results[number] = sources[number].search(queries)
+        except BaseException:
+            failures.append(sys.exc_info())
+    threads = [threading.Thread(target=search, args=(number,))
+               for number in range(len(sources))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)  # Let Ctrl+C through
+    if failures:
+        (exc_type, exc_value, exc_traceback) = failures[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+################################################################################
+
+def counter_queries(ngram):
+    """
+        Returns the list of frequencies to search for the n-gram, in the
+        order in which they are added: each word, the n-gram as a whole and,
+        with "--bigrams", each bigram. Each frequency is given as a tuple
+        `(add, surfaces, lemmas, pos)`, where `add` is the method that adds
+        the `Frequency` to the word or n-gram.
 
-        If the option "--bigrams" is active, calls the frequency function for
-        each bigram in the 'Ngram'.
-        
         @param ngram The `Ngram` that is being counted.
     """
-    global get_freq_function, freq_name, count_joint_frequency, count_bigrams
-    ( c_surfaces, c_lemmas, c_pos ) = ( [], [], [] )
-    for w in ngram:
-        c_surfaces.append(w.surface)
-        c_lemmas.append(w.lemma)
-        c_pos.append(w.pos)
-        freq_value = get_freq_function([w.surface],
-                                       [w.lemma],
-                                       [w.pos])
-        w.add_frequency(Frequency(freq_name, freq_value))
+    global count_joint_frequency, count_bigrams
+    words = list(ngram)
+    c_surfaces = [w.surface for w in words]
+    c_lemmas = [w.lemma for w in words]
+    c_pos = [w.pos for w in words]
+    queries = [(w.add_frequency, [w.surface], [w.lemma], [w.pos])
+               for w in words]
     # Global frequency
     if count_joint_frequency:
-        freq_value = get_freq_function(c_surfaces, c_lemmas, c_pos)
-        ngram.add_frequency(Frequency(freq_name, freq_value))
+        queries.append((ngram.add_frequency, c_surfaces, c_lemmas, c_pos))
     # Bigrams frequency
     if count_bigrams:
-        i = 0
-        while i < len(ngram) - 1:
-            freq_value = get_freq_function(c_surfaces[i:i + 2],
-                                           c_lemmas[i:i + 2], c_pos[i:i + 2])
-            i = i + 1
-            ngram.add_bigram(Frequency(freq_name, freq_value))
+        for i in range(len(words) - 1):
+            queries.append((ngram.add_bigram, c_surfaces[i:i + 2],
+                            c_lemmas[i:i + 2], c_pos[i:i + 2]))
+    return queries
 
 
 ################################################################################
 
-def get_freq_index(surfaces, lemmas, pos):
+def get_freqs_index(suffix_array, ngrams):
     """
-        Gets the frequency (number of occurrences) of a token (word) in the
-        index file. Calling this function assumes that you called the script
-        with the -i option and with a valid index file.
+        Gets the frequencies (numbers of occurrences) of a list of ngrams in
+        an index file, in a single call to the counter of the index.
         
-        @param surfaces A string corresponding to the surface form of a word.
+        @param suffix_array The counter of the index given with -i (see
+        `open_index`).
 
-        @param lemmas A string corresponding to the lemma of a word.
-        
-        @param pos A string corresponding to the Part Of Speech of a word.
-    """
-    global build_entry, suffix_array
-    ngram_ids = []
-    #pdb.set_trace()
-    for i in range(len(surfaces)):
-        word = build_entry(surfaces[i], lemmas[i], pos[i])
-        wordid = suffix_array.symbols.symbol_to_number.get(word, None)
-        if wordid:
-            ngram_ids.append(wordid)
-        else:
-            return 0
-
-    #i_last = binary_search(ng_ids, ngrams_file,corpus_file,lambda a, b:a > b)
-    #i_first = binary_search(ng_ids, ngrams_file,corpus_file,lambda a, b:a >= b)
-    indexrange = suffix_array.find_ngram_range(ngram_ids)
-    if indexrange is not None:
-        first, last = indexrange
-        return last - first + 1
-    else:
-        return 0
+        @param ngrams A list of ngrams, each one a list of entries made by
+        `build_entry`.
+    """
+    return suffix_array.count_ngrams(ngrams)
 
 
 ################################################################################
 
-def get_freq_web(surfaces, lemmas, pos):
+def get_freqs_web(web_freq, ngrams):
     """
-        Gets the frequency (number of occurrences) of a token (word) in the
-        Web through Yahoo's or Google's index. Calling this function assumes 
-        that you called the script with the -u or -w option.
+        Gets the frequencies (numbers of occurrences) of a list of ngrams in
+        the Web through Yahoo's or Google's index.
         
-        @param surfaces A list corresponding to the surface forms of a word.
+        @param web_freq The `WebFreq` of the -w, -u or -L option.
 
-        @param lemmas A list corresponding to the lemmas of a word.
-        
-        @param pos A list corresponding to the Part Of Speeches of a word. This
-        parameter is ignored since Web search engines dos no provide linguistic 
-        information.
+        @param ngrams A list of ngrams, each one a list of entries made by
+        `build_entry`. POS is ignored since Web search engines do not
+        provide linguistic information.
     """
-    # POS is ignored
-    global web_freq, build_entry, language
-    search_term = ""
-    for i in range(len(surfaces)):
-        search_term = search_term + build_entry(surfaces[i], lemmas[i],
-                                                pos[i]) + " "
-    return web_freq.search_frequency(search_term.strip(), language)
+    global language
+    return web_freq.search_frequencies([" ".join(words) for words in ngrams],
+                                       language)
 
 
 ################################################################################
 
-def read_file(path):
-    fh = open(path)
-    txt = fh.read()
-    fh.close()
-    return txt
+def get_freqs_web1t(web1t_freq, ngrams):
+    """
+        Gets the frequencies (numbers of occurrences) of a list of ngrams in
+        Google's Web 1T 5-gram Corpus, through its block index.
+        
+        @param web1t_freq The `Web1TFreq` of the -T option.
+
+        @param ngrams A list of ngrams, each one a list of entries made by
+        `build_entry`.
+    """
+    return [web1t_freq.search_frequency(words) for words in ngrams]
 
 
 ################################################################################
 
-def get_freq_web1t(surfaces, lemmas, pos):
+def get_freqs_web1t_scan(web1t_freq, ngrams):
     """
-        Gets the frequency (number of occurrences) of an ngram in Google's
-        Web 1T 5-gram Corpus.
+        Same as `get_freqs_web1t`, but reads the corpus files only once for
+        all the ngrams instead of using the block index (see
+        `Web1TFreq.count_ngrams`), with -T and --scan.
     """
+    global max_jobs
+    return web1t_freq.count_ngrams(ngrams, max_jobs)
 
-    global build_entry, web1t_data_path
-
-    length = len(surfaces)
 
-    if length > 5:
-        warn("Cannot count the frequency of an n-gram, n>5!")
-        return 0
-
-    search_term = ' '.join(map(build_entry, surfaces, lemmas, pos))
+################################################################################
 
-    # Find the file in which to look for the ngram.
-    if length == 1:
-        filename = web1t_data_path + "/1gms/vocab.gz"
-    else:
-        indexfile = web1t_data_path + "/%dgms/%dgm.idx" % (length, length)
-        filenames = [x.split("\t") for x in read_file(indexfile).split("\n")]
-        filename = None
-        for (name, first) in filenames:
-            # Assumes byte-value-based ordering!
-            if first > search_term:
-                break
-            else:
-                filename = name
-
-        if filename is None:
-            return 0
-        filename = "%s/%dgms/%s" % (web1t_data_path, length, filename)
-
-    verbose("WEB1T: Opening %s, looking for %s" % (filename, search_term))
-
-    # This has been absurdly slow in Python.
-    #file = gzip.open(filename, "rb")
-    #
-    #search_term += "\t"
-    #freq = 0
-    #
-    #for line in file:
-    #    if line.startswith(search_term):
-    #        freq = int(line.split("\t")[1])
-    #        break
-    #
-    #print >>sys.stderr, "buenito: %d" % freq
-    #
-    #file.close()
-
-    file = subprocess.Popen(
-        ["zgrep", "--", "^" + re.escape(search_term) + "\t", filename],
-        stdout=subprocess.PIPE).stdout
-    line = file.read()
-    file.close()
-    if line:
-        freq = int(line.split("\t")[1])
+def make_build_entry(surface_flag, ignorepos_flag):
+    """
+        Returns the function that makes the entry searched for a word, given
+        its surface form, lemma and POS: the surface form with -s, else the
+        lemma, followed by the POS unless POS is ignored.
+    """
+    if surface_flag and ignorepos_flag:
+        return lambda surface, lemma, pos: surface
+    elif surface_flag:
+        return lambda surface, lemma, pos: surface + ATTRIBUTE_SEPARATOR + pos
+    elif ignorepos_flag:
+        return lambda surface, lemma, pos: lemma
     else:
-        freq = 0
-    verbose("freq =" + str(freq))
-    return freq
+        return lambda surface, lemma, pos: lemma + ATTRIBUTE_SEPARATOR + pos
 
 
 ################################################################################
 
-def open_index(prefix):
+def open_index(path, surface_flag, ignorepos_flag):
     """
     Open the index files (valid index created by the `index.py` script). 
-    @param prefix The string name of the index file.
+    @param path The name of the `.info` file or of the shard manifest.
+    @return The `FrequencySource` of the index.
     """
-    global freq_name, the_corpus_size
-    global index, suffix_array
-    assert prefix.endswith(".info")
-    prefix = prefix[:-len(".info")]
+    global max_jobs
     try:
         verbose("Loading index files... this may take some time.")
-        index = Index(prefix)
+        if path.endswith(SHARD_MANIFEST_EXT):
+            index = ShardedIndex(path)
+            prefix = path[:-len(SHARD_MANIFEST_EXT)]
+            index.max_jobs = max_jobs
+        else:
+            assert path.endswith(".info")
+            prefix = path[:-len(".info")]
+            index = Index(prefix)
         index.load_metadata()
-        freq_name = re.sub(".*/", "", prefix)
-        #pdb.set_trace()
-        the_corpus_size = index.metadata["corpus_size"]
+        corpus_size = index.metadata["corpus_size"]
     except IOError:
         error("Error opening the index.\nTry again with another index filename")
     except KeyError:
         error("Error opening the index.\nTry again with another index filename")
 
+    attribute = ("surface" if surface_flag else "lemma") + \
+                ("" if ignorepos_flag else "+pos")
+    suffix_array = index.load_counter(attribute)
+    # Frequencies kept in a file are valid for the same index and entries
+    signature = " ".join(["index", "%s:%d" % (os.path.abspath(path),
+                          os.path.getmtime(path)), attribute, str(corpus_size)])
+    return FrequencySource(re.sub(".*/", "", prefix), corpus_size,
+                           functools.partial(get_freqs_index, suffix_array),
+                           make_build_entry(surface_flag, ignorepos_flag),
+                           signature, suffix_array.close
+                           if isinstance(index, ShardedIndex) else None)
+
+
+################################################################################
+
+def open_web(web_freq, name, source, surface_flag):
+    """
+    Returns the `FrequencySource` of a Web search engine, or of a simulated
+    one (-L), given its `WebFreq`. Entries are single surface or lemma forms.
+    @param source A string that identifies the counts of the search engine.
+    """
+    global web_jobs, web_rate
+    web_freq.max_requests = web_jobs
+    web_freq.bucket = TokenBucket(web_rate, web_jobs)
+    corpus_size = web_freq.corpus_size()
+    signature = " ".join([name, source, "surface" if surface_flag else "lemma",
+                          str(corpus_size)])
+    return FrequencySource(name, corpus_size,
+                           functools.partial(get_freqs_web, web_freq),
+                           make_build_entry(surface_flag, True), signature,
+                           web_freq.flush_cache)
+
+
+################################################################################
+
+def open_web1t(path, surface_flag):
+    """
+    Returns the `FrequencySource` of the Web 1T 5-gram Corpus in `path`.
+    """
+    global web1t_index_path, scan_web1t
+    web1t_freq = Web1TFreq(path, web1t_index_path)
+    corpus_size = web1t_freq.corpus_size()
+    signature = " ".join(["web1t", os.path.abspath(path), "surface"
+                          if surface_flag else "lemma", str(corpus_size)])
+    get_freqs = get_freqs_web1t_scan if scan_web1t else get_freqs_web1t
+    return FrequencySource("web1t", corpus_size,
+                           functools.partial(get_freqs, web1t_freq),
+                           make_build_entry(surface_flag, True), signature,
+                           web1t_freq.close)
+
 ################################################################################
 
 def treat_text( line ):
@@ -430,30 +707,35 @@ def treat_options(opts, arg, n_arg, usage_string):
         
         @param n_arg The number of arguments expected for this script.    
     """
-    global cache_file, get_freq_function, build_entry, web_freq
-    global the_corpus_size, freq_name
+    global cache_file, sources, web_freq
     global low_limit, up_limit
     global count_vars
     global language
-    global suffix_array
     global count_joint_frequency
     global count_bigrams
-    global web1t_data_path
+    global scan_web1t
+    global web1t_index_path
     global filetype_corpus_ext
     global filetype_candidates_ext
     global output_filetype_ext
+    global max_jobs
+    global web_jobs
+    global web_rate
+    global local_latency
+    global local_error_rate
+    global local_cache
+    global memo_size
+    global memo_path
 
     surface_flag = False
     ignorepos_flag = False
-    mode = []
+    mode = []  # Kind and argument of each frequency source option
 
     treat_options_simplest(opts, arg, n_arg, usage_string)
 
     for ( o, a ) in opts:
         if o in ( "-i", "--index" ):
-            open_index(a)
-            get_freq_function = get_freq_index
-            mode.append("index")
+            mode.append(("index", a))
         elif o in ( "-y", "--yahoo" ):
             error("THIS OPTION IS DEPRECATED AS YAHOO SHUT DOWN THEIR FREE "
                   "SEARCH API")
@@ -461,29 +743,16 @@ def treat_options(opts, arg, n_arg, usage_string):
             #freq_name = "yahoo"
             #ignorepos_flag = True 
             #the_corpus_size = web_freq.corpus_size()         
-            #get_freq_function = get_freq_web
+            #get_freqs_function = get_freqs_web
             #mode.append( "yahoo" )   
         elif o in ( "-w", "--google" ):
-            web_freq = GoogleFreq()
-            freq_name = "google"
-            ignorepos_flag = True
-            the_corpus_size = web_freq.corpus_size()
-            get_freq_function = get_freq_web
-            mode.append("google")
+            mode.append(("google", a))
         elif o in ( "-u", "--univ" ):
-            web_freq = GoogleFreqUniv(a)
-            freq_name = "google"
-            ignorepos_flag = True
-            the_corpus_size = web_freq.corpus_size()
-            get_freq_function = get_freq_web
-            mode.append("google")
+            mode.append(("univ", a))
+        elif o in ("-L", "--local"):
+            mode.append(("local", a))
         elif o in ("-T", "--web1t"):
-            ignorepos_flag = True
-            freq_name = "web1t"
-            web1t_data_path = a
-            the_corpus_size = int(read_file(web1t_data_path + "/1gms/total"))
-            get_freq_function = get_freq_web1t
-            mode.append("web1t")
+            mode.append(("web1t", a))
         elif o in ("-s", "--surface" ):
             surface_flag = True
         elif o in ("-g", "--ignore-pos"):
@@ -515,39 +784,96 @@ def treat_options(opts, arg, n_arg, usage_string):
             count_bigrams = True
         elif o in ("-o", "--old"):
             Index.use_c_indexer(False)
+        elif o == "--web1t-index":
+            web1t_index_path = a
+        elif o == "--scan":
+            scan_web1t = True
         elif o == "--corpus-from":
             filetype_corpus_ext = a
         elif o == "--candidates-from":
             filetype_candidates_ext = a
         elif o == "--to":
             output_filetype_ext = a
+        elif o in ("-j", "--jobs"):
+            try:
+                max_jobs = int(a)
+            except ValueError:
+                max_jobs = 0
+            if max_jobs < 1:
+                error("Argument of " + o + " must be a positive integer")
+            web_jobs = max_jobs
+        elif o == "--rate":
+            try:
+                web_rate = float(a)
+            except ValueError:
+                web_rate = 0
+            if web_rate <= 0:
+                error("Argument of " + o + " must be a positive number")
+        elif o == "--latency":
+            try:
+                local_latency = float(a)
+            except ValueError:
+                local_latency = -1
+            if local_latency < 0:
+                error("Argument of " + o + " must be a non-negative number")
+        elif o == "--error-rate":
+            try:
+                local_error_rate = float(a)
+            except ValueError:
+                local_error_rate = -1
+            if not 0 <= local_error_rate <= 1:
+                error("Argument of " + o + " must be a number between 0 and 1")
+        elif o == "--no-cache":
+            local_cache = False
+        elif o == "--memo":
+            try:
+                memo_size = int(a)
+            except ValueError:
+                memo_size = -1
+            if memo_size < 0:
+                error("Argument of " + o + " must be a non-negative integer")
+        elif o == "--memo-file":
+            memo_path = a
         else:
             raise Exception("Bad arg: " + o)
 
-    if mode == ["index"]:
-        if surface_flag and ignorepos_flag:
-            build_entry = lambda surface, lemma, pos: surface
-            suffix_array = index.load("surface")
-        elif surface_flag:
-            build_entry = lambda surface, lemma, pos: surface +\
-                                                      ATTRIBUTE_SEPARATOR + pos
-            suffix_array = index.load("surface+pos")
-        elif ignorepos_flag:
-            build_entry = lambda surface, lemma, pos: lemma
-            suffix_array = index.load("lemma")
-        else:
-            build_entry = lambda surface, lemma, pos: lemma +\
-                                                      ATTRIBUTE_SEPARATOR + pos
-            suffix_array = index.load("lemma+pos")
+    if not mode:
+        error("At least one option -u, -w, -L, -T or -i must be provided")
+    if scan_web1t and "web1t" not in dict(mode):
+        error("Option --scan can only be used with -T")
 
-    else:  # Web search, entries are single surface or lemma forms
-        if surface_flag:
-            build_entry = lambda surface, lemma, pos: surface
+    for (kind, a) in mode:
+        if kind == "index":
+            sources.append(open_index(a, surface_flag, ignorepos_flag))
+        elif kind == "google":
+            web_freq = GoogleFreq()
+            sources.append(open_web(web_freq, "google", language,
+                                    surface_flag))
+        elif kind == "univ":
+            web_freq = GoogleFreqUniv(a)
+            sources.append(open_web(web_freq, "google", language,
+                                    surface_flag))
+        elif kind == "local":
+            web_freq = LocalFreq(a, latency=local_latency,
+                                 error_rate=local_error_rate,
+                                 use_cache=local_cache)
+            sources.append(open_web(web_freq, "local", "%s:%d" % (
+                    os.path.abspath(a), os.path.getmtime(a)), surface_flag))
         else:
-            build_entry = lambda surface, lemma, pos: lemma
-
-    if len(mode) != 1:
-        error("Exactly one option -u, -w or -i, must be provided")
+            sources.append(open_web1t(a, surface_flag))
+    names = [source.name for source in sources]
+    for name in names:
+        if names.count(name) > 1:
+            error("Several frequency sources are named \"" + name + "\"")
+
+    # Frequencies kept in a file are valid for the same corpus and entries
+    memos = load_memos(memo_path) if memo_path is not None else {}
+    for source in sources:
+        source.memo = FrequencyMemo(memo_size, source.signature,
+                                    memos.get(source.signature))
+        if source.signature in memos:
+            verbose("Loaded %d frequencies of %s from %s"
+                    % (len(source.memo.entries), source.name, memo_path))
     #elif text_input and web_freq is None:
     #    warn("-x option is recommended for web queries, not textual indices")
 
@@ -558,13 +884,24 @@ def treat_options(opts, arg, n_arg, usage_string):
 longopts = ["candidates-from=", "corpus-from=", "to=",
             "yahoo", "google", "index=", "ignore-pos", "surface", "old",
             "lower=", "upper=", "vars", "lang=", "no-joint", "bigrams",
-            "univ=", "web1t="]
-args = read_options("ywi:gsoal:Jbu:T:", longopts,
+            "univ=", "web1t=", "jobs=", "web1t-index=", "scan", "memo=",
+            "memo-file=", "rate=", "local=", "latency=", "error-rate=",
+            "no-cache"]
+args = read_options("ywi:gsoal:Jbu:T:j:L:", longopts,
         treat_options, -1, usage_string)
 
 try:
     verbose("Counting ngrams in candidates file")
-    filetype.parse(args, CounterPrinter(), filetype_candidates_ext)
+    # The candidates kept by `CounterPrinter` are not garbage, but make every
+    # collection of the cyclic garbage collector slower as they pile up
+    gc.disable()
+    try:
+        filetype.parse(args, CounterPrinter(), filetype_candidates_ext)
+    finally:
+        gc.enable()
 finally:
-    if web_freq:
-        web_freq.flush_cache()  # VERY IMPORTANT!
+    for source in sources:
+        source.close()
+        source.memo.report(source.name)
+    if memo_path is not None:
+        save_memos(memo_path, [source.memo for source in sources])
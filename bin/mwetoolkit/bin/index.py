@@ -33,7 +33,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-from libs.util import error, treat_options_simplest, read_options
+import sys
+import subprocess
+import multiprocessing
+
+from libs.util import error, verbose, warn, treat_options_simplest, \
+        read_options
 from libs.filetype import indexlib
 
 ################################################################################
@@ -51,6 +56,12 @@ formats accepted by the `--from` switch.
 
 The -i <index> option is mandatory.
 
+In verbose mode, the progress of each phase of the build (reading the
+corpus, sorting the suffix arrays) is reported every few seconds, with an
+estimate of the remaining time. The attributes whose files are complete are
+recorded in <index>.checkpoint: if the build is interrupted, running the
+same command again on the same <corpus> files skips these attributes.
+
 
 OPTIONS may be:    
 
@@ -61,6 +72,74 @@ OPTIONS may be:
 -o OR --old
     Use the old (slower) Python indexer, even when the C indexer is available.
 
+-j <n> OR --jobs <n>
+    Build the suffix arrays of up to <n> attributes at the same time. With
+    the C indexer, jobs left over when there are fewer attributes than <n>
+    are used as threads to sort each array. By default, uses as many jobs as
+    there are processors.
+
+-M <megabytes> OR --memory <megabytes>
+    Do not start a new attribute build if the estimated memory used by all
+    running builds would exceed <megabytes>. By default, there is no limit.
+
+-x <words> OR --external <words>
+    Build the suffix arrays on disk, for corpora that do not fit in memory.
+    At most <words> suffixes are sorted in memory at a time; sorted runs are
+    then merged into the final index files.
+
+--tmpdir <dir>
+    Directory for the temporary files of the -x option (by default, the
+    system's temporary directory). It should have room for about 3 times
+    the size of the index.
+
+-z OR --compress
+    Store the corpus arrays compressed. Frequent words take less space, so
+    the index is smaller on disk and in the page cache, but counting ngrams
+    is slower, as each word read must be decoded.
+
+-A OR --append
+    Add the sentences of <corpus> to the existing index <index>, without
+    rebuilding it. The new sentences are indexed as a separate segment, and
+    frequencies are summed over all segments. When the index has too many
+    segments, they are merged into the main index by a background process.
+
+--merge
+    Merge the segments of the existing index <index> into the main index,
+    and exit. No <corpus> is read. The main index and its segments are read
+    and sorted again as a whole. If the segments of <index> are already being
+    merged by another process, exits at once.
+
+--shards
+    Make a sharded index out of existing indexes, built independently
+    (e.g. on different machines), without rebuilding them. The <corpus>
+    arguments must be the `.info` files of the shards, and the manifest
+    listing them is written to <index>.shards. Their frequencies can then
+    be summed with `counter.py -i <index>.shards`.
+
+--verify
+    Check the files of the existing index <index>, and exit. Reports array
+    files that are truncated, corrupted (checksum mismatch) or unreadable.
+    Exits with status 1 if any file has a problem. No <corpus> is read.
+
+--max-segments <n>
+    Number of segments that triggers a background merge with -A.
+    Default: 4.
+
+--count-table <n>
+    Export the counts of all the ngrams of 1 to <n> words of the existing
+    index <index> to count tables, and exit. No <corpus> is read. A count
+    table is written to <index>.<attr>.counts for each attribute given with
+    -a (by default, each of surface, surface+pos, lemma and lemma+pos whose
+    files exist). `counter.py -i` then looks ngrams up in the count table,
+    which is much faster than searching the suffix array. The index must
+    not have segments (see --merge), and the tables must be exported again
+    whenever the index changes, as outdated tables are ignored.
+
+--min-freq <f>
+    Leave the ngrams that occur less than <f> times out of the count tables,
+    which makes them smaller. Such ngrams are then searched in the suffix
+    array by `counter.py`. Default: 1.
+
 --from <input-filetype-ext>
     Force reading of corpus with given filetype extension.
     (By default, file type is automatically detected):
@@ -96,6 +175,16 @@ OPTIONS may be:
 use_text_format = None
 input_filetype_ext = None
 basename = None
+max_jobs = multiprocessing.cpu_count()
+memory_budget = None
+external_run_size = None
+temp_dir = None
+mode = "build"
+compress = False
+max_segments = indexlib.MAX_INDEX_SEGMENTS
+count_table_n = None
+min_freq = 1
+attributes_given = False
 
 
 ################################################################################
@@ -115,6 +204,16 @@ def treat_options( opts, arg, n_arg, usage_string ) :
     global build_entry
     global use_text_format
     global input_filetype_ext
+    global max_jobs
+    global memory_budget
+    global external_run_size
+    global temp_dir
+    global mode
+    global compress
+    global max_segments
+    global count_table_n
+    global min_freq
+    global attributes_given
 
     treat_options_simplest( opts, arg, n_arg, usage_string )
 
@@ -126,23 +225,125 @@ def treat_options( opts, arg, n_arg, usage_string ) :
             input_filetype_ext = a
         elif o in ("-a", "--attributes"):
             used_attributes = a.split(":")
+            attributes_given = True
         elif o in ("-m", "--moses"):
             use_text_format = "moses"
         elif o in ("-c", "--conll"):
             use_text_format = "conll"            
         elif o in ("-o", "--old"):
             indexlib.Index.use_c_indexer(False)
+        elif o in ("-j", "--jobs"):
+            try:
+                max_jobs = int(a)
+            except ValueError:
+                max_jobs = 0
+            if max_jobs < 1:
+                error("Argument of " + o + " must be a positive integer")
+        elif o in ("-M", "--memory"):
+            try:
+                memory_budget = int(a) * 1024 * 1024
+            except ValueError:
+                memory_budget = 0
+            if memory_budget <= 0:
+                error("Argument of " + o + " must be a positive integer")
+        elif o in ("-x", "--external"):
+            try:
+                external_run_size = int(a)
+            except ValueError:
+                external_run_size = 0
+            if external_run_size <= 0:
+                error("Argument of " + o + " must be a positive integer")
+        elif o == "--tmpdir":
+            temp_dir = a
+        elif o in ("-z", "--compress"):
+            compress = True
+        elif o in ("-A", "--append"):
+            mode = "append"
+        elif o == "--merge":
+            mode = "merge"
+        elif o == "--verify":
+            mode = "verify"
+        elif o == "--shards":
+            mode = "shards"
+        elif o == "--max-segments":
+            try:
+                max_segments = int(a)
+            except ValueError:
+                max_segments = 0
+            if max_segments <= 0:
+                error("Argument of " + o + " must be a positive integer")
+        elif o == "--count-table":
+            mode = "count-table"
+            try:
+                count_table_n = int(a)
+            except ValueError:
+                count_table_n = 0
+            if not 1 <= count_table_n <= indexlib.NGRAM_LIMIT:
+                error("Argument of " + o + " must be an integer between 1 "
+                      "and %d" % indexlib.NGRAM_LIMIT)
+        elif o == "--min-freq":
+            try:
+                min_freq = int(a)
+            except ValueError:
+                min_freq = 0
+            if min_freq <= 0:
+                error("Argument of " + o + " must be a positive integer")
             
     if basename is None:     
         error("You must provide a filename for the index.\n"
               "Option -i is mandatory.")
+    if external_run_size is not None:
+        indexlib.Index.use_external_indexer(external_run_size, temp_dir)
 
                             
 ################################################################################
 # MAIN SCRIPT
 
-longopts = ["from=", "index=", "attributes=", "old", "moses", "conll" ]
-arg = read_options( "i:a:omc", longopts, treat_options, -1, usage_string )
+longopts = ["from=", "index=", "attributes=", "old", "moses", "conll",
+            "jobs=", "memory=", "external=", "tmpdir=", "append", "merge",
+            "max-segments=", "verify", "compress", "shards", "count-table=",
+            "min-freq=" ]
+arg = read_options( "i:a:omcj:M:x:Az", longopts, treat_options, -1, usage_string )
+
+if mode == "merge":
+    indexlib.merge_index_segments(indexlib.Index(basename), max_jobs,
+                                  memory_budget)
+    sys.exit(0)
+
+if mode == "verify":
+    problems = indexlib.Index(basename).verify()
+    for (path, problem) in problems:
+        warn("{path}: {problem}", path=path, problem=problem)
+    verbose("%d problem(s) found in index %s." % (len(problems), basename))
+    sys.exit(1 if problems else 0)
+
+if mode == "count-table":
+    index = indexlib.Index(basename)
+    index.load_metadata()
+    if not attributes_given:
+        used_attributes = [attr for attr in ["surface", "surface+pos",
+                                             "lemma", "lemma+pos"]
+                           if all(index.array_file_exists(a)
+                                  for a in attr.split('+'))]
+    for attr in used_attributes:
+        indexlib.write_count_table(index, attr, count_table_n, min_freq)
+    sys.exit(0)
+
+if mode == "shards":
+    indexlib.write_shard_manifest(basename + indexlib.SHARD_MANIFEST_EXT, arg)
+    verbose("Wrote manifest of %d shard(s) to %s%s."
+            % (len(arg), basename, indexlib.SHARD_MANIFEST_EXT))
+    sys.exit(0)
+
+if mode == "append":
+    index = indexlib.Index(basename)
+    nb_segments = indexlib.append_to_index(index, arg, input_filetype_ext,
+                                           max_jobs, memory_budget)
+    if nb_segments >= max_segments:
+        verbose("Merging segments in the background...")
+        subprocess.Popen([sys.executable, sys.argv[0], "--merge",
+                          "-i", basename], close_fds=True)
+    sys.exit(0)
 
 simple_attrs = [a for a in used_attributes if '+' not in a]
 composite_attrs = [a for a in used_attributes if '+' in a]
@@ -153,9 +354,36 @@ for attrs in [attr.split('+') for attr in composite_attrs]:
             simple_attrs.append(attr)
 
 
-index = indexlib.Index(basename, simple_attrs)
-indexlib.populate_index(index, arg, input_filetype_ext)
+checkpoint = None
+done_attrs = []
+if arg and "-" not in arg:
+    checkpoint = indexlib.BuildCheckpoint(basename, arg)
+    done_attrs = [a for a in checkpoint.completed_attributes()
+                  if a in simple_attrs + composite_attrs]
+    if done_attrs:
+        verbose("Resuming build, attributes already done: %s."
+                % ", ".join(done_attrs))
+
+todo_attrs = [a for a in simple_attrs if a not in done_attrs]
+index = indexlib.Index(basename, todo_attrs)
+if todo_attrs:
+    indexlib.populate_index(index, arg, input_filetype_ext)
+    index.build_suffix_arrays(max_jobs, memory_budget, checkpoint)
+else:
+    index.metadata["corpus_size"] = checkpoint.metadata["corpus_size"]
+    index.metadata["position_width"] = checkpoint.metadata["position_width"]
+if checkpoint is None:
+    index.save_main()
+else:
+    index.save_metadata()
+if compress:
+    index.compress_corpora()
+    index.save_metadata()
+# Fused arrays are made from the files of the simple attributes
 for attr in composite_attrs:
-    index.make_fused_array(attr.split('+'))
-index.build_suffix_arrays()
-index.save_main()
+    if attr not in done_attrs:
+        index.make_fused_array(attr.split('+'))
+        if checkpoint is not None:
+            checkpoint.mark_done(attr, index.metadata)
+if checkpoint is not None:
+    checkpoint.clear()
@@ -23,11 +23,12 @@
 #
 ################################################################################
 """
-    This script joins two web frequency cache files. These files are generated
-    by counter.py and store the Google or Yahoo word and ngram counts. If two
-    cache entries have the same value, the newest one is kept. Joining cache
-    files from Yahoo and from Google in a single file is not recommended since
-    these two search engines have different index sizes and counts.
+    This script joins two or more web frequency cache files. These files are
+    generated by counter.py and store the Google or Yahoo word and ngram
+    counts. If two cache entries have the same key, the newest one is kept.
+    Joining cache files from Yahoo and from Google in a single file is not
+    recommended since these two search engines have different index sizes and
+    counts.
     
     For more information, call the script with no parameter and read the
     usage instructions.
@@ -38,9 +39,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-import cPickle
+import os
+import heapq
+import itertools
 
-from libs.util import read_options, treat_options_simplest, verbose
+from libs.base.webCache import WebCache, iter_cache_file
+from libs.util import read_options, treat_options_simplest, verbose, error
                  
 #from base.__common import TEMP_PREFIX, TEMP_FOLDER
      
@@ -49,54 +53,77 @@ from libs.util import read_options, treat_options_simplest, verbose
      
 usage_string = """Usage: 
     
-python {program} OPTIONS <cache1.dat> <cache2.dat> <cache_out.dat>
+python {program} OPTIONS <cache1.dat> <cache2.dat> [<cache3.dat> ...] <cache_out.dat>
 
 OPTIONS may be:
 
 {common_options}
 
     The <cache*.dat> files must be generated by counter.py, and should be
-    different from each other.
+    different from each other. The caches are read in key order and merged
+    as they are read, so that they need not fit in memory (except for cache
+    files of older versions of counter.py).
 """       
 
+entry_counts = []  # Number of entries read from each input cache
+
 ################################################################################
 
-def combine_caches( cache1, cache2, cache_out ) :
+def count_entries( entries, number ) :
+    """
+        Yields the entries `(key, value)` of the input cache `number`, as
+        `(key, number, value)`, counting them in `entry_counts`.
+    """
+    for ( key, value ) in entries :
+        entry_counts[ number ] += 1
+        yield ( key, number, value )
+
+################################################################################
+
+def merge_caches( caches ) :
+    """
+        Given a list of web caches, each one an iterator over its entries
+        `(key, (freq, date))` sorted by key, yields the entries of their
+        union, sorted by key. If a key is contained in several caches, then
+        the value of the most recent one is kept and the older ones are
+        discarded. If they are from the same date, the value from the first
+        cache in the list is kept.
     """
-        Given two web caches, generates a third one which is the union of the
-        first two. If a key is contained in both caches, then the value of the
-        most recent one is kept and the oldest is discarded. If they are both
-        from the same date, the value from cache1 is kept.
-    """    
-    # First, copy all entries from cache1 to cache_out
-    for k1 in cache1.keys() :
-        cache_out[ k1 ] = cache1[ k1 ]   
-    # Update entries in cache_out if corresponding entry in cache_2 is newer
-    for k2 in cache2.keys() :        
-        ( freq2, date2 ) = cache2[ k2 ]
-        ( freq_out, date_out ) = cache_out.get( k2, ( -1, None ) )
-        if date_out is None :
-            cache_out[ k2 ] = ( freq2, date2 )
-        elif date2 < date_out :
-            cache_out[ k2 ] = ( freq2, date2 )
+    entry_counts[ : ] = [ 0 ] * len( caches )
+    entries = heapq.merge( *[ count_entries( cache, number )
+                              for ( number, cache ) in enumerate( caches ) ] )
+    for ( key, group ) in itertools.groupby( entries, lambda entry: entry[ 0 ] ):
+        newest = None
+        for ( key, number, ( freq, date ) ) in group :
+            if newest is None or date > newest[ 1 ] :
+                newest = ( freq, date )
+        yield ( key, newest )
+
+################################################################################
+
+def treat_options( opts, arg, n_arg, usage_string ) :
+    """
+        Callback function that handles the command line options of this script.
+    """
+    treat_options_simplest( opts, arg, n_arg, usage_string )
+    if len( arg ) < 3 :
+        error( "You must provide at least two input caches and an output cache" )
+    if os.path.abspath( arg[ -1 ] ) in map( os.path.abspath, arg[ : -1 ] ) :
+        error( "The output cache must be different from the input caches" )
 
 ################################################################################     
 # MAIN SCRIPT
 
 longopts = []
-arg = read_options( "", longopts, treat_options_simplest, 3, usage_string )
-
-verbose( "Opening files and checking consistency" )
-cache1_desc = open( arg[ 0 ], "r" )
-cache2_desc = open( arg[ 1 ], "r" )
-cache_out_desc = open( arg[ 2 ], "w" )
-cache1 = cPickle.load( cache1_desc )
-cache2 = cPickle.load( cache2_desc )
-cache_out = {}
+arg = read_options( "", longopts, treat_options, -1, usage_string )
+
 verbose( "Combining cache files..." )
-combine_caches( cache1, cache2, cache_out )
-verbose( "Writing new cache file..." )
-cPickle.dump( cache_out, cache_out_desc )
-verbose( "{c} had {n} entries".format(c=arg[ 0 ], n=len(cache1)) )
-verbose( "{c} had {n} entries".format(c=arg[ 1 ], n=len(cache2)) )
-verbose( "Result has {n} entries".format(n=len(cache_out)) )
+for path in ( arg[ -1 ], arg[ -1 ] + "-wal", arg[ -1 ] + "-shm" ) :
+    if os.path.exists( path ) :
+        os.remove( path )
+cache_out = WebCache( arg[ -1 ] )
+cache_out.update( merge_caches( map( iter_cache_file, arg[ : -1 ] ) ) )
+for ( cache_path, nb_entries ) in zip( arg[ : -1 ], entry_counts ) :
+    verbose( "{c} had {n} entries".format( c=cache_path, n=nb_entries ) )
+verbose( "Result has {n} entries".format( n=len( cache_out ) ) )
+cache_out.close()
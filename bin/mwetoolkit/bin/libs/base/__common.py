@@ -52,6 +52,18 @@ DEFAULT_LANG = "en"
 """
 MAX_CACHE_DAYS = -1
 
+"""
+    Maximum number of Web queries sent at the same time, and maximum number of
+    queries sent per second on average (bursts of up to `WEB_MAX_REQUESTS`
+    queries are allowed). Queries that fail are retried up to
+    `WEB_MAX_TRIES` times in all, waiting `WEB_BACKOFF_SECONDS` before the
+    first retry, and twice as long before each of the next ones.
+"""
+WEB_MAX_REQUESTS = 4
+WEB_REQUESTS_PER_SECOND = 2
+WEB_MAX_TRIES = 5
+WEB_BACKOFF_SECONDS = 2
+
 """
     Application ID to be used with Yahoo Web Search API (see specific doc. for
     more details)
@@ -64,6 +76,12 @@ YAHOO_APPID = "ngram001"
 """
 C_INDEXER_PROGRAM = os.path.dirname(__file__) + "/../../c-indexer"
 
+"""
+    Path to the C n-gram counting library, built along with the C indexer.
+    Without it, ngrams are counted in Python.
+"""
+NGRAM_COUNT_LIBRARY = os.path.dirname(__file__) + "/../../libngramcount.so"
+
 # Internal options below (do not modify unless you know what you are doing)
 
 """
@@ -72,6 +90,7 @@ C_INDEXER_PROGRAM = os.path.dirname(__file__) + "/../../c-indexer"
 """
 YAHOO_CACHE_FILENAME = "yahoo_cache.dat"
 GOOGLE_CACHE_FILENAME = "google_cache.dat"
+LOCAL_CACHE_FILENAME = "local_cache.dat"
 
 """
     Characters internally used as attribute and word separators.
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding:UTF-8 -*-
+
+################################################################################
+#
+# Copyright 2010-2014 Carlos Ramisch, Vitor De Araujo, Silvio Ricardo Cordeiro,
+# Sandra Castellanos
+#
+# localFreq.py is part of mwetoolkit
+#
+# mwetoolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mwetoolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mwetoolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+"""
+    This module provides the `LocalFreq` class, a search engine simulated with
+    a local table of ngram counts, to test and benchmark the Web frequency
+    code without any Internet connection.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import codecs
+import random
+import threading
+import time
+import urllib2
+
+from libs.base.__common import LOCAL_CACHE_FILENAME
+from libs.base.webFreq import WebFreq
+from libs.filetype.indexlib import Index, ShardedIndex, SHARD_MANIFEST_EXT
+
+################################################################################
+
+class LocalConnection( object ) :
+    """
+        Stands for the connection of `WebFreq` to the search engine.
+    """
+
+    def close( self ) :
+        pass
+
+################################################################################
+
+class LocalFreq( WebFreq ) :
+    """
+        The `LocalFreq` class answers the queries of `WebFreq` from a local
+        table of ngram counts instead of a search engine, through the same
+        cache, concurrent requests, rate limit and retries. Each query can be
+        made to take some time and to fail at random, as real Web queries do.
+        The table is either a text file with one ngram and its count per line,
+        separated by a tab, or an index made by `index.py`.
+    """
+
+################################################################################
+
+    def __init__( self, table_path, attribute="surface", latency=0,
+                  error_rate=0, cache_filename=None, use_cache=True ) :
+        """
+            @param table_path The `.tsv` file of the ngram counts, or the
+            `.info` file (or the shard manifest) of an index.
+
+            @param attribute The attribute of the index whose ngrams are
+            counted. Since queries are lowercased, as in Web search engines,
+            the index should be made from a lowercased corpus.
+
+            @param latency The number of seconds that each query takes.
+
+            @param error_rate The probability that a query fails with the
+            "503 Service Unavailable" error.
+
+            @param cache_filename The name of the cache file (by default,
+            `LOCAL_CACHE_FILENAME`). The entries of each table are kept apart
+            by the path and modification time of the table.
+
+            @param use_cache Whether to use the cache. If false, all the
+            queries are sent, e.g. to benchmark the queries themselves.
+        """
+        if not use_cache :
+            cache_filename = None
+        elif not cache_filename :
+            cache_filename = LOCAL_CACHE_FILENAME
+        super( LocalFreq, self ).__init__( cache_filename, "local:" +
+                                           table_path, {}, None )
+        self.cache_prefix = "%s:%d___" % ( os.path.abspath( table_path ),
+                                           os.path.getmtime( table_path ) )
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        if table_path.endswith( ".info" ) or \
+                table_path.endswith( SHARD_MANIFEST_EXT ) :
+            if table_path.endswith( SHARD_MANIFEST_EXT ) :
+                self.index = ShardedIndex( table_path )
+            else :
+                self.index = Index( table_path[ : -len( ".info" ) ] )
+            self.index.load_metadata()
+            self.counter = self.index.load_counter( attribute )
+            self.counts = None
+            self.size = self.index.metadata[ "corpus_size" ]
+        else :
+            self.index = None
+            self.counts = {}
+            self.size = 0
+            table_file = codecs.open( table_path, "r", "utf-8" )
+            for line in table_file :
+                ( ngram, count ) = line.rstrip( "\n" ).rsplit( "\t", 1 )
+                ngram = " ".join( ngram.lower().split() )
+                self.counts[ ngram ] = self.counts.get( ngram, 0 ) + int( count )
+                if " " not in ngram :
+                    self.size += int( count )
+            table_file.close()
+
+################################################################################
+
+    def open_connection( self ) :
+        """
+            Returns a connection that does nothing, as no connection is needed.
+        """
+        return LocalConnection()
+
+################################################################################
+
+    def send_query( self, lang, search_term, connection=None ) :
+        """
+            Returns the count of `search_term` in the table, after waiting
+            `self.latency` seconds. The query fails with probability
+            `self.error_rate`.
+
+            @param lang The language code of the search. Ignored.
+
+            @param search_term The quoted and UTF-8 encoded search term, as
+            made by `search_frequencies`.
+
+            @param connection Ignored.
+        """
+        if self.latency :
+            time.sleep( self.latency )
+        if random.random() < self.error_rate :
+            raise urllib2.HTTPError( self.url, 503, "Service Unavailable "
+                                     "(simulated)", None, None )
+        ngram = search_term.decode( "utf-8" ).strip( "\"" ).split()
+        if self.counts is not None :
+            return self.counts.get( " ".join( ngram ), 0 )
+        with self.lock :
+            return self.counter.count_ngrams( [ ngram ] )[ 0 ]
+
+################################################################################
+
+    def corpus_size( self ) :
+        """
+            Returns the number of words in the index, or the sum of the counts
+            of the single words of the table.
+        """
+        return self.size
+
+################################################################################
+
+    def flush_cache( self ) :
+        """
+            Closes the cache file and the index.
+        """
+        super( LocalFreq, self ).flush_cache()
+        if isinstance( self.index, ShardedIndex ) :
+            self.counter.close()
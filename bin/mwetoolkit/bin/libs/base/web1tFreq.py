@@ -0,0 +1,412 @@
+#!/usr/bin/python
+# -*- coding:UTF-8 -*-
+
+################################################################################
+#
+# Copyright 2010-2014 Carlos Ramisch, Vitor De Araujo, Silvio Ricardo Cordeiro,
+# Sandra Castellanos
+#
+# web1tFreq.py is part of mwetoolkit
+#
+# mwetoolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mwetoolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mwetoolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+"""
+    This module provides the `Web1TFreq` class, which looks up the frequency
+    of ngrams in Google's Web 1T 5-gram corpus through a block index built
+    once over the gzipped files of the corpus, or by scanning these files
+    once for a whole batch of ngrams.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import bisect
+import zlib
+import subprocess
+import multiprocessing
+
+from libs.util import verbose, warn, error
+
+################################################################################
+
+# Number of bytes of uncompressed ngram lines per block of the block index.
+# Each lookup decompresses one block.
+WEB1T_BLOCK_SIZE = 65536
+WEB1T_BLOCK_CACHE_SIZE = 256  # Decompressed blocks kept by `Web1TFreq`
+
+# The block index of the n-grams is made of `<n>gm.blocks`, the zlib-compressed
+# blocks one after the other, and `<n>gm.blocks.idx`, a text file with the
+# offset and first n-gram of each block (`offset\tngram`), plus a last line
+# with the end offset of the last block.
+WEB1T_BLOCKS_EXT = ".blocks"
+WEB1T_BLOCK_TABLE_EXT = ".blocks.idx"
+
+WEB1T_MAX_LENGTH = 5
+
+################################################################################
+
+def scan_web1t_file(task):
+    """
+        Returns the counts of the byte strings of `terms` in the gzipped
+        Web1T file at `path`, in one pass over the file. If `is_sorted`, the
+        lines of the file and the `terms` must be sorted in byte order: the
+        file is merge-joined with the terms, only the decompressed chunks that
+        may contain a term are searched, and the scan stops after the last
+        term. Otherwise, every line is looked up in a dict of the terms. Runs
+        in worker processes of `Web1TFreq.count_ngrams`.
+    """
+    (path, terms, is_sorted) = task
+    counts = [0] * len(terms)
+    positions = dict((term, i) for (i, term) in enumerate(terms))
+    gz_file = open(path, "rb")
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    next_term = 0
+    rest = b""
+    while next_term < len(terms):
+        chunk = gz_file.read(WEB1T_BLOCK_SIZE)
+        if chunk:
+            text = rest + decompressor.decompress(chunk)
+            end = text.rfind(b"\n") + 1
+        else:
+            text = rest + decompressor.flush() + b"\n"
+            end = len(text)
+        (text, rest) = (b"\n" + text[:end], text[end:])
+        if not is_sorted:
+            for line in text.split(b"\n"):
+                tab = line.find(b"\t")
+                if tab < 0:
+                    continue  # Blank line between chunks or at the end
+                i = positions.get(line[:tab])
+                if i is not None:
+                    counts[i] = int(line[tab + 1:])
+        elif end > 0:
+            last_line = text[text.rfind(b"\n", 0, len(text) - 1) + 1:]
+            last = last_line[:last_line.find(b"\t")]
+            while next_term < len(terms) and (terms[next_term] <= last
+                                              or not chunk):
+                start = text.find(b"\n" + terms[next_term] + b"\t")
+                if start >= 0:
+                    start += len(terms[next_term]) + 2
+                    counts[next_term] = int(text[start:text.index(b"\n",
+                                                                  start)])
+                next_term += 1
+        if not chunk:
+            break
+    gz_file.close()
+    return counts
+
+
+################################################################################
+
+class Web1TFreq(object):
+    """
+        The `Web1TFreq` class gives the frequency of ngrams in a copy of the
+        Web 1T 5-gram corpus. The n-gram lines of the gzipped files of each
+        order are copied once into blocks of `WEB1T_BLOCK_SIZE` bytes, which
+        are compressed separately. The table of the first n-gram of each block
+        is loaded in memory, so that looking up an n-gram reads and
+        decompresses a single block.
+    """
+
+################################################################################
+
+    def __init__(self, data_path, index_path=None):
+        """
+            @param data_path The directory with the union of the contents of
+            the `data/` directories of the corpus CDs (`1gms/`, `2gms/`...).
+
+            @param index_path The directory where the block index is kept
+            (in `<n>gms/` subdirectories, as the data). The index is built
+            the first time n-grams of a given order are looked up. By
+            default, it is kept along with the data.
+        """
+        self.data_path = data_path
+        self.index_path = index_path if index_path is not None else data_path
+        self.tables = {}  # n -> (first ngram of each block, block offsets)
+        self.files = {}  # n -> open `.blocks` file
+        self.cache = {}  # (n, block number) -> decompressed block
+
+################################################################################
+
+    def corpus_size(self):
+        """
+            Returns the number of tokens in the corpus.
+        """
+        total_file = open(os.path.join(self.data_path, "1gms", "total"))
+        total = int(total_file.read())
+        total_file.close()
+        return total
+
+################################################################################
+
+    def blocks_path(self, length):
+        """
+            Returns the path of the `.blocks` file of the n-grams of `length`.
+        """
+        return os.path.join(self.index_path, "%dgms" % length,
+                            "%dgm%s" % (length, WEB1T_BLOCKS_EXT))
+
+################################################################################
+
+    def data_files(self, length):
+        """
+            Returns the paths of the gzipped files of the n-grams of
+            `length`, in the order of the n-grams.
+        """
+        directory = os.path.join(self.data_path, "%dgms" % length)
+        if length == 1:
+            return [os.path.join(directory, "vocab.gz")]
+        idx_file = open(os.path.join(directory, "%dgm.idx" % length))
+        names = [line.split(b"\t")[0] for line in idx_file if line.strip()]
+        idx_file.close()
+        return [os.path.join(directory, name) for name in names]
+
+################################################################################
+
+    def read_data(self, length):
+        """
+            Returns an iterator over the decompressed contents of the data
+            files of the n-grams of `length`, in chunks, with each file
+            ending in a newline. The vocabulary file is sorted in byte order
+            first, as the n-gram files are.
+        """
+        if length == 1:
+            (path,) = self.data_files(1)
+            verbose("WEB1T: Sorting %s..." % path)
+            environment = dict(os.environ, LC_ALL="C")
+            gunzip = subprocess.Popen(["gzip", "-dc", path],
+                                      stdout=subprocess.PIPE)
+            sort = subprocess.Popen(["sort"], stdin=gunzip.stdout,
+                                    stdout=subprocess.PIPE, env=environment)
+            gunzip.stdout.close()
+            for chunk in iter(lambda: sort.stdout.read(WEB1T_BLOCK_SIZE), b""):
+                yield chunk
+            if sort.wait() != 0 or gunzip.wait() != 0:
+                error("WEB1T: Could not sort %s" % path)
+            return
+
+        for path in self.data_files(length):
+            verbose("WEB1T: Reading %s..." % path)
+            gz_file = open(path, "rb")
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            last = b"\n"
+            for chunk in iter(lambda: gz_file.read(WEB1T_BLOCK_SIZE), b""):
+                data = decompressor.decompress(chunk)
+                if data:
+                    last = data
+                    yield data
+            data = decompressor.flush()
+            gz_file.close()
+            if data:
+                last = data
+            if not last.endswith(b"\n"):
+                data += b"\n"
+            yield data
+
+################################################################################
+
+    def build_blocks(self, length):
+        """
+            Makes the block index of the n-grams of `length` out of the
+            gzipped data files. The n-grams must be sorted in byte order, as
+            in the original corpus.
+        """
+        blocks_path = self.blocks_path(length)
+        table_path = blocks_path[:-len(WEB1T_BLOCKS_EXT)] + \
+                WEB1T_BLOCK_TABLE_EXT
+        if not os.path.isdir(os.path.dirname(blocks_path)):
+            os.makedirs(os.path.dirname(blocks_path))
+        verbose("WEB1T: Building block index %s..." % blocks_path)
+        blocks_file = open(blocks_path + ".tmp", "wb")
+        table_file = open(table_path + ".tmp", "wb")
+        state = {"offset": 0, "last": None}
+
+        def write_block(block):
+            first = block[:block.index(b"\t")]
+            if state["last"] is not None and first <= state["last"]:
+                error("WEB1T: %d-grams are not sorted in byte order (%s after "
+                      "%s)" % (length, first.decode("utf-8", "replace"),
+                               state["last"].decode("utf-8", "replace")))
+            state["last"] = first
+            data = zlib.compress(block)
+            table_file.write(b"%d\t%s\n" % (state["offset"], first))
+            blocks_file.write(data)
+            state["offset"] += len(data)
+
+        buffer = b""
+        for chunk in self.read_data(length):
+            buffer += chunk
+            while len(buffer) >= WEB1T_BLOCK_SIZE:
+                end = buffer.rfind(b"\n", 0, WEB1T_BLOCK_SIZE) + 1 or \
+                      buffer.find(b"\n") + 1
+                if end == 0:
+                    break  # One very long line, not complete yet
+                write_block(buffer[:end])
+                buffer = buffer[end:]
+        if buffer:
+            write_block(buffer)
+        table_file.write(b"%d\t\n" % state["offset"])
+        blocks_file.close()
+        table_file.close()
+        # The table is renamed last: a build is complete if it is present.
+        os.rename(blocks_path + ".tmp", blocks_path)
+        os.rename(table_path + ".tmp", table_path)
+
+################################################################################
+
+    def load_table(self, length):
+        """
+            Returns the table of the first n-gram of each block and of the
+            block offsets of the n-grams of `length`, building the block index
+            if needed. Tables are loaded once and kept in memory.
+        """
+        table = self.tables.get(length)
+        if table is None:
+            blocks_path = self.blocks_path(length)
+            table_path = blocks_path[:-len(WEB1T_BLOCKS_EXT)] + \
+                    WEB1T_BLOCK_TABLE_EXT
+            if not os.path.isfile(table_path):
+                self.build_blocks(length)
+            firsts = []
+            offsets = []
+            table_file = open(table_path, "rb")
+            for line in table_file:
+                (offset, first) = line.rstrip(b"\n").split(b"\t", 1)
+                offsets.append(int(offset))
+                firsts.append(first)
+            table_file.close()
+            table = self.tables[length] = (firsts[:-1], offsets)
+            self.files[length] = open(blocks_path, "rb")
+        return table
+
+################################################################################
+
+    def read_block(self, length, number):
+        """
+            Returns the decompressed block `number` of the n-grams of
+            `length`, with a leading newline.
+        """
+        block = self.cache.get((length, number))
+        if block is None:
+            (firsts, offsets) = self.load_table(length)
+            blocks_file = self.files[length]
+            blocks_file.seek(offsets[number])
+            data = blocks_file.read(offsets[number + 1] - offsets[number])
+            if len(self.cache) >= WEB1T_BLOCK_CACHE_SIZE:
+                self.cache.clear()
+            block = self.cache[(length, number)] = \
+                    b"\n" + zlib.decompress(data)
+        return block
+
+################################################################################
+
+    def search_frequency(self, words):
+        """
+            Returns the number of occurrences of the n-gram made of the list
+            of `words` in the corpus (0 if the n-gram is not in the corpus).
+        """
+        length = len(words)
+        if length > WEB1T_MAX_LENGTH:
+            warn("Cannot count the frequency of an n-gram, n>5!")
+            return 0
+        term = " ".join(words)
+        if isinstance(term, unicode):
+            term = term.encode("utf-8")
+        (firsts, offsets) = self.load_table(length)
+        number = bisect.bisect_right(firsts, term) - 1
+        if number < 0:
+            return 0
+        block = self.read_block(length, number)
+        start = block.find(b"\n" + term + b"\t")
+        if start < 0:
+            return 0
+        start += len(term) + 2
+        return int(block[start:block.index(b"\n", start)])
+
+################################################################################
+
+    def count_ngrams(self, ngrams, max_jobs=1):
+        """
+            Returns the list of the numbers of occurrences of the n-grams in
+            the list `ngrams` (each one a list of words). Instead of looking
+            up each n-gram in the block index, the distinct n-grams of each
+            length are sorted and assigned to the data file whose range of
+            n-grams contains them (according to `<n>gm.idx`). Then each data
+            file that has n-grams to count is read once, by up to `max_jobs`
+            worker processes at the same time.
+        """
+        terms = []
+        for words in ngrams:
+            term = " ".join(words)
+            if isinstance(term, unicode):
+                term = term.encode("utf-8")
+            terms.append(term)
+        tasks = []
+        for length in range(1, WEB1T_MAX_LENGTH + 1):
+            distinct = sorted(set(term for (term, words) in zip(terms, ngrams)
+                                  if len(words) == length))
+            if not distinct:
+                continue
+            paths = self.data_files(length)
+            if length == 1:
+                tasks.append((paths[0], distinct, False))
+                continue
+            idx_file = open(os.path.join(self.data_path, "%dgms" % length,
+                                         "%dgm.idx" % length), "rb")
+            firsts = [line.rstrip(b"\n").split(b"\t", 1)[1]
+                      for line in idx_file if line.strip()]
+            idx_file.close()
+            shards = [[] for path in paths]
+            for term in distinct:
+                shard = bisect.bisect_right(firsts, term) - 1
+                if shard >= 0:
+                    shards[shard].append(term)
+            tasks.extend((path, shard_terms, True)
+                         for (path, shard_terms) in zip(paths, shards)
+                         if shard_terms)
+        if len(ngrams) > len([words for words in ngrams
+                              if len(words) <= WEB1T_MAX_LENGTH]):
+            warn("Cannot count the frequency of an n-gram, n>5!")
+
+        verbose("WEB1T: Scanning %d file(s) for %d n-gram(s)..."
+                % (len(tasks), sum(len(task[1]) for task in tasks)))
+        if max_jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(max_jobs, len(tasks)))
+            try:
+                results = pool.map(scan_web1t_file, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            results = map(scan_web1t_file, tasks)
+        found = {}
+        for ((path, task_terms, is_sorted), counts) in zip(tasks, results):
+            found.update(zip(task_terms, counts))
+        return [found.get(term, 0) if len(words) <= WEB1T_MAX_LENGTH else 0
+                for (term, words) in zip(terms, ngrams)]
+
+################################################################################
+
+    def close(self):
+        """
+            Closes the files of the block index.
+        """
+        for blocks_file in self.files.values():
+            blocks_file.close()
+        self.files = {}
+        self.tables = {}
+        self.cache = {}
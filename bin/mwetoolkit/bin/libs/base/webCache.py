@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding:UTF-8 -*-
+
+################################################################################
+#
+# Copyright 2010-2014 Carlos Ramisch, Vitor De Araujo, Silvio Ricardo Cordeiro,
+# Sandra Castellanos
+#
+# webCache.py is part of mwetoolkit
+#
+# mwetoolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mwetoolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mwetoolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+"""
+    This module provides the `WebCache` class, the SQLite database in which
+    `WebFreq` keeps the frequencies of the terms already searched in the Web.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import fcntl
+import sqlite3
+import cPickle
+from datetime import date
+
+from libs.util import verbose
+
+################################################################################
+
+SQLITE_HEADER = b"SQLite format 3\0"
+WEB_CACHE_TIMEOUT = 600  # Seconds to wait for another process to commit
+
+################################################################################
+
+def iter_cache_file(path):
+    """
+        Yields the entries `(key, (freq, date))` of the cache file `path`,
+        sorted by key, without converting the file if it was written by an
+        older version. Entries are read from the database as they are
+        yielded, whereas an old pickled cache is loaded as a whole.
+    """
+    if WebCache.is_database(path):
+        cache = WebCache(path)
+        try:
+            for item in cache.iteritems():
+                yield item
+        finally:
+            cache.close()
+    else:
+        cache_file = open(path, "rb")
+        cache = cPickle.load(cache_file)
+        cache_file.close()
+        for item in sorted((key.decode("utf-8") if isinstance(key, bytes)
+                            else key, value)
+                           for (key, value) in cache.iteritems()):
+            yield item
+
+################################################################################
+
+class WebCache(object):
+    """
+        A cache of Web frequencies, kept in an SQLite database. Each entry maps
+        a key (`lang___term`) to the frequency of the term and to the date on
+        which it was searched. Entries are written to disk as soon as they are
+        stored, so that they are not lost if the process is interrupted, and
+        several processes can use the same cache at the same time. Only the
+        entries which are looked up are read.
+
+        Cache files written by older versions (a pickled dict) are converted
+        when they are opened.
+    """
+
+################################################################################
+
+    def __init__(self, path):
+        """
+            Opens the cache file `path`, creating it if it does not exist.
+        """
+        self.path = path
+        if os.path.exists(path) and not self.is_database(path):
+            self.convert_pickle(path)
+        self.connection = self.connect(path)
+
+################################################################################
+
+    @staticmethod
+    def is_database(path):
+        """
+            Returns whether the file `path` is an SQLite database, or empty.
+        """
+        cache_file = open(path, "rb")
+        header = cache_file.read(len(SQLITE_HEADER))
+        cache_file.close()
+        return header in (b"", SQLITE_HEADER)
+
+################################################################################
+
+    @staticmethod
+    def connect(path):
+        """
+            Returns a connection to the cache database `path`, creating its
+            table if needed.
+        """
+        # Several sources of counter.py may be searched from other threads
+        # than the main one, but each cache is used by one thread at a time
+        connection = sqlite3.connect(path, timeout=WEB_CACHE_TIMEOUT,
+                                     check_same_thread=False)
+        # Readers do not block the writer, and commits do not wait for the
+        # disk: an interrupted process may only lose its last entries
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT "
+                           "PRIMARY KEY, freq INTEGER, day INTEGER)")
+        connection.execute("CREATE INDEX IF NOT EXISTS cache_day "
+                           "ON cache (day)")
+        connection.commit()
+        return connection
+
+################################################################################
+
+    @classmethod
+    def convert_pickle(cls, path):
+        """
+            Replaces the pickled dict in the old cache file `path` by a cache
+            database with the same entries.
+        """
+        pickle_file = open(path, "rb")
+        try:
+            # Another process may be converting the same file
+            fcntl.flock(pickle_file, fcntl.LOCK_EX)
+            if os.fstat(pickle_file.fileno()).st_ino != os.stat(path).st_ino:
+                return  # Already replaced by a database
+            verbose("Converting Web cache file " + path + " to SQLite")
+            cache = cPickle.load(pickle_file)
+            temp_path = "%s.%d.tmp" % (path, os.getpid())
+            connection = cls.connect(temp_path)
+            connection.executemany("INSERT OR REPLACE INTO cache VALUES "
+                                   "(?, ?, ?)", cls.rows(cache.iteritems()))
+            connection.commit()
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.close()
+            os.rename(temp_path, path)
+        finally:
+            pickle_file.close()
+
+################################################################################
+
+    @staticmethod
+    def rows(items):
+        """
+            Yields the database rows of the cache entries `(key, (freq,
+            date))` in `items`.
+        """
+        for (key, (freq, day)) in items:
+            if isinstance(key, bytes):
+                key = key.decode("utf-8")
+            yield (key, freq, day.toordinal())
+
+################################################################################
+
+    def get(self, key, max_days=-1):
+        """
+            Returns the entry `(freq, date)` of `key`, or None if `key` is not
+            in the cache or if its entry is `max_days` days old or older. If
+            `max_days` is negative, entries never expire.
+        """
+        if max_days < 0:
+            row = self.connection.execute("SELECT freq, day FROM cache "
+                                          "WHERE key = ?", (key,)).fetchone()
+        else:
+            row = self.connection.execute("SELECT freq, day FROM cache "
+                    "WHERE key = ? AND day > ?", (key, date.today().toordinal()
+                                                  - max_days)).fetchone()
+        if row is None:
+            return None
+        return (row[0], date.fromordinal(row[1]))
+
+################################################################################
+
+    def put(self, key, freq, day):
+        """
+            Stores the entry `(freq, day)` of `key` and writes it to disk.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                                (key, freq, day.toordinal()))
+        self.connection.commit()
+
+################################################################################
+
+    def update(self, items):
+        """
+            Stores the entries `(key, (freq, date))` in `items`, in a single
+            transaction.
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO cache VALUES "
+                                    "(?, ?, ?)", self.rows(items))
+        self.connection.commit()
+
+################################################################################
+
+    def iteritems(self):
+        """
+            Yields all the entries `(key, (freq, date))`, sorted by key.
+        """
+        for (key, freq, day) in self.connection.execute(
+                "SELECT key, freq, day FROM cache ORDER BY key"):
+            yield (key, (freq, date.fromordinal(day)))
+
+################################################################################
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+################################################################################
+
+    def expire(self, max_days):
+        """
+            Removes the entries which are `max_days` days old or older.
+        """
+        self.connection.execute("DELETE FROM cache WHERE day <= ?",
+                                (date.today().toordinal() - max_days,))
+        self.connection.commit()
+
+################################################################################
+
+    def close(self):
+        """
+            Closes the database. All the entries are already on disk.
+        """
+        self.connection.close()
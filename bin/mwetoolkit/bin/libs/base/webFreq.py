@@ -34,13 +34,51 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import sys
-import cPickle # Cache is pickled to/from a file
 from datetime import date
 import urllib2
 import urllib
+import urlparse
+import httplib
+import threading
+import Queue
 import time
 
-from libs.base.__common import MAX_CACHE_DAYS, DEFAULT_LANG
+from libs.base.__common import MAX_CACHE_DAYS, DEFAULT_LANG, \
+        WEB_MAX_REQUESTS, WEB_REQUESTS_PER_SECOND, WEB_MAX_TRIES, \
+        WEB_BACKOFF_SECONDS
+from libs.base.webCache import WebCache
+
+################################################################################
+
+class TokenBucket( object ) :
+    """
+        Limits the rate of Web queries shared by several threads: a query
+        takes a token, tokens are added at a rate of `rate` per second, and
+        at most `capacity` tokens are kept.
+    """
+
+    def __init__( self, rate, capacity ) :
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire( self ) :
+        """
+            Takes a token, waiting until one is available.
+        """
+        while True :
+            with self.lock :
+                now = time.time()
+                self.tokens = min( self.capacity, self.tokens +
+                                   ( now - self.last ) * self.rate )
+                self.last = now
+                if self.tokens >= 1 :
+                    self.tokens -= 1
+                    return
+                wait = ( 1 - self.tokens ) / self.rate
+            time.sleep( wait )
 
 ################################################################################
 
@@ -73,7 +111,10 @@ class WebFreq( object ) :
             @param cache_filename The string corresonding to the name of the
             cache file in/from which you would like to store/retrieve recent
             queries. You should have write permission in the current directory
-            in order to create and update the cache file.
+            in order to create and update the cache file. The cache file is
+            an SQLite database (see `WebCache`), which can be used by several
+            processes at the same time. If `None`, no cache is used, and all
+            the queries are sent.
 
             @param url The URL of the web service that allows access to the
             search engine index. The URL is generally in the provider's
@@ -94,41 +135,115 @@ class WebFreq( object ) :
         self.post_data = post_data
         self.treat_result = treat_result
         self.cache_filename = cache_filename
+        # Prepended to the cache keys, to tell apart search engines that
+        # share a cache file
+        self.cache_prefix = ""
+        self.max_requests = WEB_MAX_REQUESTS
+        self.bucket = TokenBucket( WEB_REQUESTS_PER_SECOND, WEB_MAX_REQUESTS )
         #### CACHE MECHANISM ####
         self.MAX_DAYS = MAX_CACHE_DAYS
         self.today = date.today()
-        try :
-            cache_file = open( self.cache_filename, "r" )
-            self.cache = cPickle.load( cache_file )
-            cache_file.close()
-        except IOError :
-            cache_file = open( self.cache_filename, "w" )
-            cache_file.close()
-            self.cache = {}
+        self.cache = None
+        if self.cache_filename is not None :
+            self.cache = WebCache( self.cache_filename )
+            if self.MAX_DAYS >= 0 :
+                self.cache.expire( self.MAX_DAYS )
 
 ################################################################################
 
-    def send_query( self, lang, search_term ):
+    def send_query( self, lang, search_term, connection=None ):
         """
             Sends the query to the search engine by replacing the placeholders
-            in the template url and creating a new request through urllib2.
+            in the template url and creating a new request through urllib2,
+            or through `connection` if given, which is kept open for the next
+            queries (see `open_connection`).
             
             @param lang The language code of the search
             
             @param search_term The search term corresponding to the query. The
             search term must be quoted if you want an exact search. The search
             term should not be escaped, this is done inside this function.
+
+            @param connection An `httplib` connection to the host of the url.
             
             @return The integer corresponding to the frequency of the query term
             in the web according to that search engine
         """
         url = self.url.replace( "LANGPLACEHOLDER",lang )
         url = url.replace( "QUERYPLACEHOLDER", urllib.quote_plus( search_term ))
-        request = urllib2.Request( url, None, self.post_data )
-        response = urllib2.urlopen( request )
+        if connection is None :
+            request = urllib2.Request( url, None, self.post_data )
+            response = urllib2.urlopen( request )
+            response_string = response.read()
+            return self.treat_result( response_string )
+
+        parts = urlparse.urlsplit( url )
+        connection.request( "GET", urlparse.urlunsplit( ( "", "" ) +
+                            parts[ 2: ] ), headers=self.post_data )
+        response = connection.getresponse()
         response_string = response.read()
+        if response.status != 200 :
+            raise urllib2.HTTPError( url, response.status, response.reason,
+                                     response.msg, None )
         return self.treat_result( response_string )
 
+################################################################################
+
+    def open_connection( self ) :
+        """
+            Returns a new `httplib` connection to the host of the url of the
+            search engine, to send several queries through `send_query`.
+        """
+        parts = urlparse.urlsplit( self.url )
+        if parts.scheme == "https" :
+            return httplib.HTTPSConnection( parts.netloc, timeout=60 )
+        return httplib.HTTPConnection( parts.netloc, timeout=60 )
+
+################################################################################
+
+    def query_worker( self, queries, lang, results ) :
+        """
+            Sends the search terms taken from the `queries` queue until it is
+            empty, through a connection of its own, and puts the pairs
+            `(search_term, frequency)` in the `results` queue. A query that
+            fails is sent again after waiting `WEB_BACKOFF_SECONDS`, twice as
+            long after each failure, up to `WEB_MAX_TRIES` times in all; then
+            the pair `(search_term, error)` is put in `results` and the worker
+            stops. Runs in a thread of `search_frequencies`.
+        """
+        connection = self.open_connection()
+        try :
+            while True :
+                try :
+                    search_term = queries.get_nowait()
+                except Queue.Empty :
+                    return
+                tries = 0
+                result_count = None
+                while result_count is None :
+                    tries = tries + 1
+                    self.bucket.acquire()
+                    try :
+                        result_count = self.send_query( lang, search_term,
+                                                        connection )
+                        if result_count is None :
+                            raise Exception( "Result was None" )
+                        results.put( ( search_term, result_count ) )
+                    except Exception as err :
+                        # Errors cannot leave the thread, they are reported
+                        # by `search_frequencies`. The connection may be
+                        # unusable after an error
+                        connection.close()
+                        if tries >= WEB_MAX_TRIES :
+                            results.put( ( search_term, err ) )
+                            return
+                        delay = WEB_BACKOFF_SECONDS * 2 ** ( tries - 1 )
+                        print( "Got an error ->" + str( err ), file=sys.stderr)
+                        print( "Will retry in %ds..." % delay, file=sys.stderr)
+                        time.sleep( delay )
+        finally :
+            connection.close()
+
 ################################################################################
 
     def search_frequency( self, in_term, lang=None ) :
@@ -160,71 +275,112 @@ class WebFreq( object ) :
             approximation can estimate the number of times the term occurs if
             you consider the Web as a corpus.
         """
-        term = in_term.lower().strip()
+        return self.search_frequencies( [ in_term ], lang )[ 0 ]
+
+################################################################################
+
+    def search_frequencies( self, in_terms, lang=None ) :
+        """
+            Same as `search_frequency` for a list of terms, returning the list
+            of their frequencies. The terms that are not in the cache are
+            queried at the same time, with up to `self.max_requests` queries
+            in flight, each through a connection reused for the next queries,
+            and at most `WEB_REQUESTS_PER_SECOND` queries per second on
+            average. Failed queries are retried with an exponential backoff.
+
+            @param in_terms The list of strings corresponding to the searched
+            words or ngrams (see `search_frequency`).
+
+            @param lang Two-letter code of the language of the web pages.
+
+            @return A list with the frequency of each term of `in_terms`.
+        """
+        terms = [ in_term.lower().strip() for in_term in in_terms ]
         if not lang :
             lang = DEFAULT_LANG
         # Look into the cache
-        try :
-            ( freq, time_searched ) = self.cache[ lang + "___" + term ]
-            dayspassed = self.today - time_searched
-            if dayspassed.days >= self.MAX_DAYS and self.MAX_DAYS >= 0 :
-                raise KeyError # TTL expired, must search again :-(
-            else :
-                return freq # TTL not expired :-)
-        except KeyError :
-            search_term = term
-            if isinstance( search_term, unicode ) :
-                search_term = search_term.encode( 'utf-8' )
-            search_term = "\"" + search_term + "\""
-            tries = 0
-            max_tries = 5
-            result_count = None
-            while result_count is None :
-                try:
-                    tries = tries + 1
-                    result_count = self.send_query( lang, search_term )
-                    if result_count is None :
-                        raise Exception("Result was None")
-                except urllib2.HTTPError as err:
-                    print( "Got an error ->" + str( err ), file=sys.stderr)
-                    if tries < max_tries :
-                        print("Will retry in 30s...", file=sys.stderr)
-                        time.sleep( 30 )
-                        #result_count = None
-                    else :
-                        print("Stopped at search term: " + search_term,
-                              file=sys.stderr)
-                        #print >> sys.stderr, request.get_full_url()
-                        if err.code == 403 : #Forbidden
-                            print("Probably your ID for the Google university "
-                                  "research program is not correct or is "
-                                  "associated to another IP address",
-                                  file=sys.stderr)
-                            print("Check \"http://research.google.com/"
-                                  "university/search/\" for further "
-                                  "information",file=sys.stderr)
-                        print("PLEASE VERIFY YOUR INTERNET CONNECTION",
+        freqs = {}
+        search_terms = {}
+        for term in terms :
+            if term in freqs or term in search_terms :
+                continue
+            entry = None
+            if self.cache is not None :
+                entry = self.cache.get( self.cache_prefix + lang + "___" +
+                                        term, self.MAX_DAYS )
+            if entry is not None :
+                freqs[ term ] = entry[ 0 ]
+            else : # Not found or TTL expired, must search again :-(
+                search_term = term
+                if isinstance( search_term, unicode ) :
+                    search_term = search_term.encode( 'utf-8' )
+                search_terms[ b"\"" + search_term + b"\"" ] = term
+
+        if search_terms :
+            queries = Queue.Queue()
+            for search_term in sorted( search_terms ) :
+                queries.put( search_term )
+            results = Queue.Queue()
+            workers = [ threading.Thread( target=self.query_worker,
+                                          args=( queries, lang, results ) )
+                        for i in range( min( self.max_requests,
+                                             len( search_terms ) ) ) ]
+            for worker in workers :
+                worker.daemon = True
+                worker.start()
+            # Each frequency is stored in the cache as soon as it is found
+            nb_terms = len( freqs ) + len( search_terms )
+            failed = None
+            while len( freqs ) < nb_terms :
+                try :
+                    ( search_term, result_count ) = results.get( timeout=1 )
+                except Queue.Empty : # Let Ctrl+C through
+                    if any( worker.is_alive() for worker in workers ) or \
+                            not results.empty() :
+                        continue
+                    break
+                if isinstance( result_count, Exception ) :
+                    failed = ( search_term, result_count )
+                    break
+                term = search_terms[ search_term ]
+                freqs[ term ] = result_count
+                if self.cache is not None :
+                    self.cache.put( self.cache_prefix + lang + "___" + term,
+                                    result_count, self.today )
+
+            if len( freqs ) < nb_terms :
+                if failed is not None :
+                    ( search_term, err ) = failed
+                    print( b"Stopped at search term: " + search_term,
+                           file=sys.stderr )
+                    if getattr( err, "code", None ) == 403 : #Forbidden
+                        print("Probably your ID for the Google university "
+                              "research program is not correct or is "
+                              "associated to another IP address",
                               file=sys.stderr)
-                        sys.exit( -1 )
-            
-            self.cache[ lang + "___" + term ] = ( result_count, self.today )
-            return result_count
+                        print("Check \"http://research.google.com/"
+                              "university/search/\" for further "
+                              "information",file=sys.stderr)
+                print("PLEASE VERIFY YOUR INTERNET CONNECTION",
+                      file=sys.stderr)
+                sys.exit( -1 )
+
+        return [ freqs[ term ] for term in terms ]
 
 ################################################################################
 
     def flush_cache( self ) :
         """
-            Explicit destructor, flushes the cache content to a file before
-            closing the connection. Thus, the cache entries will be available
-            the next time the search engine is called and, if they are not
-            expired, will avoid repeated queries.
+            Explicit destructor, closes the cache file. The cache entries are
+            written to the file as soon as they are found, so they will be
+            available the next time the search engine is called and, if they
+            are not expired, will avoid repeated queries, even if the process
+            is interrupted.
 
-            IMPORTANT: If you want the cache mechanism to be used properly,
-            NEVER FORGET to call this function in a "finally" block, in order
-            to guarantee that, even if an exceptioon occurs (like pressing
-            Ctrl+C), the cache will be flushed.
+            Call this function in a "finally" block, in order to guarantee
+            that, even if an exception occurs (like pressing Ctrl+C), the
+            cache file is properly closed.
         """
-        # Flush cache content to file
-        cache_file = open( self.cache_filename, "w" )
-        cPickle.dump( self.cache, cache_file )
-        cache_file.close()
+        # Cache entries are written as soon as they are found
+        if self.cache is not None :
+            self.cache.close()
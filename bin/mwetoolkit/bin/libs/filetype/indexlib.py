@@ -55,16 +55,130 @@ import xml.sax
 import tempfile
 import subprocess
 import struct
+import time
+import multiprocessing
+import heapq
+import shutil
+import glob
+import fcntl
+import operator
+import itertools
+import ctypes
+import zlib
+import mmap
+import hashlib
+import collections
 
 from ..base.sentence import Sentence
 from ..util import verbose, strip_xml, warn, error
 from ..base.word import Word, WORD_ATTRIBUTES
-from ..base.__common import ATTRIBUTE_SEPARATOR, WILDCARD, C_INDEXER_PROGRAM
+from ..base.__common import ATTRIBUTE_SEPARATOR, WILDCARD, C_INDEXER_PROGRAM, \
+        TEMP_PREFIX, NGRAM_COUNT_LIBRARY
 from .. import filetype
 
 
 NGRAM_LIMIT = 16
 
+# Rough number of bytes needed per corpus word while sorting, used to keep
+# parallel builds within a memory budget. The C indexer holds a 4-byte corpus
+# symbol and an 8-byte suffix position per word. The Python indexer holds a
+# sort key per word (a string of up to NGRAM_LIMIT + 1 words, see
+# `SuffixArray.build_suffix_array`), rounded up by the allocator to a multiple
+# of 8 bytes, plus about 80 bytes of int object, list slots, sort wrapper and
+# result array. The external indexer holds a `(key, position)` tuple per word,
+# the key being an array of up to NGRAM_LIMIT words, and then writes the key
+# to the run array (see `write_suffix_run`). These estimates agree with the
+# peak memory measured while sorting (about 185 and 300 bytes per word).
+C_INDEXER_BYTES_PER_WORD = 12
+PYTHON_INDEXER_BYTES_PER_WORD = \
+        (sys.getsizeof(b"") + (NGRAM_LIMIT + 1) * 4 + 7) // 8 * 8 + 80
+EXTERNAL_INDEXER_BYTES_PER_WORD = sys.getsizeof((0, 0)) + \
+        sys.getsizeof(array.array("i", [0] * NGRAM_LIMIT)) + 32 + \
+        (NGRAM_LIMIT + 2) * 4
+
+# Appending to an index creates a new segment; once there are this many
+# segments, they are merged back into the main index.
+MAX_INDEX_SEGMENTS = 4
+
+# A sharded index is described by a manifest file with this extension, which
+# lists the `.info` files of its shards, one per line, relative to the
+# directory of the manifest. Lines starting with "#" are comments.
+SHARD_MANIFEST_EXT = ".shards"
+
+# Extensions of the lock files of an index: the lock of its metadata, and the
+# lock held while its segments are merged (see `Index.lock`).
+LOCK_EXT = ".lock"
+MERGE_LOCK_EXT = ".merge.lock"
+
+# While an index is built, the attributes whose files are complete are
+# recorded in a file with this extension, so that an interrupted build can
+# be resumed without rebuilding them (see `BuildCheckpoint`).
+CHECKPOINT_EXT = ".checkpoint"
+
+# The counts of all the ngrams of an attribute up to some length can be
+# exported to a count table (index.py --count-table), in a file with this
+# extension, so that they are looked up instead of searched in the suffix
+# array. The file starts with a header: magic string, format version,
+# maximum ngram length, minimum count of the ngrams in the table, count
+# width in bytes, corpus size of the index, number of slots (a power of 2)
+# and number of ngrams. Then come the tag of each slot (8 bytes each) and
+# the count of each slot (`count width` bytes each), all little-endian. An
+# ngram is hashed with MD5: the first 8 bytes give its first slot, and the
+# next 8 bytes (with the lowest bit set, as 0 marks an empty slot) its tag.
+# Collisions are resolved by linear probing.
+COUNT_TABLE_EXT = ".counts"
+COUNT_TABLE_MAGIC = b"MWETKCNT"
+COUNT_TABLE_VERSION = 1
+COUNT_TABLE_HEADER_FORMAT = "<8sIIIIQQQ"
+COUNT_TABLE_HEADER_SIZE = struct.calcsize(COUNT_TABLE_HEADER_FORMAT)
+COUNT_TABLE_LOAD_FACTOR = 0.75  # Maximum ratio of used slots
+COUNT_WIDTH_FORMATS = {1: "<B", 2: "<H", 4: "<I", 8: "<Q"}
+
+# The `.corpus` and `.suffix` array files start with a header: magic string,
+# format version, element width in bytes, byte order mark (written in the
+# byte order of the file), CRC32 of the data, and number of elements. The
+# same layout is written by the C indexer. Files without the magic string
+# are read as legacy headerless dumps of native `int`s.
+ARRAY_FILE_MAGIC = b"MWETKARR"
+ARRAY_FILE_VERSION = 1
+ARRAY_HEADER_FORMAT = "8sIIIIQ"
+ARRAY_HEADER_SIZE = struct.calcsize("=" + ARRAY_HEADER_FORMAT)
+BYTE_ORDER_MARK = 0x01020304
+
+# Corpus arrays may be stored compressed (index.py --compress). Symbol
+# numbers are replaced by their rank by decreasing frequency, so that most
+# of them are small, and the ranks are stored in variable-byte encoding: 7
+# bits per byte, least significant first, the high bit telling that more
+# bytes follow. The header of a compressed file gives ARRAY_WIDTH_VARBYTE as
+# element width. After the header come the block size and the number of
+# symbols (4 bytes each); the symbol of each rank (4 bytes each, padded to a
+# multiple of 8 bytes); the offset in the encoded data of each block of
+# `block size` ranks, plus the end of the data (8 bytes each); and the
+# encoded data. Thanks to the offsets, any position can be read by decoding
+# a single block. The CRC32 covers everything after the header.
+ARRAY_WIDTH_VARBYTE = 0
+COMPRESSED_BLOCK_SIZE = 64
+COMPRESSED_BLOCK_CACHE_SIZE = 16384  # Decoded blocks kept by CompressedArray
+
+# Minimum number of seconds between two progress reports of a build phase.
+PROGRESS_INTERVAL = 5
+
+# Version of the index as a whole, recorded in its `.info` file.
+INDEX_FORMAT_VERSION = 1
+
+# Array typecodes by element width in bytes. Arrays hold 4-byte numbers,
+# except the suffix arrays of corpora too big for 4-byte positions, which
+# hold 8-byte ones (see position_width).
+ARRAY_TYPECODES = dict((array.array(typecode).itemsize, typecode)
+                       for typecode in "li")
+
+# The C n-gram counting library, once loaded (see load_ngram_count_library).
+ngram_count_library = None
+
+# Counters of the shards opened by this process (see count_in_shard), by
+# (base path, attribute).
+shard_counters = {}
+
 ################################################################################
 
 def copy_list(ls):
@@ -73,42 +187,449 @@ def copy_list(ls):
 
 ################################################################################
 
-def make_array(initializer=None):
+def format_duration(seconds):
+    """
+        Returns a number of seconds as a string `H:MM:SS`.
+    """
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+################################################################################
+
+class ProgressReporter(object):
+    """
+        Reports the progress of a phase of an index build in verbose mode, as
+        `~~> [phase] tokens=1200000 done=45.0% elapsed=0:01:10 eta=0:01:26`,
+        at most once every `PROGRESS_INTERVAL` seconds. The C indexer reports
+        its sorting progress in the same format.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.start = self.last = time.time()
+
+    def update(self, fraction=None, force=False, **counts):
+        """
+            Reports the given counts (e.g. `tokens=1200`) and, if known, the
+            `fraction` of the phase that is done, from which the remaining
+            time is estimated. Unless `force` is set, does nothing if the last
+            report is too recent.
+        """
+        now = time.time()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        elapsed = now - self.start
+        fields = ["%s=%d" % item for item in sorted(counts.items())]
+        if fraction is not None:
+            fields.append("done=%.1f%%" % (100 * fraction))
+        fields.append("elapsed=" + format_duration(elapsed))
+        if fraction:
+            fields.append("eta=" + format_duration(elapsed * (1 - fraction)
+                                                   / fraction))
+        verbose("~~> [%s] %s" % (self.phase, " ".join(fields)))
+
+
+################################################################################
+
+def make_array(initializer=None, width=4):
+    """
+        Returns a new array of numbers of `width` bytes (4 or 8).
+    """
+    if width not in ARRAY_TYPECODES:
+        error("Arrays of %d-byte numbers are not supported on this platform"
+              % width)
     if initializer is None:
-        return array.array('i')
+        return array.array(ARRAY_TYPECODES[width])
     else:
-        return array.array('i', initializer)
+        return array.array(ARRAY_TYPECODES[width], initializer)
 
 
 ################################################################################
 
-# Taken from counter.py
-def load_array_from_file(an_array, a_filename):
+def position_width(nb_positions):
+    """
+        Returns the width in bytes of the numbers needed to store the
+        positions of a corpus of `nb_positions` words: 4 bytes, unless the
+        positions go beyond 2^31 - 1.
+    """
+    if nb_positions <= 2 ** 31:
+        return 4
+    else:
+        return 8
+
+
+################################################################################
+
+def array_checksum(an_array, crc=0):
+    """
+        Returns the CRC32 of the contents of an array, continuing from the
+        CRC32 `crc` of the data before it.
+    """
+    return zlib.crc32(buffer(an_array), crc) & 0xffffffff
+
+
+################################################################################
+
+def write_array_header(file, width, crc, length):
+    """
+        Writes an array file header at the current position of `file`.
+    """
+    file.write(struct.pack("=" + ARRAY_HEADER_FORMAT, ARRAY_FILE_MAGIC,
+                           ARRAY_FILE_VERSION, width, BYTE_ORDER_MARK, crc,
+                           length))
+
+
+################################################################################
+
+def read_array_header(file):
     """
-        Fills an existing array with the contents of a file.
+        Reads the header of an array file opened in binary mode. Returns
+        `None` for a legacy file without header, leaving `file` at its start.
+        Otherwise, returns a tuple `(width, swapped, crc, length)`, where
+        `swapped` tells whether the data is in the opposite byte order.
     """
-    MAX_MEM = 10000
-    fd = open(a_filename)
-    isMore = True
-    while isMore:
+    data = file.read(ARRAY_HEADER_SIZE)
+    if not data.startswith(ARRAY_FILE_MAGIC):
+        file.seek(0)
+        return None
+    if len(data) < ARRAY_HEADER_SIZE:
+        raise ValueError("truncated header")
+
+    swapped = False
+    fields = struct.unpack("=" + ARRAY_HEADER_FORMAT, data)
+    if fields[3] != BYTE_ORDER_MARK:
+        swapped = True
+        other_order = ">" if sys.byteorder == "little" else "<"
+        fields = struct.unpack(other_order + ARRAY_HEADER_FORMAT, data)
+        if fields[3] != BYTE_ORDER_MARK:
+            raise ValueError("bad byte order mark")
+    (magic, version, width, mark, crc, length) = fields
+    if version > ARRAY_FILE_VERSION:
+        raise ValueError("unsupported format version %d" % version)
+    return (width, swapped, crc, length)
+
+
+################################################################################
+
+def read_array_file(a_filename):
+    """
+        Returns a new array with the contents of an array file, which may
+        be a legacy file without header (of 4-byte numbers), or compressed
+        (it is then decoded as a whole). The array has the element width of
+        the file, and is converted to the native byte order. A truncated
+        file is an error.
+    """
+    fd = open(a_filename, "rb")
+    try:
+        header = read_array_header(fd)
+    except ValueError as message:
+        error("Cannot read %s: %s" % (a_filename, message))
+
+    if header is None:
+        an_array = make_array()
+        MAX_MEM = 10000
+        isMore = True
+        while isMore:
+            try:
+                an_array.fromfile(fd, MAX_MEM)
+            except EOFError:
+                isMore = False  # Did not read MAX_MEM_ITEMS items? Not a problem...
+    elif header[0] == ARRAY_WIDTH_VARBYTE:
+        an_array = make_array(CompressedArray(a_filename))
+    else:
+        (width, swapped, crc, length) = header
+        if width not in ARRAY_TYPECODES:
+            error("Cannot read %s: %d-byte elements are not supported"
+                  % (a_filename, width))
+        an_array = make_array(width=width)
         try:
-            an_array.fromfile(fd, MAX_MEM)
+            an_array.fromfile(fd, length)
         except EOFError:
-            isMore = False  # Did not read MAX_MEM_ITEMS items? Not a problem...
+            error("Index file %s is truncated" % a_filename)
+        if swapped:
+            an_array.byteswap()
     fd.close()
+    return an_array
+
+
+################################################################################
+
+def load_array_from_file(an_array, a_filename):
+    """
+        Fills an existing array with the contents of an array file (see
+        read_array_file), converting its numbers to the width of `an_array`.
+    """
+    contents = read_array_file(a_filename)
+    if contents.itemsize == an_array.itemsize:
+        an_array.extend(contents)
+    else:
+        try:
+            an_array.fromlist(contents.tolist())
+        except OverflowError:
+            error("Cannot read %s: its numbers do not fit in %d bytes"
+                  % (a_filename, an_array.itemsize))
 
 
 ################################################################################
 
 def save_array_to_file(array, path):
     """
-        Dumps an array to a file.
+        Dumps an array to a file, after an array file header.
     """
-    file = open(path, "w")
+    file = open(path, "wb")
+    write_array_header(file, array.itemsize, array_checksum(array), len(array))
     array.tofile(file)
     file.close()
 
 
+################################################################################
+
+class ArrayFileWriter(object):
+    """
+        Writes an array file whose contents are appended in pieces, for
+        arrays that are not kept in memory as a whole. The header is written
+        by close(), once the checksum and the length are known.
+    """
+
+    def __init__(self, file, width=4):
+        """
+            @param file A file opened for writing in binary mode, positioned
+            at its start.
+
+            @param width The width in bytes of the numbers in the arrays that
+            will be written.
+        """
+        self.file = file
+        self.width = width
+        self.crc = 0
+        self.length = 0
+        self.file.write(b"\0" * ARRAY_HEADER_SIZE)
+
+    def write(self, an_array):
+        """
+            Appends the contents of an array to the file.
+        """
+        if an_array.itemsize != self.width:
+            error("Cannot write %d-byte numbers to an array file of %d-byte "
+                  "numbers" % (an_array.itemsize, self.width))
+        an_array.tofile(self.file)
+        self.crc = array_checksum(an_array, self.crc)
+        self.length += len(an_array)
+
+    def close(self):
+        """
+            Writes the header and closes the file.
+        """
+        self.file.seek(0)
+        write_array_header(self.file, self.width, self.crc, self.length)
+        self.file.close()
+
+
+################################################################################
+
+def verify_array_file(path):
+    """
+        Checks the header, the size and the checksum of an array file.
+        Returns `None` if the file is fine, or a message describing the
+        problem. Legacy files without header can only be checked for size.
+    """
+    file = open(path, "rb")
+    try:
+        try:
+            header = read_array_header(file)
+        except ValueError as message:
+            return str(message)
+        size = os.fstat(file.fileno()).st_size
+        if header is None:
+            if size % make_array().itemsize != 0:
+                return "legacy file with a partial last element"
+            return None
+
+        (width, swapped, crc, length) = header
+        # The size of compressed data is only checked through its CRC32
+        if width != ARRAY_WIDTH_VARBYTE and \
+                size != ARRAY_HEADER_SIZE + width * length:
+            return "%d bytes of data instead of %d" \
+                   % (size - ARRAY_HEADER_SIZE, width * length)
+        actual_crc = 0
+        while True:
+            data = file.read(1024 * 1024)
+            if not data:
+                break
+            actual_crc = zlib.crc32(data, actual_crc)
+        if actual_crc & 0xffffffff != crc:
+            return "checksum mismatch"
+        return None
+    finally:
+        file.close()
+
+
+################################################################################
+
+def array_file_length(path):
+    """
+        Returns the number of elements of an array file, whatever their
+        width.
+    """
+    file = open(path, "rb")
+    try:
+        header = read_array_header(file)
+        if header is None:
+            return os.fstat(file.fileno()).st_size // make_array().itemsize
+        return header[3]
+    finally:
+        file.close()
+
+
+################################################################################
+
+def open_array_file(path):
+    """
+        Returns the contents of an array file like read_array_file, except
+        that a compressed file is not decoded but returned as a
+        `CompressedArray`.
+    """
+    file = open(path, "rb")
+    try:
+        header = read_array_header(file)
+    except ValueError:
+        header = None  # Reported by read_array_file
+    finally:
+        file.close()
+    if header is not None and header[0] == ARRAY_WIDTH_VARBYTE:
+        return CompressedArray(path)
+    return read_array_file(path)
+
+
+################################################################################
+
+def encode_varbyte(numbers):
+    """
+        Returns a bytearray with the variable-byte encoding of a list of
+        non-negative numbers.
+    """
+    if not numbers or max(numbers) < 0x80:
+        return bytearray(numbers)
+    data = bytearray()
+    for number in numbers:
+        while number >= 0x80:
+            data.append(number & 0x7f | 0x80)
+            number >>= 7
+        data.append(number)
+    return data
+
+
+################################################################################
+
+def decode_varbyte(data):
+    """
+        Returns the list of numbers encoded in the bytearray `data` by
+        encode_varbyte.
+    """
+    if not data or max(data) < 0x80:
+        return list(data)
+    numbers = []
+    number = shift = 0
+    for byte in data:
+        if byte & 0x80:
+            number |= (byte & 0x7f) << shift
+            shift += 7
+        else:
+            numbers.append(number | byte << shift)
+            number = shift = 0
+    return numbers
+
+
+################################################################################
+
+def save_compressed_array(an_array, path, block_size=COMPRESSED_BLOCK_SIZE):
+    """
+        Dumps an array of non-negative numbers to a compressed array file,
+        in blocks of `block_size` numbers (see ARRAY_WIDTH_VARBYTE).
+    """
+    counts = collections.Counter(an_array)
+    by_rank = make_array(sorted(counts,
+                                key=lambda number: (-counts[number], number)))
+    rank = [0] * (max(counts) + 1 if counts else 0)
+    for (i, number) in enumerate(by_rank):
+        rank[number] = i
+    if len(by_rank) % 2:
+        by_rank.append(0)  # Padding, so that the offsets are aligned
+
+    offsets = make_array(width=8)
+    data = bytearray()
+    for start in xrange(0, len(an_array), block_size):
+        offsets.append(len(data))
+        data += encode_varbyte(map(rank.__getitem__,
+                                   an_array[start:start + block_size]))
+    offsets.append(len(data))
+
+    payload = struct.pack("=II", block_size, len(counts)) + \
+            by_rank.tostring() + offsets.tostring() + str(data)
+    file = open(path, "wb")
+    write_array_header(file, ARRAY_WIDTH_VARBYTE,
+                       zlib.crc32(payload) & 0xffffffff, len(an_array))
+    file.write(payload)
+    file.close()
+
+
+################################################################################
+
+def compress_array_file(path, block_size=COMPRESSED_BLOCK_SIZE):
+    """
+        Rewrites an array file as a compressed array file.
+    """
+    save_compressed_array(read_array_file(path), path + ".tmp", block_size)
+    os.rename(path + ".tmp", path)
+
+
+################################################################################
+
+def read_metadata_file(path):
+    """
+        Returns the dict of metadata in a file written by
+        `write_metadata_file`.
+    """
+    metadata = {}
+    metafile = open(path)
+    for line in metafile:
+        key, type, value = line.rstrip('\n').split(" ", 2)
+        if type == "int":
+            value = int(value)
+        metadata[key] = value
+
+    metafile.close()
+    return metadata
+
+
+################################################################################
+
+def write_metadata_file(path, metadata):
+    """
+        Writes a dict of metadata (with int and string values) to a file,
+        one `key type value` line per entry, as in the `.info` file of an
+        index.
+    """
+    # Write to a temporary file first, so that readers never see a
+    # half-written file. The corpus size must come first, as it is used
+    # to recognize the file format.
+    metafile = open(path + ".tmp", "w")
+    keys = sorted(metadata.keys(), key=lambda k: k != "corpus_size")
+    for key in keys:
+        value = metadata[key]
+        if isinstance(value, int):
+            type = "int"
+        else:
+            type = "string"
+
+        metafile.write("%s %s %s\n" % (key, type, value))
+
+    metafile.close()
+    os.rename(path + ".tmp", path)
+
+
 ################################################################################
 
 def load_symbols_from_file(symbols, path):
@@ -143,6 +664,139 @@ def save_symbols_to_file(symbols, path):
 
 ################################################################################
 
+def load_ngram_count_library():
+    """
+        Returns the C n-gram counting library, loaded with ctypes, or `None`
+        if it has not been built (see `MappedSuffixArray`).
+    """
+    global ngram_count_library
+    if ngram_count_library is None:
+        try:
+            library = ctypes.CDLL(NGRAM_COUNT_LIBRARY)
+        except OSError:
+            verbose("C n-gram counting library not found; counting in Python.")
+            return None
+        int_pointer = ctypes.POINTER(ctypes.c_int)
+        library.ngramindex_open.argtypes = [ctypes.c_char_p]
+        library.ngramindex_open.restype = ctypes.c_void_p
+        library.ngramindex_close.argtypes = [ctypes.c_void_p]
+        library.ngramindex_close.restype = None
+        library.ngramindex_count.argtypes = [ctypes.c_void_p, int_pointer,
+                                             ctypes.c_int]
+        library.ngramindex_count.restype = ctypes.c_long
+        library.ngramindex_count_batch.argtypes = [
+                ctypes.c_void_p, int_pointer, int_pointer, ctypes.c_int,
+                ctypes.POINTER(ctypes.c_long)]
+        library.ngramindex_count_batch.restype = None
+        ngram_count_library = library
+    return ngram_count_library
+
+
+################################################################################
+
+def array_pointer(an_array, c_type=ctypes.c_int):
+    """
+        Returns a ctypes pointer to the contents of an array, which must not
+        be resized while the pointer is in use.
+    """
+    return ctypes.cast(an_array.buffer_info()[0], ctypes.POINTER(c_type))
+
+
+################################################################################
+
+def write_suffix_run(path, corpus, length):
+    """
+        Sorts the suffixes starting at the first `length` positions of
+        `corpus` and writes them to the run file `path`. Each record holds
+        the key length, the position and the key, i.e. the words of the
+        suffix up to `NGRAM_LIMIT` words or the end of the sentence. The
+        `corpus` array must extend `NGRAM_LIMIT` words past `length`, unless
+        it reaches the end of the corpus.
+    """
+    keys = []
+    next_zero = len(corpus)
+    for i in xrange(len(corpus) - 1, -1, -1):
+        if i < length:
+            end = min(i + NGRAM_LIMIT, next_zero + 1)
+            keys.append((corpus[i:end], i))
+        if corpus[i] == 0:
+            next_zero = i
+    keys.sort()
+
+    run = make_array()
+    for (key, pos) in keys:
+        run.append(len(key))
+        run.append(pos)
+        run.extend(key)
+    save_array_to_file(run, path)
+
+
+################################################################################
+
+def read_suffix_run(path, offset):
+    """
+        Returns an iterator that yields the `(key, position)` records of a
+        run file written by `write_suffix_run`, adding `offset` to the
+        positions. Only a small buffer of the file is kept in memory.
+    """
+    RUN_READ_CHUNK = 65536
+    i = 0
+    run_file = open(path, "rb")
+    try:
+        # Only the width is used: the file is read sequentially
+        buffer = make_array(width=read_array_header(run_file)[0])
+        isMore = True
+        while True:
+            if isMore and len(buffer) - i < NGRAM_LIMIT + 2:
+                buffer = buffer[i:]
+                i = 0
+                try:
+                    buffer.fromfile(run_file, RUN_READ_CHUNK)
+                except EOFError:
+                    isMore = False  # Items read before EOF are kept
+            if i >= len(buffer):
+                break
+            length = buffer[i]
+            yield (buffer[i + 2:i + 2 + length], buffer[i + 1] + offset)
+            i += length + 2
+    finally:
+        # Also run when the iterator is closed before its end
+        run_file.close()
+
+
+################################################################################
+
+def merge_suffix_runs(path, runs, width):
+    """
+        Merges the run files in `runs`, a list of `(run_path, offset)` as
+        given to `read_suffix_run`, into the run file `path`, whose positions
+        include the offsets. The numbers of the new run are of `width` bytes,
+        enough for the positions of the whole corpus.
+    """
+    RUN_WRITE_CHUNK = 65536
+    readers = [read_suffix_run(run_path, offset) for (run_path, offset) in runs]
+    try:
+        writer = ArrayFileWriter(open(path, "wb"), width)
+        run = make_array(width=width)
+        for (key, pos) in heapq.merge(*readers):
+            if key.itemsize != width:
+                key = make_array(key, width)
+            run.append(len(key))
+            run.append(pos)
+            run.extend(key)
+            if len(run) >= RUN_WRITE_CHUNK:
+                writer.write(run)
+                run = make_array(width=width)
+        writer.write(run)
+        writer.close()
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+################################################################################
+################################################################################
+
 def read_attribute_from_index(attr, path):
     """
         Returns an iterator that yields the value of the attribute `attr`
@@ -150,19 +804,26 @@ def read_attribute_from_index(attr, path):
         the corpus from the index, and is used for attribute fusion.
     """
 
-    corpus_file = open(path + "." + attr + ".corpus", "rb")
+    corpus = open_array_file(path + "." + attr + ".corpus")
     symbols = SymbolTable()
     load_symbols_from_file(symbols, path + "." + attr + ".symbols")
 
-    while True:
-        ## Assuming 32-bit int! (right in x86 and x86-64)
-        wordcode = corpus_file.read(4)
-        if wordcode == "":
-            return
-        wordnum = struct.unpack('i', wordcode)[0]
+    for wordnum in corpus:
         yield symbols.number_to_symbol[wordnum]
 
-    corpus_file.close()
+
+################################################################################
+
+def sort_suffixes(corpus_string):
+    """
+        Builds a suffix array from the machine representation of a corpus
+        array and returns the machine representation of the suffix array.
+        This runs in a worker process when building arrays in parallel.
+    """
+    sufarray = SuffixArray()
+    sufarray.corpus.fromstring(corpus_string)
+    sufarray.build_suffix_array()
+    return sufarray.suffix.tostring()  # Width given by position_width
 
 
 ################################################################################
@@ -215,16 +876,50 @@ def fuse_suffix_arrays(array1, array2):
     """
         Returns a new `SuffixArray` fusing the `corpus` data of each input array
         This is used to generate indices for combined attributes (eg lemma+pos)
+
+        The fusion is done on symbol numbers: each pair of numbers is mapped
+        to a new number, and numbers are given in the order of the pairs, so
+        that fused ngrams are ordered like the sequences of pairs. Symbol
+        strings are only built once per distinct pair. The suffix array of
+        the result is not built.
     """
-    fused_array = SuffixArray()
-    for i in xrange(len(array1.corpus)):
-        sym1 = array1.symbols.number_to_symbol[array1.corpus[i]]
-        sym2 = array2.symbols.number_to_symbol[array2.corpus[i]]
-        fused_array.append_word(sym1 + ATTRIBUTE_SEPARATOR + sym2)
+    width = len(array2.symbols.number_to_symbol)
+    codes = map(operator.add,
+                itertools.imap(operator.mul, array1.corpus,
+                               itertools.repeat(width)),
+                array2.corpus)
+    # Code 0 (end of sentence in both arrays) must stay symbol 0
+    distinct = sorted(set(codes) | set([0]))
+    numbers = dict(itertools.izip(distinct, itertools.count()))
 
+    fused_array = SuffixArray()
+    fused_array.corpus = make_array(map(numbers.__getitem__, codes))
+    codes = None
+    symbols1 = array1.symbols.number_to_symbol
+    symbols2 = array2.symbols.number_to_symbol
+    fused_array.symbols.number_to_symbol = [""] + \
+            [symbols1[code // width] + ATTRIBUTE_SEPARATOR +
+             symbols2[code % width] for code in distinct[1:]]
+    fused_array.symbols.symbol_to_number = dict(itertools.izip(
+            fused_array.symbols.number_to_symbol, itertools.count()))
+    fused_array.symbols.last_number = len(distinct) - 1
     return fused_array
 
 
+################################################################################
+
+def sortable_string(an_array):
+    """
+        Returns the contents of an array of non-negative numbers as a string
+        in which each number is stored in big-endian order, so that comparing
+        substrings compares the sequences of numbers.
+    """
+    big_endian = array.array(an_array.typecode, an_array)
+    if sys.byteorder == "little":
+        big_endian.byteswap()
+    return big_endian.tostring()
+
+
 ################################################################################
 ################################################################################
 
@@ -267,6 +962,7 @@ class SuffixArray(object):
         self.corpus = make_array()  # List of word numbers
         self.suffix = make_array()  # List of word positions
         self.symbols = SymbolTable()  # word<->number conversion table
+        self.pending_build = None  # Result of a sort running in a worker
 
 ################################################################################
 
@@ -285,8 +981,8 @@ class SuffixArray(object):
         """
             Loads the suffix array from the files at `self.basepath`.
         """
-        load_array_from_file(self.corpus, self.corpus_path)
-        load_array_from_file(self.suffix, self.suffix_path)
+        self.corpus = open_array_file(self.corpus_path)
+        self.suffix = read_array_file(self.suffix_path)
         load_symbols_from_file(self.symbols, self.symbols_path)
 
 ################################################################################
@@ -321,10 +1017,67 @@ class SuffixArray(object):
         """
             Builds the sorted suffix array from the corpus array.
         """
-        tmpseq = range(0, len(self.corpus))
-        tmpseq.sort(cmp=(lambda a, b: compare_ngrams(self.corpus, a,
-                                                     self.corpus, b)))
-        self.suffix = make_array(tmpseq)
+        # Same order as sorting with `compare_ngrams` (which looks at most
+        # at one word past `NGRAM_LIMIT`), but comparing two suffixes is a
+        # single string comparison.
+        data = sortable_string(self.corpus)
+        width = self.corpus.itemsize
+        limit = (NGRAM_LIMIT + 1) * width
+        tmpseq = sorted(xrange(len(self.corpus)),
+                        key=lambda pos: data[pos * width:pos * width + limit])
+        self.suffix = make_array(tmpseq, position_width(len(tmpseq)))
+
+################################################################################
+
+    def nb_positions(self):
+        """
+            Returns the number of positions (words and sentence ends) of the
+            corpus, i.e. the length of the suffix array once built.
+        """
+        return len(self.corpus)
+
+################################################################################
+
+    def estimated_memory(self):
+        """
+            Returns an estimate, in bytes, of the memory needed to build the
+            suffix array.
+        """
+        return len(self.corpus) * PYTHON_INDEXER_BYTES_PER_WORD
+
+################################################################################
+
+    def start_building(self, pool=None):
+        """
+            Starts building the suffix array. If `pool` is a
+            `multiprocessing.Pool`, the sort runs in one of its workers and
+            `finish_building` must be called to collect the result. Otherwise,
+            the array is built right away.
+        """
+        if pool is None:
+            self.build_suffix_array()
+        else:
+            self.pending_build = pool.apply_async(sort_suffixes,
+                                                  (self.corpus.tostring(),))
+
+################################################################################
+
+    def building_done(self):
+        """
+            Returns whether a build started by `start_building` is over.
+        """
+        return self.pending_build is None or self.pending_build.ready()
+
+################################################################################
+
+    def finish_building(self):
+        """
+            Waits for a build started by `start_building` to finish.
+        """
+        if self.pending_build is not None:
+            self.suffix = make_array(width=position_width(len(self.corpus)))
+            self.suffix.fromstring(self.pending_build.get())
+            self.pending_build = None
 
 ################################################################################
 
@@ -354,6 +1107,37 @@ class SuffixArray(object):
         else:
             return None
 
+################################################################################
+
+    def count_ngram(self, words):
+        """
+            Returns the number of occurrences of the ngram made of the symbols
+            in the list `words`.
+        """
+        ngram_ids = []
+        for word in words:
+            wordid = self.symbols.symbol_to_number.get(word, None)
+            if wordid:
+                ngram_ids.append(wordid)
+            else:
+                return 0
+
+        indexrange = self.find_ngram_range(ngram_ids)
+        if indexrange is not None:
+            first, last = indexrange
+            return last - first + 1
+        else:
+            return 0
+
+################################################################################
+
+    def count_ngrams(self, ngrams):
+        """
+            Returns the list of the numbers of occurrences of each ngram in
+            `ngrams`, a list of lists of symbols.
+        """
+        return [self.count_ngram(words) for words in ngrams]
+
 ################################################################################
 
     def binary_search_ngram(self, ngram, first, last, cmp):
@@ -366,7 +1150,7 @@ class SuffixArray(object):
         # satisfies the comparison.
         maxi = last + 1
         mini = first
-        ngram_array = make_array(ngram)
+        ngram_array = array.array(self.corpus.typecode, ngram)
         length = len(ngram)
         mid = -1
         while mini < maxi:
@@ -416,47 +1200,614 @@ class SuffixArray(object):
 ################################################################################
 ################################################################################
 
-class CSuffixArray(SuffixArray):
+def lazy_word_attribute(attr):
     """
-        This class implements an interface to the C indexer. Appended words
-        go to a temporary text file, and build_suffix_array invoked the C
-        indexer upon that file. After array construction, one must call
-        array.load() to load the array into 'python-space'.
+        Returns a property that looks up the value of the word attribute
+        `attr` of an `IndexWord` on first access.
     """
+    def get(self):
+        self.index_sentence.decode(attr)
+        return self.__dict__[attr]
+    return property(get)
+
 
 ################################################################################
 
-    def __init__(self):
-        SuffixArray.__init__(self)
-        self.basepath = None
+class IndexWord(Word):
+    """
+        A `Word` read back from an index, whose attribute values are only
+        looked up in the symbol tables if they are used.
+    """
 
-        (fd, path) = tempfile.mkstemp()
-        self.wordlist_file = os.fdopen(fd, 'w+')
-        self.wordlist_path = path
+    surface = lazy_word_attribute("surface")
+    lemma = lazy_word_attribute("lemma")
+    pos = lazy_word_attribute("pos")
+    syn = lazy_word_attribute("syn")
 
-################################################################################
+    def __init__(self, sentence):
+        """
+            @param sentence The `IndexSentenceColumns` of the word's sentence.
+        """
+        self.index_sentence = sentence
+        self.freqs = []
 
-    def append_word(self, word):
-        self.wordlist_file.write(word.encode('utf-8') + '\n')
 
 ################################################################################
 
-    def build_suffix_array(self):
-        if self.basepath is None:
-            error("Base path not specified for suffix array to be built " + \
-                  "with C indexer")
-            sys.exit(2)
+class IndexSentenceColumns(object):
+    """
+        Symbol numbers of all attributes of a sentence read back from an
+        index. The first time an attribute of one of the words is used, the
+        attribute is looked up for the whole sentence at once.
+    """
 
-        self.wordlist_file.seek(0)
-        verbose("Using C indexer to build suffix array %s" % self.basepath)
-        subprocess.call([C_INDEXER_PROGRAM, self.basepath],
-                        stdin=self.wordlist_file)
+    def __init__(self, columns, symbols, length):
+        """
+            @param columns A dict from attribute names to the arrays of symbol
+            numbers of the sentence.
 
-################################################################################
+            @param symbols A dict from attribute names to the lists of symbols
+            of the index.
 
-    def save(self):
-        self.wordlist_file.close()
-        os.remove(self.wordlist_path)
+            @param length The number of words in the sentence.
+        """
+        self.columns = columns
+        self.symbols = symbols
+        self.words = [IndexWord(self) for i in xrange(length)]
+
+    def decode(self, attr):
+        """
+            Sets the value of `attr` in every word of the sentence, or
+            `WILDCARD` if the index does not have `attr`. Words in which `attr`
+            was already assigned (e.g. edited by the caller before reading
+            `attr` in any word) keep their value.
+        """
+        column = self.columns.get(attr)
+        if column is None:
+            values = [WILDCARD] * len(self.words)
+        else:
+            values = map(self.symbols[attr].__getitem__, column)
+        # `Word` is an old-style class: these instance attributes hide the
+        # lazy properties from now on.
+        for (word, value) in itertools.izip(self.words, values):
+            if attr not in word.__dict__:
+                setattr(word, attr, value)
+
+
+################################################################################
+################################################################################
+
+class SuffixArrayGroup(object):
+    """
+        Group of suffix arrays for the same attribute of several parts of a
+        corpus (e.g. the segments of an index). Ngrams are counted in every
+        array and the counts are summed.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+################################################################################
+
+    def count_ngram(self, words):
+        """
+            Returns the number of occurrences of the ngram made of the symbols
+            in the list `words`, summed over all arrays in the group.
+        """
+        return sum(array.count_ngram(words) for array in self.arrays)
+
+################################################################################
+
+    def count_ngrams(self, ngrams):
+        """
+            Returns the list of the numbers of occurrences of each ngram in
+            `ngrams`, summed over all arrays in the group.
+        """
+        if not self.arrays:
+            return [0] * len(ngrams)
+        return map(sum, itertools.izip(*[array.count_ngrams(ngrams)
+                                         for array in self.arrays]))
+
+
+################################################################################
+################################################################################
+
+class CompressedArray(object):
+    """
+        Read-only array of the numbers in a compressed array file (see
+        ARRAY_WIDTH_VARBYTE). The file is mapped in memory, and blocks are
+        decoded when their numbers are accessed. Up to
+        `COMPRESSED_BLOCK_CACHE_SIZE` decoded blocks are kept.
+    """
+
+    def __init__(self, path):
+        file = open(path, "rb")
+        try:
+            header = read_array_header(file)
+            if header is None or header[0] != ARRAY_WIDTH_VARBYTE:
+                error("%s is not a compressed array file" % path)
+            (width, swapped, crc, self.length) = header
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        self.typecode = make_array().typecode
+        self.itemsize = make_array().itemsize
+        self.cache = {}
+
+        byte_order = "=" if not swapped else \
+                     (">" if sys.byteorder == "little" else "<")
+        start = ARRAY_HEADER_SIZE
+        (self.block_size, nb_symbols) = struct.unpack(
+                byte_order + "II", self.data[start:start + 8])
+        start += 8
+        self.by_rank = make_array()
+        self.by_rank.fromstring(self.data[start:start + nb_symbols * 4])
+        start += (nb_symbols + nb_symbols % 2) * 4
+        nb_blocks = -(-self.length // self.block_size)
+        self.offsets = make_array(width=8)
+        self.offsets.fromstring(self.data[start:start + (nb_blocks + 1) * 8])
+        self.data_start = start + (nb_blocks + 1) * 8
+        if swapped:
+            self.by_rank.byteswap()
+            self.offsets.byteswap()
+        if len(self.offsets) != nb_blocks + 1 or \
+                len(self.data) < self.data_start + self.offsets[-1]:
+            error("Index file %s is truncated" % path)
+
+################################################################################
+
+    def __len__(self):
+        return self.length
+
+################################################################################
+
+    def decode_block(self, number):
+        """
+            Returns an array with the numbers of block `number`.
+        """
+        start = self.data_start + self.offsets[number]
+        end = self.data_start + self.offsets[number + 1]
+        ranks = decode_varbyte(bytearray(self.data[start:end]))
+        return array.array(self.typecode, map(self.by_rank.__getitem__, ranks))
+
+################################################################################
+
+    def block(self, number):
+        """
+            Returns the decoded block `number`, from the cache if possible.
+        """
+        block = self.cache.get(number)
+        if block is None:
+            if len(self.cache) >= COMPRESSED_BLOCK_CACHE_SIZE:
+                self.cache.clear()
+            block = self.cache[number] = self.decode_block(number)
+        return block
+
+################################################################################
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self.length)
+            if step != 1:
+                return array.array(self.typecode, [self[i] for i in
+                                                   xrange(start, stop, step)])
+            result = array.array(self.typecode)
+            while start < stop:
+                (number, offset) = divmod(start, self.block_size)
+                end = min(offset + stop - start, self.block_size)
+                result.extend(self.block(number)[offset:end])
+                start += end - offset
+            return result
+
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("array index out of range")
+        (number, offset) = divmod(index, self.block_size)
+        return self.block(number)[offset]
+
+################################################################################
+
+    def __iter__(self):
+        # Sequential reads bypass the cache, which they would only flush
+        return itertools.chain.from_iterable(itertools.imap(
+                self.decode_block, xrange(len(self.offsets) - 1)))
+
+
+################################################################################
+################################################################################
+
+class MappedSuffixArray(object):
+    """
+        A read-only suffix array whose ngrams are counted by the C n-gram
+        counting library. The library maps the `.corpus` and `.suffix` files
+        in memory, so only the symbol table is loaded in Python.
+    """
+
+    def __init__(self, library, basepath):
+        self.library = library
+        self.symbols = SymbolTable()
+        load_symbols_from_file(self.symbols, basepath + ".symbols")
+        if isinstance(basepath, unicode):
+            basepath = basepath.encode(sys.getfilesystemencoding())
+        # `None` if the files cannot be mapped as they are
+        self.handle = library.ngramindex_open(basepath)
+
+    def __del__(self):
+        if getattr(self, "handle", None):
+            self.library.ngramindex_close(self.handle)
+            self.handle = None
+
+################################################################################
+
+    def ngram_ids(self, words):
+        """
+            Returns the list of symbol numbers of the ngram made of the
+            symbols in `words`, or `None` if one of them is not in the corpus.
+        """
+        ngram_ids = map(self.symbols.symbol_to_number.get, words)
+        if not all(ngram_ids):
+            return None
+        return ngram_ids
+
+################################################################################
+
+    def count_ngram(self, words):
+        """
+            Returns the number of occurrences of the ngram made of the symbols
+            in the list `words`.
+        """
+        ngram_ids = self.ngram_ids(words)
+        if ngram_ids is None:
+            return 0
+        ngram = make_array(ngram_ids)
+        return self.library.ngramindex_count(self.handle, array_pointer(ngram),
+                                             len(ngram))
+
+################################################################################
+
+    def count_ngrams(self, ngrams):
+        """
+            Returns the list of the numbers of occurrences of each ngram in
+            `ngrams`, counting them all in a single call to the library.
+        """
+        counts = [0] * len(ngrams)
+        found = []  # Positions of the ngrams whose symbols are all known
+        symbols = make_array()
+        lengths = make_array()
+        for (i, words) in enumerate(ngrams):
+            ngram_ids = self.ngram_ids(words)
+            if ngram_ids is not None:
+                found.append(i)
+                symbols.extend(ngram_ids)
+                lengths.append(len(ngram_ids))
+        found_counts = array.array('l', [0]) * len(found)
+        self.library.ngramindex_count_batch(
+                self.handle, array_pointer(symbols), array_pointer(lengths),
+                len(found), array_pointer(found_counts, ctypes.c_long))
+        for (i, count) in itertools.izip(found, found_counts):
+            counts[i] = count
+        return counts
+
+
+################################################################################
+################################################################################
+
+class CountTable(object):
+    """
+        A read-only table of the counts of the ngrams of an attribute, made by
+        `write_count_table`. The file is mapped in memory, and each ngram is
+        looked up in constant time. Ngrams that the table cannot count (longer
+        than its maximum length, or absent while the table omits rare ngrams)
+        are counted by a fallback counter, loaded the first time it is needed.
+    """
+
+    def __init__(self, path, load_fallback):
+        """
+            @param path The path of the count table file.
+
+            @param load_fallback A function that returns the counter of the
+            ngrams that are not in the table, such as a `SuffixArray`.
+        """
+        header = read_count_table_header(path)
+        (self.max_n, self.min_freq, width, self.corpus_size, self.nb_slots,
+         self.nb_entries) = header
+        self.mask = self.nb_slots - 1
+        self.count_format = COUNT_WIDTH_FORMATS[width]
+        self.count_width = width
+        self.counts_offset = COUNT_TABLE_HEADER_SIZE + 8 * self.nb_slots
+        table_file = open(path, "rb")
+        self.data = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        table_file.close()
+        self.load_fallback = load_fallback
+        self.fallback = None
+
+################################################################################
+
+    def lookup(self, words):
+        """
+            Returns the count of the ngram made of the symbols in the list
+            `words`, or `None` if it is not in the table.
+        """
+        (slot, tag) = count_table_hash(words)
+        slot &= self.mask
+        while True:
+            (slot_tag,) = struct.unpack_from(
+                    "<Q", self.data, COUNT_TABLE_HEADER_SIZE + 8 * slot)
+            if slot_tag == tag:
+                return struct.unpack_from(self.count_format, self.data,
+                        self.counts_offset + self.count_width * slot)[0]
+            if slot_tag == 0:
+                return None
+            slot = (slot + 1) & self.mask
+
+################################################################################
+
+    def count_ngram(self, words):
+        """
+            Returns the number of occurrences of the ngram made of the symbols
+            in the list `words`.
+        """
+        return self.count_ngrams([words])[0]
+
+################################################################################
+
+    def count_ngrams(self, ngrams):
+        """
+            Returns the list of the numbers of occurrences of each ngram in
+            `ngrams`. The ngrams that the table cannot count are counted by
+            the fallback counter, in a single call.
+        """
+        counts = [0] * len(ngrams)
+        missing = []  # Positions of the ngrams left to the fallback counter
+        for (i, words) in enumerate(ngrams):
+            count = None
+            if len(words) <= self.max_n:
+                count = self.lookup(words)
+            if count is not None:
+                counts[i] = count
+            elif len(words) > self.max_n or self.min_freq > 1:
+                missing.append(i)
+        if missing:
+            if self.fallback is None:
+                self.fallback = self.load_fallback()
+            missing_counts = self.fallback.count_ngrams([ngrams[i]
+                                                         for i in missing])
+            for (i, count) in itertools.izip(missing, missing_counts):
+                counts[i] = count
+        return counts
+
+
+################################################################################
+################################################################################
+
+class CSuffixArray(SuffixArray):
+    """
+        This class implements an interface to the C indexer. Appended words
+        are interned in Python as usual, and build_suffix_array streams the
+        symbol numbers of the corpus to the C indexer through a pipe. The
+        indexer only sorts them and writes the `.corpus` and `.suffix` files;
+        the `.symbols` file is written by save(). After array construction,
+        one must call array.load() to load the array into 'python-space'.
+    """
+
+################################################################################
+
+    def __init__(self):
+        SuffixArray.__init__(self)
+        self.basepath = None
+        self.process = None
+        self.threads = 1
+
+################################################################################
+
+    def build_suffix_array(self):
+        self.start_building()
+        self.finish_building()
+
+################################################################################
+
+    def estimated_memory(self):
+        return len(self.corpus) * C_INDEXER_BYTES_PER_WORD
+
+################################################################################
+
+    def start_building(self, pool=None):
+        """
+            Launches the C indexer on the corpus without waiting for it to
+            sort, using `self.threads` threads. The `pool` argument is
+            ignored, as the indexer runs in its own process anyway.
+        """
+        if self.basepath is None:
+            error("Base path not specified for suffix array to be built " + \
+                  "with C indexer")
+            sys.exit(2)
+
+        verbose("Using C indexer to build suffix array %s" % self.basepath)
+        self.process = subprocess.Popen([C_INDEXER_PROGRAM, "-b",
+                                         "-t", str(self.threads),
+                                         "-w", str(self.corpus.itemsize),
+                                         self.basepath],
+                                        stdin=subprocess.PIPE)
+        # The indexer reads the whole corpus before sorting, so this only
+        # blocks for as long as it takes to copy the numbers.
+        self.corpus.tofile(self.process.stdin)
+        self.process.stdin.close()
+        self.corpus = make_array()
+
+################################################################################
+
+    def building_done(self):
+        return self.process is None or self.process.poll() is not None
+
+################################################################################
+
+    def finish_building(self):
+        if self.process is not None:
+            status = self.process.wait()
+            self.process = None
+            if status != 0:
+                error("C indexer failed for suffix array %s" % self.basepath)
+
+################################################################################
+
+    def save(self):
+        save_symbols_to_file(self.symbols, self.symbols_path)
+
+
+################################################################################
+################################################################################
+
+class ExternalSuffixArray(SuffixArray):
+    """
+        This class builds suffix arrays with bounded memory, for corpora that
+        do not fit in RAM. Appended words go to a temporary corpus file, and
+        build_suffix_array sorts `run_size` suffixes at a time into temporary
+        run files, which are then merged into the `.suffix` file. Only the
+        symbol table and one run are kept in memory. As with CSuffixArray,
+        one must call array.load() to use the array after construction.
+
+        At most `merge_fan_in` run files are open at a time: if there are
+        more runs, they are first merged by groups into longer runs, in as
+        many passes as needed.
+    """
+
+    run_size = 1000000  # Number of suffixes sorted in memory at a time
+    merge_fan_in = 128  # Number of runs merged at a time
+    temp_dir = None  # Where temporary files go (`None` for the default)
+
+################################################################################
+
+    def __init__(self):
+        SuffixArray.__init__(self)
+        self.basepath = None
+        self.nb_words = 0
+
+        (fd, path) = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                      dir=ExternalSuffixArray.temp_dir)
+        self.corpus_file = os.fdopen(fd, 'w+b')
+        self.corpus_file_path = path
+        self.corpus_writer = ArrayFileWriter(self.corpus_file)
+
+################################################################################
+
+    def append_word(self, word):
+        self.corpus.append(self.symbols.intern(word))
+        self.nb_words += 1
+        if len(self.corpus) >= ExternalSuffixArray.run_size:
+            self.corpus_writer.write(self.corpus)
+            self.corpus = make_array()
+
+################################################################################
+
+    def read_corpus_slice(self, first, last):
+        """
+            Returns an array with the words at positions `first` to `last` - 1
+            of the corpus file.
+        """
+        corpus = make_array()
+        self.corpus_file.seek(ARRAY_HEADER_SIZE + first * corpus.itemsize)
+        try:
+            corpus.fromfile(self.corpus_file, last - first)
+        except EOFError:
+            pass  # Reached the end of the corpus
+        return corpus
+
+################################################################################
+
+    def build_suffix_array(self):
+        if self.basepath is None:
+            error("Base path not specified for suffix array to be built " + \
+                  "on disk")
+
+        self.corpus_writer.write(self.corpus)
+        self.corpus = make_array()
+        self.corpus_file.flush()
+
+        run_dir = tempfile.mkdtemp(prefix=TEMP_PREFIX,
+                                   dir=ExternalSuffixArray.temp_dir)
+        try:
+            self.sort_runs(run_dir)
+        except:
+            # The corpus file is only kept once it is moved to the index
+            self.corpus_file.close()
+            os.remove(self.corpus_file_path)
+            raise
+        finally:
+            shutil.rmtree(run_dir)
+
+        self.corpus_writer.close()
+        shutil.move(self.corpus_file_path, self.corpus_path)
+
+################################################################################
+
+    def sort_runs(self, run_dir):
+        """
+            Sorts the suffixes of the corpus file by runs in `run_dir`, and
+            merges the runs into the `.suffix` file.
+        """
+        runs = []
+        for first in xrange(0, self.nb_words, ExternalSuffixArray.run_size):
+            last = min(first + ExternalSuffixArray.run_size, self.nb_words)
+            verbose("Sorting suffixes %d to %d of %s..."
+                    % (first, last, self.basepath))
+            corpus = self.read_corpus_slice(first, last + NGRAM_LIMIT)
+            run_path = os.path.join(run_dir, "run%d" % len(runs))
+            write_suffix_run(run_path, corpus, last - first)
+            runs.append((run_path, first))
+
+        width = position_width(self.nb_words)
+        fan_in = ExternalSuffixArray.merge_fan_in
+        nb_merged = 0
+        while len(runs) > fan_in:
+            verbose("Merging %d sorted runs of %s by groups of %d..."
+                    % (len(runs), self.basepath, fan_in))
+            merged_runs = []
+            for i in xrange(0, len(runs), fan_in):
+                group = runs[i:i + fan_in]
+                if len(group) == 1:
+                    merged_runs.extend(group)
+                    continue
+                run_path = os.path.join(run_dir, "merged%d" % nb_merged)
+                nb_merged += 1
+                merge_suffix_runs(run_path, group, width)
+                for (group_path, first) in group:
+                    os.remove(group_path)
+                merged_runs.append((run_path, 0))
+            runs = merged_runs
+
+        verbose("Merging %d sorted runs of %s..." % (len(runs), self.basepath))
+        suffix_writer = ArrayFileWriter(open(self.suffix_path, "wb"), width)
+        suffix = make_array(width=width)
+        readers = [read_suffix_run(run_path, first)
+                   for (run_path, first) in runs]
+        try:
+            for (key, pos) in heapq.merge(*readers):
+                suffix.append(pos)
+                if len(suffix) >= ExternalSuffixArray.run_size:
+                    suffix_writer.write(suffix)
+                    suffix = make_array(width=width)
+        finally:
+            for reader in readers:
+                reader.close()
+        suffix_writer.write(suffix)
+        suffix_writer.close()
+
+################################################################################
+
+    def estimated_memory(self):
+        return min(self.nb_words, ExternalSuffixArray.run_size) * \
+               EXTERNAL_INDEXER_BYTES_PER_WORD
+
+################################################################################
+
+    def nb_positions(self):
+        return self.nb_words
+
+################################################################################
+
+    def save(self):
+        save_symbols_to_file(self.symbols, self.symbols_path)
 
 
 ################################################################################
@@ -484,7 +1835,9 @@ class Index(object):
 
         """
 
-        if wants_to_use is None and Index.make_suffix_array is None:
+        if wants_to_use is None:
+            if Index.make_suffix_array is not None:
+                return
             wants_to_use = True
 
         can_use = True
@@ -507,12 +1860,27 @@ class Index(object):
 
     use_c_indexer = staticmethod(use_c_indexer)
 
+################################################################################
+
+    def use_external_indexer(run_size, temp_dir=None):
+        """
+            Class method that makes the index build its suffix arrays on disk
+            (see `ExternalSuffixArray`), sorting at most `run_size` suffixes
+            in memory at a time. Temporary files go to `temp_dir`, if given.
+        """
+        ExternalSuffixArray.run_size = run_size
+        ExternalSuffixArray.temp_dir = temp_dir
+        Index.make_suffix_array = ExternalSuffixArray
+
+    use_external_indexer = staticmethod(use_external_indexer)
+
 ################################################################################
 
     def __init__(self, basepath=None, used_word_attributes=None,
                  use_c_indexer=None):
         self.arrays = {}
         self.metadata = {"corpus_size": 0}
+        self.segments = []
 
         Index.use_c_indexer(use_c_indexer)
 
@@ -553,20 +1921,22 @@ class Index(object):
         """
             Load an attribute from the corresponding index files.
             If the attribute is of the form `a1+a2` and the corresponding
-            file does not exist, creates a new suffix array fusing the 
-            arrays for attributes `a1` and `a2`.
+            files do not exist or are out of date, creates a new suffix array
+            fusing the arrays for attributes `a1` and `a2`.
         """
         #pdb.set_trace()
         if self.arrays.has_key(attribute):
             return self.arrays[attribute]
 
+        if '+' in attribute and self.fused_array_is_stale(attribute):
+            array = self.make_fused_array(attribute.split('+'))
+            self.arrays[attribute] = array
+            return array
+
         if not self.array_file_exists(attribute):
-            if '+' in attribute:
-                self.make_fused_array(attribute.split('+'))
-            else:
-                warn("Cannot load attribute %s; index files not present."
-                     % attribute)
-                return None
+            warn("Cannot load attribute %s; index files not present."
+                 % attribute)
+            return None
 
         verbose("Loading corpus files for attribute \"%s\"." % attribute)
         array = SuffixArray()
@@ -579,36 +1949,295 @@ class Index(object):
 
 ################################################################################
 
-    def make_fused_array(self, attrs):
+    def load_counter(self, attribute):
         """
-            Make an array combining the attributes `attrs`. This array must be
-            loaded after creation.
+            Returns an object whose `count_ngram` method counts ngrams of
+            `attribute` in the whole index, including its segments. The
+            metadata is loaded again, under a shared lock (see `lock`). If the
+            index has an up-to-date count table of `attribute`, ngrams are
+            looked up in it, and the suffix arrays are only loaded for the
+            ngrams it cannot count.
         """
+        lock_file = self.lock(shared=True)
+        try:
+            self.load_metadata()
+            if not self.count_table_is_stale(attribute):
+                path = self.basepath + "." + attribute + COUNT_TABLE_EXT
+                verbose("Using count table %s." % path)
+                return CountTable(path,
+                                  lambda: self.load_array_counter(attribute))
+            return self.load_array_counter(attribute)
+        finally:
+            self.unlock(lock_file)
 
-        verbose("Making fused array for " + '+'.join(attrs) + "...")
-        generators = [read_attribute_from_index(attr, self.basepath) \
-                      for attr in attrs]
+################################################################################
+
+    def count_table_is_stale(self, attribute):
+        """
+            Returns whether the count table of `attribute` is missing or does
+            not match the current index files: older than the suffix array,
+            made for another corpus size, or made before segments were
+            appended.
+        """
+        path = self.basepath + "." + attribute + COUNT_TABLE_EXT
+        suffix_path = self.basepath + "." + attribute + ".suffix"
+        if self.segment_numbers() or not os.path.isfile(path):
+            return True
+        if '+' in attribute and self.fused_array_is_stale(attribute):
+            return True
+        if not os.path.isfile(suffix_path) or \
+                os.path.getmtime(suffix_path) > os.path.getmtime(path):
+            return True
+        header = read_count_table_header(path)
+        return header is None or \
+                header[3] != self.metadata.get("corpus_size")
+
+################################################################################
+
+    def load_array_counter(self, attribute):
+        """
+            Returns the counter of `load_counter`, without the count table.
+            Unless the Python indexer was requested, ngrams are counted by the
+            C n-gram counting library over the mapped index files, if it is
+            available. The metadata is loaded again and the files are opened
+            under a shared lock, so that they are those of the same version
+            of the index.
+        """
+        library = None
+        if Index.make_suffix_array is not SuffixArray:
+            library = load_ngram_count_library()
+        lock_file = self.lock(shared=True)
+        try:
+            self.load_metadata()
+            arrays = [self.load_mapped(attribute, library)]
+            for segment in self.load_segments():
+                arrays.append(segment.load_mapped(attribute, library))
+        finally:
+            self.unlock(lock_file)
+        arrays = [array for array in arrays if array is not None]
+
+        if len(arrays) == 1:
+            return arrays[0]
+        return SuffixArrayGroup(arrays)
+
+################################################################################
+
+    def load_mapped(self, attribute, library):
+        """
+            Like `load`, but returns a `MappedSuffixArray` using `library`,
+            unless `library` is `None` or the attribute had to be built now.
+        """
+        if library is None or self.arrays.has_key(attribute):
+            return self.load(attribute)
+        if '+' in attribute and self.fused_array_is_stale(attribute):
+            return self.load(attribute)
+        if not self.array_file_exists(attribute):
+            warn("Cannot load attribute %s; index files not present."
+                 % attribute)
+            return None
+
+        verbose("Mapping corpus files for attribute \"%s\"." % attribute)
+        array = MappedSuffixArray(library, self.basepath + "." + attribute)
+        if array.handle is None:
+            verbose("Cannot map the files of \"%s\"; loading them instead."
+                    % attribute)
+            return self.load(attribute)
+        return array
+
+################################################################################
+
+    def verify(self):
+        """
+            Checks every array file of the index and of its segments (see
+            `verify_array_file`), and that each `.suffix` file has as many
+            elements as its `.corpus` file. Returns a list of `(path,
+            message)` for the files that have a problem.
+        """
+        problems = []
+        for corpus_path in sorted(glob.glob(self.basepath + ".*.corpus")):
+            suffix_path = corpus_path[:-len(".corpus")] + ".suffix"
+            for path in [corpus_path, suffix_path]:
+                if not os.path.isfile(path):
+                    problems.append((path, "missing"))
+                    continue
+                verbose("Verifying %s..." % path)
+                problem = verify_array_file(path)
+                if problem is not None:
+                    problems.append((path, problem))
+            if not [path for (path, problem) in problems
+                    if path in (corpus_path, suffix_path)] and \
+                    array_file_length(corpus_path) != \
+                    array_file_length(suffix_path):
+                problems.append((suffix_path, "length differs from corpus"))
+        return problems
+
+################################################################################
+
+    def segment_numbers(self):
+        """
+            Returns the list of numbers of the segments appended to the index,
+            according to the loaded metadata.
+        """
+        segments = self.metadata.get("segments", "")
+        return [int(number) for number in segments.split(":") if number]
 
-        sufarray = Index.make_suffix_array()
-        sufarray.set_basepath(self.basepath + "." + '+'.join(attrs))
+################################################################################
+
+    def segment_path(self, number):
+        """
+            Returns the base path of segment `number` of the index.
+        """
+        return "%s.seg%d" % (self.basepath, number)
+
+################################################################################
+
+    def load_segments(self):
+        """
+            Returns the `Index`es of the segments appended to this index,
+            with their metadata loaded.
+        """
+        if not self.segments:
+            for number in self.segment_numbers():
+                segment = Index(self.segment_path(number),
+                                copy_list(self.used_word_attributes))
+                segment.load_metadata()
+                self.segments.append(segment)
+        return self.segments
+
+################################################################################
+
+    def lock(self, shared=False, blocking=True, ext=LOCK_EXT):
+        """
+            Acquires a lock on the index metadata, so that segments can be
+            added and merged by concurrent processes. Processes that change
+            the metadata or rename the main files hold an exclusive lock, and
+            readers hold a shared lock while they load the metadata and open
+            the files, so that they never see segments that are both merged
+            into the main files and still listed in the metadata.
+
+            Returns the lock file, which must be given to `unlock`, or `None`
+            if `blocking` is false and the lock is held by another process.
+            A shared lock is also `None` if the lock file cannot be created
+            (e.g. in a read-only directory): readers then go without it.
+
+            @param ext The extension of the lock file, for other locks than
+            the lock of the metadata (see `merge_index_segments`).
+        """
+        path = self.basepath + ext
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            mode |= fcntl.LOCK_NB
         while True:
             try:
-                g = ""
-                next_words = [g.next() for g in generators]
-                if g == "":
-                    sufarray.append_word("")
-                else:
-                    sufarray.append_word(ATTRIBUTE_SEPARATOR.join(next_words))
+                lock_file = open(path, "a")
+            except IOError:
+                if shared:
+                    return None
+                raise
+            try:
+                fcntl.flock(lock_file, mode)
+            except IOError:
+                lock_file.close()
+                return None  # Held by another process
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    return lock_file
+            except OSError:
+                pass
+            # Removed by `unlock` while we were waiting: lock the new file
+            lock_file.close()
 
-            except StopIteration:
-                break
+################################################################################
+
+    def unlock(self, lock_file):
+        """
+            Releases a lock acquired with `lock`. The last process to release
+            the lock removes the lock file.
+        """
+        if lock_file is None:
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(lock_file.fileno()).st_ino == \
+                    os.stat(lock_file.name).st_ino:
+                os.remove(lock_file.name)
+        except (IOError, OSError):
+            pass  # Still held by another process
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+################################################################################
+
+    def fused_array_is_stale(self, attribute):
+        """
+            Returns whether the files of the fused attribute `attribute` (e.g.
+            `lemma+pos`) are missing or older than the files of the attributes
+            it is made of, and must thus be (re)built.
+        """
+        if not self.array_file_exists(attribute):
+            return True
+        fused_time = os.path.getmtime(self.basepath + "." + attribute +
+                                      ".corpus")
+        for attr in attribute.split('+'):
+            path = self.basepath + "." + attr + ".corpus"
+            if os.path.isfile(path) and os.path.getmtime(path) > fused_time:
+                return True
+        return False
 
-        sufarray.build_suffix_array()
-        sufarray.save()
+################################################################################
 
-        # Is this any good? (May be with the old indexer; must test)
-        sufarray = None
-        print("objects collected by gc.collect()", file=sys.stderr)
+    def make_fused_array(self, attrs):
+        """
+            Make an array combining the attributes `attrs`, save it to the
+            index files so that it is reused by later runs, and return it.
+        """
+        verbose("Making fused array for " + '+'.join(attrs) + "...")
+        fused_array = None
+        for attr in attrs:
+            array = SuffixArray()
+            array.set_basepath(self.basepath + "." + attr)
+            load_array_from_file(array.corpus, array.corpus_path)
+            load_symbols_from_file(array.symbols, array.symbols_path)
+            if fused_array is None:
+                fused_array = array
+            else:
+                fused_array = fuse_suffix_arrays(fused_array, array)
+
+        fused_array.set_basepath(self.basepath + "." + '+'.join(attrs))
+        if Index.make_suffix_array is CSuffixArray:
+            # Let the C indexer sort it, writing the .corpus/.suffix files.
+            c_array = CSuffixArray()
+            c_array.corpus = fused_array.corpus
+            c_array.symbols = fused_array.symbols
+            c_array.set_basepath(fused_array.basepath)
+            c_array.build_suffix_array()
+            c_array.save()
+            fused_array.suffix = read_array_file(fused_array.suffix_path)
+        else:
+            fused_array.build_suffix_array()
+            fused_array.save()
+        if self.metadata.get("corpus_encoding") == "varbyte":
+            compress_array_file(fused_array.corpus_path)
+        return fused_array
+
+################################################################################
+
+    def compress_corpora(self):
+        """
+            Compresses the corpus array files of the index (see
+            ARRAY_WIDTH_VARBYTE), and records it in the metadata, so that
+            fused arrays are compressed when they are made. Files that are
+            already compressed are left as they are.
+        """
+        for path in sorted(glob.glob(self.basepath + ".*.corpus")):
+            file = open(path, "rb")
+            header = read_array_header(file)
+            file.close()
+            if header is not None and header[0] == ARRAY_WIDTH_VARBYTE:
+                continue
+            verbose("Compressing %s..." % path)
+            compress_array_file(path)
+        self.metadata["corpus_encoding"] = "varbyte"
 
 ################################################################################
 
@@ -626,14 +2255,10 @@ class Index(object):
         """
             Loads the index metadata from the corresponding file.
         """
-        metafile = open(self.metadata_path)
-        for line in metafile:
-            key, type, value = line.rstrip('\n').split(" ", 2)
-            if type == "int":
-                value = int(value)
-            self.metadata[key] = value
-
-        metafile.close()
+        self.metadata.update(read_metadata_file(self.metadata_path))
+        if self.metadata.get("format_version", 0) > INDEX_FORMAT_VERSION:
+            error("Index %s was made by a newer version of mwetoolkit"
+                  % self.basepath)
 
 ################################################################################
 
@@ -641,22 +2266,23 @@ class Index(object):
         """
             Saves the index metadata to the corresponding file.
         """
-        metafile = open(self.metadata_path, "w")
-        for key, value in self.metadata.items():
-            if isinstance(value, int):
-                type = "int"
-            else:
-                type = "string"
-
-            metafile.write("%s %s %s\n" % (key, type, value))
-
-        metafile.close()
+        self.metadata["format_version"] = INDEX_FORMAT_VERSION
+        write_metadata_file(self.metadata_path, self.metadata)
 
 ################################################################################
 
     # Load/save main (non-composite) attributes and metadata
     def load_main(self):
-        self.load_metadata()
+        lock_file = self.lock(shared=True)
+        try:
+            self.load_metadata()
+            self.load_attributes()
+            for segment in self.load_segments():
+                segment.load_attributes()
+        finally:
+            self.unlock(lock_file)
+
+    def load_attributes(self):
         present_attributes = []
         for attr in self.used_word_attributes:
             present = self.load(attr)
@@ -695,48 +2321,110 @@ class Index(object):
 
 ################################################################################
 
-    def build_suffix_arrays(self):
+    def build_suffix_arrays(self, max_jobs=1, memory_budget=None,
+                            checkpoint=None):
         """
-            Build suffix arrays for all attributes in the index.
+            Build suffix arrays for all attributes in the index. Attributes
+            are independent, so up to `max_jobs` of them are built at the
+            same time, as long as their estimated memory needs add up to at
+            most `memory_budget` bytes (`None` means no limit). A build is
+            always started when nothing else is running, even if it alone
+            exceeds the budget. Jobs that are not needed for separate
+            attributes are given to the C indexer as sorting threads. The
+            width of the suffix array positions is recorded in the metadata.
+            If a `BuildCheckpoint` is given, each attribute is saved as soon
+            as it is built, and recorded as done in the checkpoint.
         """
-        for attr in self.arrays.keys():
-            verbose("Building suffix array for %s..." % attr)
-            ## REFACTOR FIXME
-            self.arrays[attr].set_basepath(self.basepath + "." + attr)
-            self.arrays[attr].build_suffix_array()
+        pending = list(self.arrays.keys())
+        nb_positions = dict((attr, self.arrays[attr].nb_positions())
+                            for attr in pending)
+        self.metadata["position_width"] = max(
+                [4] + [position_width(n) for n in nb_positions.values()])
+        running = []
+        nb_done = 0
+        positions_done = 0
+        progress = ProgressReporter("build")
+        pool = None
+        if max_jobs > 1 and Index.make_suffix_array is SuffixArray:
+            pool = multiprocessing.Pool(min(max_jobs, len(pending)))
+
+        try:
+            while pending or running:
+                while pending and len(running) < max_jobs:
+                    attr = pending[0]
+                    memory = self.arrays[attr].estimated_memory()
+                    used = sum(m for (a, m, t) in running)
+                    if running and memory_budget is not None and \
+                            used + memory > memory_budget:
+                        break
+                    pending.pop(0)
+                    verbose("Building suffix array for %s..." % attr)
+                    ## REFACTOR FIXME
+                    self.arrays[attr].set_basepath(self.basepath + "." + attr)
+                    if isinstance(self.arrays[attr], CSuffixArray):
+                        spare_jobs = max_jobs - len(running)
+                        self.arrays[attr].threads = \
+                                max(1, spare_jobs // (len(pending) + 1))
+                    self.arrays[attr].start_building(pool)
+                    running.append((attr, memory, time.time()))
+
+                finished = [r for r in running
+                            if self.arrays[r[0]].building_done()]
+                if not finished:
+                    time.sleep(0.05)
+                for (attr, memory, start) in finished:
+                    self.arrays[attr].finish_building()
+                    running.remove((attr, memory, start))
+                    nb_done += 1
+                    verbose("Suffix array for %s done (%d of %d, %.1fs)."
+                            % (attr, nb_done, len(self.arrays),
+                               time.time() - start))
+                    if checkpoint is not None:
+                        self.save(attr)
+                        checkpoint.mark_done(attr, self.metadata)
+                    positions_done += nb_positions[attr]
+                    progress.update(positions_done
+                                    / max(1, sum(nb_positions.values())),
+                                    force=True, attributes=nb_done)
+        finally:
+            if pool is not None:
+                pool.terminate()
 
 ################################################################################
 
     def iterate_sentences(self):
         """
-            Returns an iterator over all sentences in the corpus.
+            Returns an iterator over all sentences in the corpus, including
+            the sentences in the segments of the index.
         """
-
         id = 1
-        guide = self.used_word_attributes[0]  # guide?
-        length = len(self.arrays[guide].corpus)
-        words = []
-        for i in range(0, length):
-            if self.arrays[guide].corpus[i] == 0:
-                # We have already a whole sentence.
-                sentence = Sentence(words, id)
+        for part in [self] + self.segments:
+            for sentence in part.iterate_own_sentences(id):
                 id += 1
-                words = []
                 yield sentence
 
-            else:
-                args_dict = {}
-                args = []
-                for poss_attr in WORD_ATTRIBUTES:
-                    args_dict[poss_attr] = WILDCARD
-                for attr in self.used_word_attributes:
-                    number = self.arrays[attr].corpus[i]
-                    symbol = self.arrays[attr].symbols.number_to_symbol[number]
-                    args_dict[attr] = symbol
-                for poss_attr in WORD_ATTRIBUTES:
-                    args.append(args_dict[poss_attr])
-                args.append([])
-                words.append(Word(*args))
+################################################################################
+
+    def iterate_own_sentences(self, id=1):
+        """
+            Returns an iterator over the sentences in the arrays of this
+            index, not including its segments, numbering them from `id`.
+        """
+        guide = self.used_word_attributes[0]  # guide?
+        corpus = self.arrays[guide].corpus
+        symbols = dict((attr, self.arrays[attr].symbols.number_to_symbol)
+                       for attr in self.used_word_attributes)
+        # Positions of the end-of-sentence symbol (0), found at C level
+        ends = itertools.compress(itertools.count(),
+                                  itertools.imap(operator.not_, corpus))
+        start = 0
+        for end in ends:
+            columns = dict((attr, self.arrays[attr].corpus[start:end])
+                           for attr in self.used_word_attributes)
+            sentence = IndexSentenceColumns(columns, symbols, end - start)
+            yield Sentence(sentence.words, id)
+            id += 1
+            start = end + 1
 
 ################################################################################
 
@@ -748,6 +2436,190 @@ class Index(object):
             print("")
 
 
+################################################################################
+################################################################################
+
+def read_shard_manifest(path):
+    """
+        Returns the list of base paths of the shards listed in the manifest
+        file `path` (see SHARD_MANIFEST_EXT).
+    """
+    directory = os.path.dirname(path)
+    basepaths = []
+    for line in open(path):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if not line.endswith(".info"):
+            error("Bad shard in %s: %s is not an index .info file"
+                  % (path, line))
+        basepaths.append(os.path.join(directory, line[:-len(".info")]))
+    if not basepaths:
+        error("Shard manifest %s lists no shards" % path)
+    return basepaths
+
+
+################################################################################
+
+def write_shard_manifest(path, info_paths):
+    """
+        Writes a manifest file `path` listing the indexes whose `.info` files
+        are `info_paths`, as the shards of a sharded index.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    manifest = open(path + ".tmp", "w")
+    manifest.write("# Shards of %s, one index .info file per line\n"
+                   % os.path.basename(path))
+    for info_path in info_paths:
+        if not info_path.endswith(".info") or not os.path.isfile(info_path):
+            error("Shard %s is not an index .info file" % info_path)
+        manifest.write(os.path.relpath(os.path.abspath(info_path), directory)
+                       + "\n")
+    manifest.close()
+    os.rename(path + ".tmp", path)
+
+
+################################################################################
+
+def count_in_shard(basepath, attribute, ngrams):
+    """
+        Counts ngrams in one shard of a `ShardedIndex`, opening it the first
+        time and keeping it open. Returns the list of counts of `ngrams`.
+    """
+    counter = shard_counters.get((basepath, attribute))
+    if counter is None:
+        shard = Index(basepath)
+        shard.load_metadata()
+        counter = shard.load_counter(attribute)
+        shard_counters[(basepath, attribute)] = counter
+    return counter.count_ngrams(ngrams)
+
+################################################################################
+
+def count_in_shards(task):
+    """
+        Counts ngrams in some shards of a `ShardedIndex`. This runs in a
+        worker process, which is always given the same shards, so that each
+        shard is only open in one process. `task` is a tuple `(basepaths,
+        attribute, ngrams)`; returns the list of counts of `ngrams`, summed
+        over the shards.
+    """
+    (basepaths, attribute, ngrams) = task
+    return map(sum, itertools.izip(*[count_in_shard(basepath, attribute,
+                                                    ngrams)
+                                     for basepath in basepaths]))
+
+
+################################################################################
+################################################################################
+
+class ShardedIndex(object):
+    """
+        This class holds an index made of several indexes (shards) built
+        independently, and listed in a manifest file. Its metadata and ngram
+        counts are the sums of those of the shards.
+    """
+
+    def __init__(self, manifest_path, max_jobs=1):
+        """
+            @param manifest_path The path of the manifest file.
+
+            @param max_jobs Number of worker processes querying the shards
+            in parallel.
+        """
+        self.manifest_path = manifest_path
+        self.shards = [Index(basepath)
+                       for basepath in read_shard_manifest(manifest_path)]
+        self.metadata = {"corpus_size": 0}
+        self.max_jobs = max_jobs
+
+################################################################################
+
+    def load_metadata(self):
+        """
+            Loads the metadata of every shard, summing their corpus sizes.
+        """
+        for shard in self.shards:
+            shard.load_metadata()
+        self.metadata["corpus_size"] = sum(shard.metadata["corpus_size"]
+                                           for shard in self.shards)
+
+################################################################################
+
+    def load_counter(self, attribute):
+        """
+            Returns a `ShardCounter` for `attribute`. The metadata must have
+            been loaded. Fused arrays missing in some shards are made first,
+            so that workers never build the same files at once.
+        """
+        if '+' in attribute:
+            for shard in self.shards:
+                for part in [shard] + shard.load_segments():
+                    if part.fused_array_is_stale(attribute):
+                        part.make_fused_array(attribute.split('+'))
+        return ShardCounter([shard.basepath for shard in self.shards],
+                            attribute, self.max_jobs)
+
+
+################################################################################
+################################################################################
+
+class ShardCounter(object):
+    """
+        Counts the ngrams of an attribute in every shard of a `ShardedIndex`
+        and sums the counts. The shards are divided among up to `max_jobs`
+        worker processes, which count the ngrams passed to `count_ngrams` in
+        their shards at the same time. Each shard is always counted by the
+        same worker, so that it is loaded in a single process.
+    """
+
+    def __init__(self, basepaths, attribute, max_jobs=1):
+        self.basepaths = basepaths
+        self.attribute = attribute
+        nb_workers = min(max_jobs, len(basepaths))
+        self.groups = [basepaths]  # Shards of each worker
+        self.pools = []  # A single-process pool per worker
+        if nb_workers > 1:
+            self.groups = [basepaths[i::nb_workers]
+                           for i in xrange(nb_workers)]
+            self.pools = [multiprocessing.Pool(1) for group in self.groups]
+
+################################################################################
+
+    def count_ngram(self, words):
+        """
+            Returns the number of occurrences of the ngram made of the symbols
+            in the list `words`, summed over all shards.
+        """
+        return self.count_ngrams([words])[0]
+
+################################################################################
+
+    def count_ngrams(self, ngrams):
+        """
+            Returns the list of the numbers of occurrences of each ngram in
+            `ngrams`, summed over all shards.
+        """
+        tasks = [(group, self.attribute, ngrams) for group in self.groups]
+        if not self.pools:
+            counts = map(count_in_shards, tasks)
+        else:
+            results = [pool.apply_async(count_in_shards, (task,))
+                       for (pool, task) in itertools.izip(self.pools, tasks)]
+            counts = [result.get() for result in results]
+        return map(sum, itertools.izip(*counts))
+
+################################################################################
+
+    def close(self):
+        """
+            Stops the worker processes.
+        """
+        for pool in self.pools:
+            pool.terminate()
+        self.pools = []
+
+
 ################################################################################
 ################################################################################
 
@@ -759,13 +2631,343 @@ def populate_index(index, corpus_fileobjs, filetype_hint=None):
 
 ################################################################################
 
+def append_to_index(index, corpus_fileobjs, filetype_hint=None, max_jobs=1,
+                    memory_budget=None):
+    """
+        Indexes the sentences of a corpus file as a new segment of an existing
+        `Index`, without rebuilding the index. Returns the number of segments
+        the index has now.
+    """
+    index.load_metadata()
+    attrs = [attr for attr in index.used_word_attributes
+             if index.array_file_exists(attr)]
+    number = index.metadata.get("last_segment", 0) + 1
+    while os.path.isfile(index.segment_path(number) + ".info"):
+        number += 1
+
+    segment = Index(index.segment_path(number), attrs)
+    populate_index(segment, corpus_fileobjs, filetype_hint)
+    segment.build_suffix_arrays(max_jobs, memory_budget)
+    segment.save_main()
+
+    lock_file = index.lock()
+    try:
+        index.load_metadata()
+        numbers = index.segment_numbers() + [number]
+        index.metadata["segments"] = ":".join(str(n) for n in numbers)
+        index.metadata["last_segment"] = number
+        index.metadata["corpus_size"] += segment.metadata["corpus_size"]
+        index.save_metadata()
+    finally:
+        index.unlock(lock_file)
+    verbose("Added segment %d (%d words) to the index."
+            % (number, segment.metadata["corpus_size"]))
+    return len(numbers)
+
+################################################################################
+
+def merge_index_segments(index, max_jobs=1, memory_budget=None):
+    """
+        Merges the segments of an `Index` back into its main arrays. The
+        main arrays and the segments are read again and sorted as a whole,
+        so it is meant to run in the background while the segmented index
+        keeps being queried. Segments appended while the merge runs are kept
+        as segments. Only one merge of an index runs at a time: if another
+        one is running, returns without doing anything.
+    """
+    merge_lock = index.lock(blocking=False, ext=MERGE_LOCK_EXT)
+    if merge_lock is None:
+        verbose("Segments of %s are already being merged." % index.basepath)
+        return
+    try:
+        merge_locked_segments(index, max_jobs, memory_budget)
+    finally:
+        index.unlock(merge_lock)
+
+################################################################################
+
+def merge_locked_segments(index, max_jobs=1, memory_budget=None):
+    """
+        Merges the segments of an `Index` as `merge_index_segments`, whose
+        merge lock must be held, so that the main files do not change until
+        they are replaced by the merged ones.
+    """
+    lock_file = index.lock()
+    try:
+        index.load_metadata()
+        numbers = index.segment_numbers()
+    finally:
+        index.unlock(lock_file)
+    if not numbers:
+        return
+    attrs = [attr for attr in index.used_word_attributes
+             if index.array_file_exists(attr)]
+    parts = [index.basepath] + [index.segment_path(n) for n in numbers]
+
+    verbose("Merging %d segments into the index..." % len(numbers))
+    merged = Index(index.basepath + ".merging", attrs)
+    merged.fresh_arrays()
+    for attr in attrs:
+        for path in parts:
+            for word in read_attribute_from_index(attr, path):
+                merged.arrays[attr].append_word(word)
+    merged.build_suffix_arrays(max_jobs, memory_budget)
+    for attr in attrs:
+        merged.save(attr)
+    if index.metadata.get("corpus_encoding") == "varbyte":
+        merged.compress_corpora()
+
+    lock_file = index.lock()
+    try:
+        # Fused arrays are rebuilt on demand from the merged arrays. Count
+        # tables are stale, and must be exported again.
+        for path in glob.glob(index.basepath + ".*+*.*") + \
+                glob.glob(index.basepath + ".*" + COUNT_TABLE_EXT):
+            if os.path.exists(path):
+                os.remove(path)
+        for attr in attrs:
+            for ext in ["corpus", "suffix", "symbols"]:
+                os.rename("%s.%s.%s" % (merged.basepath, attr, ext),
+                          "%s.%s.%s" % (index.basepath, attr, ext))
+        index.load_metadata()
+        remaining = [n for n in index.segment_numbers() if n not in numbers]
+        index.metadata["segments"] = ":".join(str(n) for n in remaining)
+        index.metadata["position_width"] = merged.metadata["position_width"]
+        index.save_metadata()
+    finally:
+        index.unlock(lock_file)
+
+    for number in numbers:
+        for path in glob.glob(index.segment_path(number) + ".*"):
+            os.remove(path)
+    verbose("Merged %d segments into the index." % len(numbers))
+
+################################################################################
+
+def count_table_hash(words):
+    """
+        Returns the hash `(slot, tag)` of the ngram made of the symbols in the
+        list `words` in a count table. The slot must be reduced to the number
+        of slots of the table.
+    """
+    key = "\0".join(words).encode("utf-8")
+    (slot, tag) = struct.unpack("<QQ", hashlib.md5(key).digest())
+    return (slot, tag | 1)
+
+################################################################################
+
+def read_count_table_header(path):
+    """
+        Returns the tuple `(max_n, min_freq, count_width, corpus_size,
+        nb_slots, nb_entries)` read from the header of the count table file
+        `path`, or `None` if it is not a count table of a known version.
+    """
+    table_file = open(path, "rb")
+    header = table_file.read(COUNT_TABLE_HEADER_SIZE)
+    table_file.close()
+    if len(header) < COUNT_TABLE_HEADER_SIZE:
+        return None
+    fields = struct.unpack(COUNT_TABLE_HEADER_FORMAT, header)
+    if fields[0] != COUNT_TABLE_MAGIC or fields[1] != COUNT_TABLE_VERSION:
+        return None
+    return fields[2:]
+
+################################################################################
+
+def iter_ngram_counts(suffix_array, max_n):
+    """
+        Yields `(ngram, count)` for every ngram of up to `max_n` symbol
+        numbers in `suffix_array` that does not span a sentence boundary, in
+        a single pass over its suffixes. The suffixes that start with the
+        same ngram are consecutive, so the count of each ngram is the length
+        of a run of suffixes.
+    """
+    corpus = suffix_array.corpus
+    progress = ProgressReporter("count table")
+    nb_suffixes = len(suffix_array.suffix)
+    previous = array.array(corpus.typecode)
+    runs = [0] * max_n  # Length of the current run of each ngram length
+    for (i, position) in enumerate(itertools.chain(suffix_array.suffix,
+                                                   [None])):
+        if position is None:
+            current = previous[:0]  # Past the last suffix: ends all runs
+        else:
+            current = corpus[position:position + max_n]
+            if 0 in current:
+                current = current[:current.index(0)]
+        common = 0
+        limit = min(len(previous), len(current))
+        while common < limit and previous[common] == current[common]:
+            common += 1
+        for n in xrange(len(previous), common, -1):
+            yield (previous[:n], runs[n - 1])
+        for n in xrange(common, len(current)):
+            runs[n] = 0
+        for n in xrange(len(current)):
+            runs[n] += 1
+        previous = current
+        progress.update(i / max(nb_suffixes, 1), suffixes=i)
+
+################################################################################
+
+def write_count_table(index, attribute, max_n, min_freq=1):
+    """
+        Writes the count table of `attribute` in `index` (see `CountTable`),
+        with all the ngrams of up to `max_n` words that occur at least
+        `min_freq` times. The index must not have segments.
+    """
+    if not 1 <= max_n <= NGRAM_LIMIT:
+        error("Count tables are limited to ngrams of 1 to %d words"
+              % NGRAM_LIMIT)
+    index.load_metadata()
+    if index.segment_numbers():
+        error("Index %s has segments; merge them first with --merge"
+              % index.basepath)
+    suffix_array = index.load(attribute)
+    if suffix_array is None:
+        error("Cannot make the count table of attribute %s" % attribute)
+
+    verbose("Counting the ngrams of attribute \"%s\"..." % attribute)
+    symbols = suffix_array.symbols.number_to_symbol
+    digests = bytearray()  # MD5 of each kept ngram
+    counts = make_array(width=position_width(index.metadata["corpus_size"]))
+    for (ngram, count) in iter_ngram_counts(suffix_array, max_n):
+        if count >= min_freq:
+            key = "\0".join(symbols[number] for number in ngram)
+            digests += hashlib.md5(key.encode("utf-8")).digest()
+            counts.append(count)
+
+    nb_slots = 1
+    while nb_slots * COUNT_TABLE_LOAD_FACTOR < len(counts) + 1:
+        nb_slots *= 2
+    width = 1
+    while counts and max(counts) >= 1 << (8 * width):
+        width *= 2
+    verbose("Writing %d ngram counts in %d slots..." % (len(counts), nb_slots))
+    tags = bytearray(8 * nb_slots)
+    slot_counts = bytearray(width * nb_slots)
+    mask = nb_slots - 1
+    for (i, count) in enumerate(counts):
+        (slot, tag) = struct.unpack_from("<QQ", digests, 16 * i)
+        slot &= mask
+        while struct.unpack_from("<Q", tags, 8 * slot)[0]:
+            slot = (slot + 1) & mask
+        struct.pack_into("<Q", tags, 8 * slot, tag | 1)
+        struct.pack_into(COUNT_WIDTH_FORMATS[width], slot_counts,
+                         width * slot, count)
+
+    path = index.basepath + "." + attribute + COUNT_TABLE_EXT
+    table_file = open(path + ".tmp", "wb")
+    table_file.write(struct.pack(COUNT_TABLE_HEADER_FORMAT, COUNT_TABLE_MAGIC,
+                                 COUNT_TABLE_VERSION, max_n, min_freq, width,
+                                 index.metadata["corpus_size"], nb_slots,
+                                 len(counts)))
+    table_file.write(tags)
+    table_file.write(slot_counts)
+    table_file.close()
+    os.rename(path + ".tmp", path)
+    verbose("Wrote count table %s." % path)
+
+################################################################################
+
+class BuildCheckpoint(object):
+    """
+        Records which attributes of an index being built have their files
+        complete, in the file `basepath + CHECKPOINT_EXT`, so that a build
+        that was interrupted can skip them when it is run again. The
+        checkpoint only applies to the same input files: it is discarded if
+        their paths, sizes or modification times have changed.
+    """
+
+    def __init__(self, basepath, input_paths):
+        self.basepath = basepath
+        self.path = basepath + CHECKPOINT_EXT
+        signature = ":".join("%s:%d:%d" % (os.path.abspath(path),
+                                           os.path.getsize(path),
+                                           os.path.getmtime(path))
+                             for path in input_paths)
+        self.metadata = {"inputs": "%08x" % (zlib.crc32(signature)
+                                             & 0xffffffff),
+                         "attributes": ""}
+        if os.path.isfile(self.path):
+            metadata = read_metadata_file(self.path)
+            if metadata.get("inputs") == self.metadata["inputs"]:
+                self.metadata = metadata
+            else:
+                verbose("Input changed since %s was written, ignoring it."
+                        % self.path)
+
+################################################################################
+
+    def completed_attributes(self):
+        """
+            Returns the attributes recorded as done whose `.corpus`,
+            `.suffix` and `.symbols` files are still present and pass
+            `verify_array_file`.
+        """
+        completed = []
+        for attr in self.metadata["attributes"].split(":"):
+            if not attr:
+                continue
+            basepath = self.basepath + "." + attr
+            paths = [basepath + ".corpus", basepath + ".suffix"]
+            if not os.path.isfile(basepath + ".symbols") or \
+                    [path for path in paths if not os.path.isfile(path)
+                     or verify_array_file(path) is not None] or \
+                    array_file_length(paths[0]) != array_file_length(paths[1]):
+                verbose("Files of %s are damaged, rebuilding it." % attr)
+                continue
+            completed.append(attr)
+        return completed
+
+################################################################################
+
+    def mark_done(self, attribute, metadata):
+        """
+            Records that the files of `attribute` are complete, along with
+            the corpus size and position width of the index `metadata`.
+        """
+        attrs = [a for a in self.metadata["attributes"].split(":") if a]
+        if attribute not in attrs:
+            attrs.append(attribute)
+        self.metadata["attributes"] = ":".join(attrs)
+        self.metadata["corpus_size"] = metadata["corpus_size"]
+        self.metadata["position_width"] = metadata["position_width"]
+        write_metadata_file(self.path, self.metadata)
+
+################################################################################
+
+    def clear(self):
+        """
+            Removes the checkpoint file, once the whole index is built.
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+################################################################################
+
 class IndexPopulatorHandler(filetype.InputHandler):
     def __init__(self, index):
         self.index = index
         self.index.fresh_arrays()
+        self.nb_tokens = 0
+        self.nb_reported_tokens = 0
+        self.progress = ProgressReporter("read")
 
     def handle_sentence(self, sentence, info={}):
         self.index.append_sentence(sentence)
+        self.nb_tokens += len(sentence)
+        fraction = None
+        if "progress" in info and info["progress"][1] != 0:
+            fraction = info["progress"][0] / info["progress"][1]
+        self.progress.update(fraction, tokens=self.nb_tokens)
+
+    def flush(self):
+        # May be called more than once: report the total only once
+        if self.nb_tokens != self.nb_reported_tokens:
+            self.progress.update(force=True, tokens=self.nb_tokens)
+            self.nb_reported_tokens = self.nb_tokens
 
     def finish(self):
         self.index.build_suffix_arrays()
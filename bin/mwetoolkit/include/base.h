@@ -15,10 +15,29 @@ typedef enum bool { false, true } bool;
 #define SYMBOL_ENTRY_ALLOC_CHUNK 65536
 #define SYMBOL_STRINGS_ALLOC_CHUNK 65536
 #define SUFFIX_ARRAY_ALLOC_CHUNK 65536
+// Must be a power of two.
+#define SYMBOL_HASH_INITIAL_SLOTS 65536
 
 // This should be dynamic.
 #define LINE_BUFFER_LEN 4096
 
 #define NGRAM_COMPARE_LIMIT 16
 
+// Header of the .corpus and .suffix files, as written by indexlib.py:
+// magic, version, element width, byte order mark, CRC32 of the data, and
+// number of elements.
+#define ARRAY_FILE_MAGIC "MWETKARR"
+#define ARRAY_FILE_MAGIC_LEN 8
+#define ARRAY_FILE_VERSION 1
+#define ARRAY_BYTE_ORDER_MARK 0x01020304u
+#define ARRAY_HEADER_SIZE 32
+// Element width given in the header of compressed corpus files.
+#define ARRAY_WIDTH_VARBYTE 0
+
+// Minimum number of seconds between two progress reports.
+#define PROGRESS_INTERVAL 5
+
+// Partitions smaller than this are insertion-sorted.
+#define MULTIKEY_INSERTION_SORT_SIZE 16
+
 #endif
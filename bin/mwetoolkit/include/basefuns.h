@@ -3,10 +3,39 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <time.h>
 #include "base.h"
 
 void *check_malloc(size_t size);
 
 void *check_realloc(void *ptr, size_t size);
 
+/*!
+ * Returns the CRC32 (same as zlib's) of `size` bytes at `data`, continuing
+ * from the CRC32 `crc` of the data before them (0 to start).
+ */
+unsigned int crc32_update(unsigned int crc, const void *data, size_t size);
+
+/*!
+ * Progress of a long phase of the indexer, reported on stderr in the same
+ * format as indexlib.py:
+ * `~~> [phase] unit=done done=45.0% elapsed=0:01:10 eta=0:01:26`.
+ */
+typedef struct progress_t {
+	const char *phase;
+	const char *unit;
+	long long total;
+	time_t start;
+	time_t last;
+} progress_t;
+
+void start_progress(progress_t *progress, const char *phase, const char *unit,
+                    long long total);
+
+/*!
+ * Reports that `done` units out of the total are done, unless the last
+ * report is less than PROGRESS_INTERVAL seconds old and `force` is false.
+ */
+void report_progress(progress_t *progress, long long done, int force);
+
 #endif
@@ -0,0 +1,61 @@
+#ifndef MWETK_NGRAMCOUNT
+#define MWETK_NGRAMCOUNT
+
+#include <stddef.h>
+#include <stdint.h>
+
+/*!
+ * N-gram lookups over the `.corpus` and `.suffix` files of an index, which
+ * are mapped in memory instead of being read. This is built as a shared
+ * library (libngramcount.so) for counter.py, which calls it via ctypes.
+ */
+
+typedef int symbolnumber_t;
+
+typedef struct ngramindex_t {
+	symbolnumber_t *corpus;  // NULL if the corpus is compressed
+	void *suffix;  // Positions of 4 or 8 bytes, as given by suffix_width
+	int suffix_width;
+	long length;
+	// Compressed corpus (see indexlib.py): symbol of each frequency rank,
+	// and variable-byte encoded ranks, in blocks of `block_size` starting
+	// at `offsets` in `blocks`.
+	const symbolnumber_t *by_rank;
+	unsigned nb_symbols, block_size;
+	const uint64_t *offsets;
+	const unsigned char *blocks;
+	void *corpus_mapping, *suffix_mapping;
+	size_t corpus_size, suffix_size;
+} ngramindex_t;
+
+/*!
+ * Maps the suffix array files at `basepath`.corpus and `basepath`.suffix.
+ * @return The new index, or NULL if the files could not be mapped, or are
+ * in a foreign byte order or element width (they must then be read by
+ * indexlib.py, which converts them). The suffix array may hold positions of
+ * either 4 or 8 bytes, and the corpus may be compressed.
+ */
+ngramindex_t *ngramindex_open(const char *basepath);
+
+void ngramindex_close(ngramindex_t *index);
+
+/*!
+ * Finds the suffixes that start with the `length` symbols of `ngram`.
+ * @return Whether there is any, in which case their positions in the suffix
+ * array go from `*first` to `*last` (inclusive).
+ */
+int ngramindex_range(ngramindex_t *index, const symbolnumber_t *ngram,
+                     int length, long *first, long *last);
+
+long ngramindex_count(ngramindex_t *index, const symbolnumber_t *ngram,
+                      int length);
+
+/*!
+ * Counts `nb_ngrams` ngrams at once. Their symbols are concatenated in
+ * `ngrams`, and their lengths are given in `lengths`. The counts are stored
+ * in `counts`.
+ */
+void ngramindex_count_batch(ngramindex_t *index, const symbolnumber_t *ngrams,
+                            const int *lengths, int nb_ngrams, long *counts);
+
+#endif
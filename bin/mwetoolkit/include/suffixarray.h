@@ -2,31 +2,42 @@
 #define MWETK_SUFFIXARRAY
 
 #include <stdio.h>
+#include <stdint.h>
 #include "base.h"
 #include "symboltable.h"
 
+// Corpus positions, which may go beyond 2^31 for large corpora.
+typedef int64_t position_t;
+
 typedef struct suffixarray_t {
 	symbolnumber_t *corpus;
-	symbolnumber_t *suffix;
+	position_t *suffix;
 	symboltable_t *symboltable;
-	int allocated;
-	int used;
+	position_t allocated;
+	position_t used;
 } suffixarray_t;
 
 suffixarray_t* make_suffixarray();
 
 void free_suffixarray(suffixarray_t *suf);
 
-void suffixarray_append_word(suffixarray_t *suf, symbolname_t word);
+void suffixarray_append_word(suffixarray_t *suf, const char *word);
+
+void read_corpus_numbers(suffixarray_t *suf, FILE *file, int width);
 
-int suffixarray_compare(suffixarray_t *suf, int pos1, int pos2);
+int suffixarray_compare(suffixarray_t *suf, position_t pos1, position_t pos2);
 
 int suffixarray_compare_global(const void *ptr1, const void *ptr2);
 
-void suffixarray_sort(suffixarray_t *suf);
+void suffixarray_sort(suffixarray_t *suf, int threads, const char *phase);
 
 void read_suffix_array(suffixarray_t *suf, FILE *corpusfile, FILE *suffixfile);
 
+void write_array_file(FILE *file, symbolnumber_t *numbers, position_t length);
+
+void write_position_array_file(FILE *file, position_t *positions,
+                               position_t length);
+
 void write_suffix_array(suffixarray_t *suf, FILE *corpusfile, FILE *suffixfile);
 
 void load_suffix_array(suffixarray_t *suf, char *basepath);
@@ -3,25 +3,33 @@
 
 #include <stdio.h>
 #include "base.h"
-#include "rbtree.h"
 #include "readline.h"
 
 typedef int symbolnumber_t;
 
 typedef char *symbolname_t;
 
+// Symbol table descriptor. Names are looked up in an open-addressing hash
+// table, whose slots hold symbol numbers, and stored in an arena of
+// SYMBOL_STRINGS_ALLOC_CHUNK-byte blocks.
 typedef struct symboltable_t {
 	int numentries;
 	int allocated_entries;
-	rbtree_t *name_to_number;
 	symbolname_t *number_to_name;
+	unsigned int *hashes;
+	symbolnumber_t *slots;
+	int nb_slots;
+	char **arena_blocks;
+	int nb_arena_blocks;
+	char *arena_free;
+	size_t arena_left;
 } symboltable_t;
 
 symboltable_t *make_symboltable();
 
 void free_symboltable(symboltable_t *table);
 
-symbolnumber_t intern_symbol(symboltable_t *table, symbolname_t key);
+symbolnumber_t intern_symbol(symboltable_t *table, const char *key);
 
 void write_symbols(symboltable_t *table, FILE *file);
 
@@ -20,7 +20,9 @@
 ##############################################################################*/
 #include <stdio.h>
 #include <stdlib.h>
+#include <time.h>
 #include "base.h"
+#include "basefuns.h"
 
 void *check_malloc(size_t size) {
 	void *new = malloc(size);
@@ -36,3 +38,60 @@ void *check_realloc(void *ptr, size_t size) {
 	return new;
 }
 
+
+unsigned int crc32_update(unsigned int crc, const void *data, size_t size) {
+	static unsigned int table[256];
+	static int table_ready = 0;
+	const unsigned char *bytes = data;
+	unsigned int c;
+	int i, k;
+
+	if (!table_ready) {
+		for (i = 0; i < 256; i++) {
+			c = i;
+			for (k = 0; k < 8; k++)
+				c = c & 1 ? 0xEDB88320u ^ (c >> 1) : c >> 1;
+			table[i] = c;
+		}
+		table_ready = 1;
+	}
+
+	crc = ~crc;
+	while (size--)
+		crc = table[(crc ^ *bytes++) & 0xFF] ^ (crc >> 8);
+	return ~crc;
+}
+
+void start_progress(progress_t *progress, const char *phase, const char *unit,
+                    long long total) {
+	progress->phase = phase;
+	progress->unit = unit;
+	progress->total = total;
+	progress->start = progress->last = time(NULL);
+}
+
+static void format_duration(char *buffer, size_t size, long seconds) {
+	snprintf(buffer, size, "%ld:%02ld:%02ld", seconds / 3600,
+	         seconds / 60 % 60, seconds % 60);
+}
+
+void report_progress(progress_t *progress, long long done, int force) {
+	time_t now = time(NULL);
+	long elapsed = now - progress->start;
+	char elapsed_text[32], eta_text[32];
+
+	if (!force && now - progress->last < PROGRESS_INTERVAL)
+		return;
+	progress->last = now;
+	format_duration(elapsed_text, sizeof(elapsed_text), elapsed);
+	if (progress->total <= 0 || done <= 0) {
+		fprintf(stderr, "~~> [%s] %s=%lld elapsed=%s\n", progress->phase,
+		        progress->unit, done, elapsed_text);
+		return;
+	}
+	format_duration(eta_text, sizeof(eta_text),
+	                (long) (elapsed * (double) (progress->total - done) / done));
+	fprintf(stderr, "~~> [%s] %s=%lld done=%.1f%% elapsed=%s eta=%s\n",
+	        progress->phase, progress->unit, done,
+	        100.0 * done / progress->total, elapsed_text, eta_text);
+}
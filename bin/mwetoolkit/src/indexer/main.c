@@ -19,33 +19,56 @@
 #
 ##############################################################################*/
 #include <stdio.h>
+#include <string.h>
+#include <unistd.h>
 #include "base.h"
 #include "readline.h"
 #include "suffixarray.h"
 
 int main(int argc, char **argv) {
-	/* char *basepath = argv[1]; */
 	char *line;
-	char *newsym;
+	char *basepath;
+	int threads = 1;
+	int width = sizeof(symbolnumber_t);
+	bool binary = false;
+	int opt;
 
-	if (argc != 2)
-		error("Usage: %s basepath\n", argv[0]);
+	while ((opt = getopt(argc, argv, "bt:w:")) != -1) {
+		if (opt == 'b')
+			binary = true;
+		else if (opt == 't' && atoi(optarg) >= 1)
+			threads = atoi(optarg);
+		else if (opt == 'w' && (atoi(optarg) == 4 || atoi(optarg) == 8))
+			width = atoi(optarg);
+		else
+			error("Usage: %s [-b] [-t threads] [-w width] basepath\n",
+			      argv[0]);
+	}
+	if (argc - optind != 1)
+		error("Usage: %s [-b] [-t threads] [-w width] basepath\n", argv[0]);
+	basepath = argv[optind];
 
 	suffixarray_t *suf = make_suffixarray();
 
-	while (line = readline(stdin)) {
-		newsym = copystring(line);
-		suffixarray_append_word(suf, newsym);
-	}
+	if (binary)
+		// Symbol numbers, already interned by the caller, `width` bytes each.
+		read_corpus_numbers(suf, stdin, width);
+	else
+		while (line = readline(stdin))
+			suffixarray_append_word(suf, line);
+
+	fprintf(stderr, "Corpus read: %lld words.\n", (long long) suf->used);
+	fprintf(stderr, "Sorting suffix array (%d threads)...\n", threads);
 
-	fprintf(stderr, "Corpus read: %d words.\n", suf->used);
-	fprintf(stderr, "Sorting suffix array...\n");
-	
-	suffixarray_sort(suf);
+	char phase[strlen(basepath) + 5 + 1];
+	strcpy(phase, "sort ");
+	strcat(phase, basepath);
+	suffixarray_sort(suf, threads, phase);
 
 	fprintf(stderr, "Sorting done! Saving...\n");
-	save_suffix_array(suf, argv[1]);
-	save_symbols_to_file(suf->symboltable, argv[1]);
+	save_suffix_array(suf, basepath);
+	if (!binary)
+		save_symbols_to_file(suf->symboltable, basepath);
 
 	fprintf(stderr, "Done.\n");
 	return 0;
@@ -0,0 +1,268 @@
+/*##############################################################################
+#
+# Copyright 2010-2012 Carlos Ramisch, Vitor De Araujo
+#
+# ngramcount.c is part of mwetoolkit
+#
+# mwetoolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mwetoolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mwetoolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################*/
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "base.h"
+#include "ngramcount.h"
+
+/* Maps the whole file at `path` read-only. Returns NULL on error, or for an
+ * empty file (`*size` is then 0). */
+static void *map_file(const char *path, size_t *size) {
+	struct stat info;
+	void *data;
+	int fd = open(path, O_RDONLY);
+
+	*size = 0;
+	if (fd < 0)
+		return NULL;
+	if (fstat(fd, &info) < 0 || info.st_size == 0) {
+		close(fd);
+		return NULL;
+	}
+	data = mmap(NULL, info.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	close(fd);
+	if (data == MAP_FAILED)
+		return NULL;
+	*size = info.st_size;
+	return data;
+}
+
+/* Maps the array file at `path`, setting `*numbers` to its data (NULL if
+ * it is empty) and `*width` to the size of its elements, and returning its
+ * number of elements. Files with a header must be in the native byte order,
+ * with elements of 4 bytes, or also of 8 if `wide` is set, or compressed
+ * (width ARRAY_WIDTH_VARBYTE) if `compressed` is set; legacy files without
+ * header are taken as they are. Returns -1 on error. */
+static long map_array_file(const char *path, void **mapping, size_t *size,
+                           void **numbers, int *width, int wide,
+                           int compressed) {
+	char *data;
+	uint32_t version, mark;
+	uint64_t length;
+
+	*mapping = data = map_file(path, size);
+	*numbers = NULL;
+	*width = sizeof(int32_t);
+	if (*size == 0)
+		return access(path, R_OK) == 0 ? 0 : -1;
+	if (!data)
+		return -1;
+
+	if (*size < ARRAY_HEADER_SIZE ||
+	    memcmp(data, ARRAY_FILE_MAGIC, ARRAY_FILE_MAGIC_LEN) != 0) {
+		// Legacy file
+		*numbers = data;
+		return *size / sizeof(int32_t);
+	}
+
+	memcpy(&version, data + 8, sizeof(version));
+	memcpy(width, data + 12, sizeof(*width));
+	memcpy(&mark, data + 16, sizeof(mark));
+	memcpy(&length, data + 24, sizeof(length));
+	if (version > ARRAY_FILE_VERSION || mark != ARRAY_BYTE_ORDER_MARK ||
+	    !(*width == sizeof(int32_t) || (wide && *width == sizeof(int64_t)) ||
+	      (compressed && *width == ARRAY_WIDTH_VARBYTE)) ||
+	    *size < ARRAY_HEADER_SIZE + length * *width)
+		return -1;
+	if (length > 0)
+		*numbers = data + ARRAY_HEADER_SIZE;
+	return length;
+}
+
+/* Sets up the compressed corpus of `index`, whose data (after the header)
+ * is at `data`, with `size` bytes. Returns whether its layout is valid. */
+static int setup_compressed_corpus(ngramindex_t *index, const char *data,
+                                   size_t size) {
+	uint32_t fields[2];
+	size_t nb_blocks, start;
+
+	if (size < sizeof(fields))
+		return 0;
+	memcpy(fields, data, sizeof(fields));
+	index->block_size = fields[0];
+	index->nb_symbols = fields[1];
+	if (index->block_size == 0)
+		return 0;
+	nb_blocks = (index->length + index->block_size - 1) / index->block_size;
+	start = sizeof(fields) + (index->nb_symbols + index->nb_symbols % 2) *
+	                         sizeof(symbolnumber_t);
+	if (size < start + (nb_blocks + 1) * sizeof(uint64_t))
+		return 0;
+	index->by_rank = (const symbolnumber_t *) (data + sizeof(fields));
+	index->offsets = (const uint64_t *) (data + start);
+	index->blocks = (const unsigned char *) (data + start +
+	                                         (nb_blocks + 1) * sizeof(uint64_t));
+	return (size_t) (index->blocks - (const unsigned char *) data) +
+	       index->offsets[nb_blocks] <= size;
+}
+
+ngramindex_t *ngramindex_open(const char *basepath) {
+	char path[strlen(basepath) + 7 + 1];
+	long corpus_length, suffix_length;
+	int corpus_width;
+	ngramindex_t *index = malloc(sizeof(ngramindex_t));
+
+	if (!index)
+		return NULL;
+	index->by_rank = NULL;
+	strcpy(path, basepath);
+	strcat(path, ".corpus");
+	corpus_length = map_array_file(path, &index->corpus_mapping,
+	                               &index->corpus_size, (void **) &index->corpus,
+	                               &corpus_width, 0, 1);
+	strcpy(path, basepath);
+	strcat(path, ".suffix");
+	suffix_length = map_array_file(path, &index->suffix_mapping,
+	                               &index->suffix_size, &index->suffix,
+	                               &index->suffix_width, 1, 0);
+	index->length = corpus_length;
+
+	if (corpus_length < 0 || corpus_length != suffix_length ||
+	    (corpus_width == ARRAY_WIDTH_VARBYTE && !setup_compressed_corpus(
+			index, (const char *) index->corpus_mapping + ARRAY_HEADER_SIZE,
+			index->corpus_size - ARRAY_HEADER_SIZE))) {
+		ngramindex_close(index);
+		return NULL;
+	}
+	if (corpus_width == ARRAY_WIDTH_VARBYTE)
+		index->corpus = NULL;
+	return index;
+}
+
+void ngramindex_close(ngramindex_t *index) {
+	if (index->corpus_mapping)
+		munmap(index->corpus_mapping, index->corpus_size);
+	if (index->suffix_mapping)
+		munmap(index->suffix_mapping, index->suffix_size);
+	free(index);
+}
+
+/* Reads the next variable-byte encoded number at `*data`. */
+static inline unsigned decode_varbyte(const unsigned char **data) {
+	unsigned number = 0, shift = 0;
+	unsigned char byte;
+
+	do {
+		byte = *(*data)++;
+		number |= (unsigned) (byte & 0x7f) << shift;
+		shift += 7;
+	} while (byte & 0x80);
+	return number;
+}
+
+/* Like compare_suffix, for a compressed corpus. Blocks are stored one after
+ * the other, so only the first one needs to be looked up. */
+static int compare_compressed_suffix(ngramindex_t *index, long pos,
+                                     const symbolnumber_t *ngram, int length) {
+	const unsigned char *data = index->blocks +
+	                            index->offsets[pos / index->block_size];
+	long skip = pos % index->block_size;
+	unsigned rank;
+	int i;
+
+	while (skip > 0)
+		if (!(*data++ & 0x80))
+			skip--;
+	for (i = 0; i < length; i++) {
+		if (pos + i >= index->length)
+			return -1;
+		rank = decode_varbyte(&data);
+		if (rank >= index->nb_symbols)
+			return -1;  // Corrupted data
+		if (index->by_rank[rank] != ngram[i])
+			return index->by_rank[rank] < ngram[i] ? -1 : 1;
+	}
+	return 0;
+}
+
+/* Compares the first `length` words of the suffix at `pos` with `ngram`. A
+ * suffix that ends with the corpus before `length` words is lesser. */
+static int compare_suffix(ngramindex_t *index, long pos,
+                          const symbolnumber_t *ngram, int length) {
+	int i;
+
+	if (index->by_rank)
+		return compare_compressed_suffix(index, pos, ngram, length);
+	for (i = 0; i < length; i++) {
+		if (pos + i >= index->length)
+			return -1;
+		if (index->corpus[pos + i] != ngram[i])
+			return index->corpus[pos + i] < ngram[i] ? -1 : 1;
+	}
+	return 0;
+}
+
+/* Corpus position stored at `i` in the suffix array. */
+static inline long suffix_at(ngramindex_t *index, long i) {
+	if (index->suffix_width == sizeof(int32_t))
+		return ((int32_t *) index->suffix)[i];
+	return ((int64_t *) index->suffix)[i];
+}
+
+/* Returns the first position in the suffix array whose suffix compares
+ * greater than (`strict`) or at least equal to `ngram`. */
+static long search_suffixes(ngramindex_t *index, const symbolnumber_t *ngram,
+                            int length, int strict) {
+	long low = 0, high = index->length, mid;
+	int cmp;
+
+	while (low < high) {
+		mid = low + (high - low) / 2;
+		cmp = compare_suffix(index, suffix_at(index, mid), ngram, length);
+		if (cmp > 0 || (cmp == 0 && !strict))
+			high = mid;
+		else
+			low = mid + 1;
+	}
+	return low;
+}
+
+int ngramindex_range(ngramindex_t *index, const symbolnumber_t *ngram,
+                     int length, long *first, long *last) {
+	*first = search_suffixes(index, ngram, length, 0);
+	*last = search_suffixes(index, ngram, length, 1) - 1;
+	return *first <= *last;
+}
+
+long ngramindex_count(ngramindex_t *index, const symbolnumber_t *ngram,
+                      int length) {
+	long first, last;
+
+	if (!ngramindex_range(index, ngram, length, &first, &last))
+		return 0;
+	return last - first + 1;
+}
+
+void ngramindex_count_batch(ngramindex_t *index, const symbolnumber_t *ngrams,
+                            const int *lengths, int nb_ngrams, long *counts) {
+	int i;
+
+	for (i = 0; i < nb_ngrams; i++) {
+		counts[i] = ngramindex_count(index, ngrams, lengths[i]);
+		ngrams += lengths[i];
+	}
+}
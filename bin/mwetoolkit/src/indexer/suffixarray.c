@@ -19,6 +19,9 @@
 #
 ##############################################################################*/
 #include <stdio.h>
+#include <pthread.h>
+#include <string.h>
+#include <stdint.h>
 #include "base.h"
 #include "symboltable.h"
 #include "suffixarray.h"
@@ -42,74 +45,428 @@ void free_suffixarray(suffixarray_t *suf) {
 	free(suf);
 }
 
-void suffixarray_append_word(suffixarray_t *suf, symbolname_t word) {
+/* Makes room for at least one more word in the corpus. */
+static void grow_corpus(suffixarray_t *suf) {
 	if (suf->used >= suf->allocated) {
-		resize_alloc(suf->corpus,
-		             suf->allocated + SUFFIX_ARRAY_ALLOC_CHUNK,
-		             symbolnumber_t);
-		resize_alloc(suf->suffix,
-		             suf->allocated + SUFFIX_ARRAY_ALLOC_CHUNK,
-		             symbolnumber_t);
-		suf->allocated += SUFFIX_ARRAY_ALLOC_CHUNK;
+		// Grow geometrically, so that appending stays linear overall.
+		suf->allocated = suf->allocated ? 2 * suf->allocated :
+		                 SUFFIX_ARRAY_ALLOC_CHUNK;
+		resize_alloc(suf->corpus, suf->allocated, symbolnumber_t);
 	}
+}
 
-	symbolnumber_t symnum = intern_symbol(suf->symboltable, word);
-	suf->corpus[suf->used] = symnum;
-	// suf->suffix[suf->used] = suf->used;
+void suffixarray_append_word(suffixarray_t *suf, const char *word) {
+	grow_corpus(suf);
+	suf->corpus[suf->used] = intern_symbol(suf->symboltable, word);
 	suf->used++;
 }
 
-int suffixarray_compare(suffixarray_t *suf, int pos1, int pos2) {
-	int limit = suf->used;
-	symbolnumber_t *corpus = suf->corpus;
-	int first = 1;
+/* Appends to the corpus the symbol numbers in `file`, as native integers of
+ * `width` bytes (4 or 8). */
+void read_corpus_numbers(suffixarray_t *suf, FILE *file, int width) {
+	int64_t number;
+	size_t nread;
+
+	if (width == sizeof(symbolnumber_t)) {
+		do {
+			grow_corpus(suf);
+			nread = fread(suf->corpus + suf->used, sizeof(symbolnumber_t),
+			              suf->allocated - suf->used, file);
+			suf->used += nread;
+		} while (nread > 0);
+	}
+	else if (width == sizeof(int64_t)) {
+		while (fread(&number, sizeof(number), 1, file) == 1) {
+			if (number < 0 || number > INT32_MAX)
+				error("-- Symbol number out of range: %lld\n",
+				      (long long) number);
+			grow_corpus(suf);
+			suf->corpus[suf->used++] = number;
+		}
+	}
+	else
+		error("-- Unsupported symbol number width: %d\n", width);
+
+	if (ferror(file))
+		error("-- Error reading corpus numbers!\n");
+}
+
+/* Symbol at `pos`, or -1 past the end of the corpus, so that a suffix that
+ * runs out of words sorts before any longer one. */
+#define suffix_key(corpus, used, pos) ((pos) < (used) ? (corpus)[pos] : -1)
+
+/* Compares the suffixes at `pos1` and `pos2`, starting `depth` words in.
+ * Only the first NGRAM_COMPARE_LIMIT words are compared, since no n-gram
+ * longer than that is ever looked up. */
+static int suffixarray_compare_from(symbolnumber_t *corpus, position_t used,
+                                    position_t pos1, position_t pos2,
+                                    int depth) {
+	int key1, key2;
 
-	while (pos1<limit && pos2<limit) {
-		if (corpus[pos1] != corpus[pos2])
-			return corpus[pos1] - corpus[pos2];
-		if (!first && corpus[pos1]==0 && corpus[pos2]==0)
+	for (; depth < NGRAM_COMPARE_LIMIT; depth++) {
+		key1 = suffix_key(corpus, used, pos1 + depth);
+		key2 = suffix_key(corpus, used, pos2 + depth);
+		if (key1 != key2)
+			return key1 < key2 ? -1 : 1;
+		if (key1 == -1 || (key1 == 0 && depth > 0))
 			return 0;  // Don't care about order after end-of-sentence.
-		pos1++, pos2++, first=0;
 	}
+	return 0;
+}
 
-	if (pos1>=limit)
-		return -1;
-	else if (pos2>=limit)
-		return 1;
-	else
-		return 0;
+int suffixarray_compare(suffixarray_t *suf, position_t pos1, position_t pos2) {
+	return suffixarray_compare_from(suf->corpus, suf->used, pos1, pos2, 0);
 }
 
 
 int suffixarray_compare_global(const void *ptr1, const void *ptr2) {
-	return suffixarray_compare(current_suffix_array, *(int *)ptr1, *(int *)ptr2);
+	return suffixarray_compare(current_suffix_array, *(position_t *)ptr1,
+	                           *(position_t *)ptr2);
+}
+
+static void suffixarray_insertion_sort(symbolnumber_t *corpus, position_t used,
+                                       position_t *suffix, position_t n,
+                                       int depth) {
+	position_t i, j, pos;
+
+	for (i = 1; i < n; i++) {
+		pos = suffix[i];
+		for (j = i; j > 0 && suffixarray_compare_from(corpus, used,
+				suffix[j-1], pos, depth) > 0; j--)
+			suffix[j] = suffix[j-1];
+		suffix[j] = pos;
+	}
+}
+
+static int median_of_three(int a, int b, int c) {
+	if (a < b)
+		return b < c ? b : (a < c ? c : a);
+	else
+		return a < c ? a : (b < c ? c : b);
+}
+
+/* Multikey quicksort (Bentley & Sedgewick) of the `n` suffixes in `suffix`,
+ * which are known to share their first `depth` words. Each pass partitions
+ * on a single word, so a run of repeated text costs at most
+ * NGRAM_COMPARE_LIMIT passes instead of a full comparison per pair. The
+ * largest partition is handled in the loop and the others recursively, so
+ * the stack stays shallow. */
+static void suffixarray_multikey_sort(symbolnumber_t *corpus, position_t used,
+                                      position_t *suffix, position_t n,
+                                      int depth) {
+	position_t lt, gt, i, tmp;
+	position_t n_lt, n_eq, n_gt;
+	int key, pivot;
+	bool eq_sorted;
+
+	while (n > MULTIKEY_INSERTION_SORT_SIZE && depth < NGRAM_COMPARE_LIMIT) {
+		pivot = median_of_three(
+				suffix_key(corpus, used, suffix[0] + depth),
+				suffix_key(corpus, used, suffix[n/2] + depth),
+				suffix_key(corpus, used, suffix[n-1] + depth));
+
+		// Three-way partition: [0,lt) < pivot, [lt,gt] == pivot, (gt,n) > pivot
+		lt = 0, i = 0, gt = n - 1;
+		while (i <= gt) {
+			key = suffix_key(corpus, used, suffix[i] + depth);
+			if (key < pivot) {
+				tmp = suffix[lt], suffix[lt] = suffix[i], suffix[i] = tmp;
+				lt++, i++;
+			}
+			else if (key > pivot) {
+				tmp = suffix[gt], suffix[gt] = suffix[i], suffix[i] = tmp;
+				gt--;
+			}
+			else
+				i++;
+		}
+
+		n_lt = lt;
+		n_eq = gt - lt + 1;
+		n_gt = n - gt - 1;
+		// Suffixes that ended together need no further sorting.
+		eq_sorted = pivot == -1 || (pivot == 0 && depth > 0);
+		if (eq_sorted)
+			n_eq = 0;
+
+		if (n_eq >= n_lt && n_eq >= n_gt) {
+			suffixarray_multikey_sort(corpus, used, suffix, n_lt, depth);
+			suffixarray_multikey_sort(corpus, used, suffix + gt + 1, n_gt,
+			                          depth);
+			suffix += lt, n = n_eq, depth++;
+		}
+		else {
+			if (!eq_sorted)
+				suffixarray_multikey_sort(corpus, used, suffix + lt, n_eq,
+				                          depth + 1);
+			if (n_lt >= n_gt) {
+				suffixarray_multikey_sort(corpus, used, suffix + gt + 1,
+				                          n_gt, depth);
+				n = n_lt;
+			}
+			else {
+				suffixarray_multikey_sort(corpus, used, suffix, n_lt, depth);
+				suffix += gt + 1, n = n_gt;
+			}
+		}
+	}
+
+	if (n > 1 && depth < NGRAM_COMPARE_LIMIT)
+		suffixarray_insertion_sort(corpus, used, suffix, n, depth);
+}
+
+/* Suffixes starting with the same symbol, to be sorted from their second
+ * word on. */
+typedef struct suffixbucket_t {
+	position_t start;
+	position_t size;
+} suffixbucket_t;
+
+/* Buckets shared by the sorting threads, handed out in order. */
+typedef struct bucketqueue_t {
+	suffixarray_t *suf;
+	suffixbucket_t *buckets;
+	int nb_buckets;
+	int next;
+	progress_t *progress;
+	position_t sorted;  // Suffixes in place so far
+	pthread_mutex_t lock;
+} bucketqueue_t;
+
+static void sort_bucket(suffixarray_t *suf, suffixbucket_t *bucket) {
+	suffixarray_multikey_sort(suf->corpus, suf->used,
+	                          suf->suffix + bucket->start, bucket->size, 1);
+}
+
+static void *sort_buckets_thread(void *arg) {
+	bucketqueue_t *queue = (bucketqueue_t *) arg;
+	int i = -1;
+
+	while (1) {
+		pthread_mutex_lock(&queue->lock);
+		if (i >= 0) {
+			queue->sorted += queue->buckets[i].size;
+			report_progress(queue->progress, queue->sorted, 0);
+		}
+		i = queue->next++;
+		pthread_mutex_unlock(&queue->lock);
+		if (i >= queue->nb_buckets)
+			return NULL;
+		sort_bucket(queue->suf, &queue->buckets[i]);
+	}
 }
 
-void suffixarray_sort(suffixarray_t *suf) {
-	int i;
+static int compare_bucket_sizes(const void *ptr1, const void *ptr2) {
+	const suffixbucket_t *b1 = ptr1, *b2 = ptr2;
+	if (b1->size != b2->size)
+		return b1->size > b2->size ? -1 : 1;
+	return b1->start < b2->start ? -1 : 1;
+}
+
+/* Sorts the suffix array using `threads` threads. Suffixes are first placed
+ * in buckets by their first symbol, and each bucket is then sorted on its
+ * own, biggest first, by whichever thread is free. The result does not
+ * depend on the number of threads. Progress is reported as `phase`. */
+void suffixarray_sort(suffixarray_t *suf, int threads, const char *phase) {
+	position_t i, sorted;
+	int symbol, nb_symbols = 0, nb_buckets = 0;
+	position_t *offsets;
+	suffixbucket_t *buckets;
+	progress_t progress;
+
 	current_suffix_array = suf;
+	resize_alloc(suf->suffix, suf->used + 1, position_t);
+	for (i=0; i < suf->used; i++)
+		if (suf->corpus[i] >= nb_symbols)
+			nb_symbols = suf->corpus[i] + 1;
+
+	// Counting sort on the first symbol.
+	offsets = alloc(nb_symbols + 1, position_t);
+	memset(offsets, 0, (nb_symbols + 1) * sizeof(position_t));
 	for (i=0; i < suf->used; i++)
-		suf->suffix[i] = i;
-	qsort(suf->suffix, suf->used, sizeof(symbolnumber_t), suffixarray_compare_global);
+		offsets[suf->corpus[i] + 1]++;
+	for (symbol=0; symbol < nb_symbols; symbol++)
+		offsets[symbol + 1] += offsets[symbol];
+
+	buckets = alloc(nb_symbols + 1, suffixbucket_t);
+	for (symbol=0; symbol < nb_symbols; symbol++)
+		if (offsets[symbol + 1] - offsets[symbol] > 1) {
+			buckets[nb_buckets].start = offsets[symbol];
+			buckets[nb_buckets].size = offsets[symbol + 1] - offsets[symbol];
+			nb_buckets++;
+		}
+	for (i=0; i < suf->used; i++)
+		suf->suffix[offsets[suf->corpus[i]]++] = i;
+	free(offsets);
+
+	// Suffixes alone in their bucket are already in place.
+	sorted = suf->used;
+	for (symbol=0; symbol < nb_buckets; symbol++)
+		sorted -= buckets[symbol].size;
+	start_progress(&progress, phase, "suffixes", suf->used);
+
+	if (threads > nb_buckets)
+		threads = nb_buckets;
+	if (threads <= 1) {
+		for (symbol=0; symbol < nb_buckets; symbol++) {
+			sort_bucket(suf, &buckets[symbol]);
+			sorted += buckets[symbol].size;
+			report_progress(&progress, sorted, 0);
+		}
+	}
+	else {
+		bucketqueue_t queue;
+		pthread_t thread_ids[threads];
+		int t;
+
+		// Big buckets first, so that no thread is left with a big one at
+		// the end.
+		qsort(buckets, nb_buckets, sizeof(suffixbucket_t),
+		      compare_bucket_sizes);
+		queue.suf = suf;
+		queue.buckets = buckets;
+		queue.nb_buckets = nb_buckets;
+		queue.next = 0;
+		queue.progress = &progress;
+		queue.sorted = sorted;
+		pthread_mutex_init(&queue.lock, NULL);
+		for (t=0; t < threads; t++)
+			if (pthread_create(&thread_ids[t], NULL, sort_buckets_thread,
+			                   &queue) != 0)
+				error("-- Error creating sorting thread!\n");
+		for (t=0; t < threads; t++)
+			pthread_join(thread_ids[t], NULL);
+		pthread_mutex_destroy(&queue.lock);
+	}
+	report_progress(&progress, suf->used, 1);
+	free(buckets);
+}
+
+/* Reads an array file header. Returns the element width and sets `*length`,
+ * or returns 0 for a legacy file without header (of native ints), leaving
+ * the file at its start. */
+static int read_array_header(FILE *file, position_t *length) {
+	char magic[ARRAY_FILE_MAGIC_LEN];
+	uint32_t version, width, mark, crc;
+	uint64_t count;
+
+	if (fread(magic, 1, ARRAY_FILE_MAGIC_LEN, file) != ARRAY_FILE_MAGIC_LEN ||
+	    memcmp(magic, ARRAY_FILE_MAGIC, ARRAY_FILE_MAGIC_LEN) != 0) {
+		rewind(file);
+		return 0;
+	}
+	if (fread(&version, sizeof(version), 1, file) != 1 ||
+	    fread(&width, sizeof(width), 1, file) != 1 ||
+	    fread(&mark, sizeof(mark), 1, file) != 1 ||
+	    fread(&crc, sizeof(crc), 1, file) != 1 ||
+	    fread(&count, sizeof(count), 1, file) != 1)
+		error("-- Truncated array file header!\n");
+	if (version > ARRAY_FILE_VERSION || mark != ARRAY_BYTE_ORDER_MARK)
+		error("-- Unsupported array file format!\n");
+	*length = count;
+	return width;
+}
+
+/* Reads the next number of `width` bytes from `file` into `*number`. */
+static bool read_number(FILE *file, int width, int64_t *number) {
+	int32_t small;
+
+	if (width == sizeof(int32_t)) {
+		if (fread(&small, sizeof(small), 1, file) != 1)
+			return false;
+		*number = small;
+		return true;
+	}
+	return fread(number, sizeof(*number), 1, file) == 1;
 }
 
 void read_suffix_array(suffixarray_t *suf, FILE *corpusfile, FILE *suffixfile) {
-	int nread1;//nread2;
-	while (1) {
-		suf->allocated += SUFFIX_ARRAY_ALLOC_CHUNK;
-		resize_alloc(suf->corpus, suf->allocated, symbolnumber_t);
-		resize_alloc(suf->suffix, suf->allocated, symbolnumber_t);
-		nread1 = fread(corpusfile, sizeof(symbolnumber_t), SUFFIX_ARRAY_ALLOC_CHUNK, corpusfile);
-		         fread(suffixfile, sizeof(symbolnumber_t), SUFFIX_ARRAY_ALLOC_CHUNK, suffixfile);
-		suf->used += nread1;
-		if (nread1 < SUFFIX_ARRAY_ALLOC_CHUNK)
-			break;
+	position_t length = 0, i;
+	int corpus_width, suffix_width;
+	int64_t number;
+
+	corpus_width = read_array_header(corpusfile, &length);
+	suffix_width = read_array_header(suffixfile, &length);
+	if (corpus_width == 0)
+		corpus_width = sizeof(int32_t);
+	if (suffix_width == 0)
+		suffix_width = sizeof(int32_t);
+
+	for (i=0; read_number(corpusfile, corpus_width, &number); i++) {
+		grow_corpus(suf);
+		suf->corpus[suf->used++] = number;
+	}
+	resize_alloc(suf->suffix, suf->used + 1, position_t);
+	for (i=0; i < suf->used && read_number(suffixfile, suffix_width, &number);
+	     i++)
+		suf->suffix[i] = number;
+	if (i < suf->used)
+		error("-- Suffix array file is shorter than corpus file!\n");
+}
+
+static void write_array_header(FILE *file, uint32_t width, uint32_t crc,
+                               uint64_t length) {
+	uint32_t version = ARRAY_FILE_VERSION;
+	uint32_t mark = ARRAY_BYTE_ORDER_MARK;
+
+	fwrite(ARRAY_FILE_MAGIC, 1, ARRAY_FILE_MAGIC_LEN, file);
+	fwrite(&version, sizeof(version), 1, file);
+	fwrite(&width, sizeof(width), 1, file);
+	fwrite(&mark, sizeof(mark), 1, file);
+	fwrite(&crc, sizeof(crc), 1, file);
+	fwrite(&length, sizeof(length), 1, file);
+}
+
+/* Writes the `length` symbol numbers of `numbers` to `file`, after an array
+ * file header. */
+void write_array_file(FILE *file, symbolnumber_t *numbers, position_t length) {
+	write_array_header(file, sizeof(symbolnumber_t),
+	                   crc32_update(0, numbers, length * sizeof(symbolnumber_t)),
+	                   length);
+	if (fwrite(numbers, sizeof(symbolnumber_t), length, file) != length)
+		error("-- Error writing array file!\n");
+}
+
+/* Writes the `length` positions of `positions` to `file`, after an array
+ * file header. Like indexlib.py, positions are stored in 32 bits unless
+ * some of them need 64. */
+void write_position_array_file(FILE *file, position_t *positions,
+                               position_t length) {
+	int32_t chunk[SUFFIX_ARRAY_ALLOC_CHUNK];
+	position_t start, i, size;
+	uint32_t crc = 0;
+	int pass;
+
+	if (length > (position_t) INT32_MAX + 1) {
+		write_array_header(file, sizeof(position_t),
+		                   crc32_update(0, positions,
+		                                length * sizeof(position_t)),
+		                   length);
+		if (fwrite(positions, sizeof(position_t), length, file) != length)
+			error("-- Error writing array file!\n");
+		return;
+	}
+
+	// Narrowed a chunk at a time: once for the checksum, once to write.
+	for (pass = 0; pass < 2; pass++) {
+		if (pass == 1)
+			write_array_header(file, sizeof(int32_t), crc, length);
+		for (start = 0; start < length; start += SUFFIX_ARRAY_ALLOC_CHUNK) {
+			size = length - start < SUFFIX_ARRAY_ALLOC_CHUNK ?
+			       length - start : SUFFIX_ARRAY_ALLOC_CHUNK;
+			for (i = 0; i < size; i++)
+				chunk[i] = positions[start + i];
+			if (pass == 0)
+				crc = crc32_update(crc, chunk, size * sizeof(int32_t));
+			else if (fwrite(chunk, sizeof(int32_t), size, file) != size)
+				error("-- Error writing array file!\n");
+		}
 	}
 }
 
 void write_suffix_array(suffixarray_t *suf, FILE *corpusfile, FILE *suffixfile) {
-	fwrite(suf->corpus, sizeof(symbolnumber_t), suf->used, corpusfile);
-	fwrite(suf->suffix, sizeof(symbolnumber_t), suf->used, suffixfile);
+	write_array_file(corpusfile, suf->corpus, suf->used);
+	write_position_array_file(suffixfile, suf->suffix, suf->used);
 }
 
 void load_suffix_array(suffixarray_t *suf, char *basepath) {
@@ -20,61 +20,126 @@
 ##############################################################################*/
 
 #include <stdio.h>
+#include <string.h>
 #include "base.h"
-#include "rbtree.h"
 #include "readline.h"
+#include "symboltable.h"
 
-typedef int symbolnumber_t;
-typedef char *symbolname_t;
-
-// Symbol table descriptor.
-typedef struct symboltable_t {
-	int numentries;
-	int allocated_entries;
-	rbtree_t *name_to_number;
-	symbolname_t *number_to_name;
-} symboltable_t;
-	
+#define EMPTY_SLOT (-1)
 
 symboltable_t *make_symboltable() {
-	symbolnumber_t intern_symbol(symboltable_t *table, symbolname_t key);
-
+	int i;
 	symboltable_t *new = alloc(1, symboltable_t);
-	symbolname_t empty_symbol = alloc(1, char);
-	empty_symbol[0] = '\0';
 	new->numentries = 0;
 	new->allocated_entries = 0;
-	new->name_to_number = rbmake();
 	new->number_to_name = NULL;
-	intern_symbol(new, empty_symbol);
+	new->hashes = NULL;
+	new->nb_slots = SYMBOL_HASH_INITIAL_SLOTS;
+	new->slots = alloc(new->nb_slots, symbolnumber_t);
+	for (i=0; i < new->nb_slots; i++)
+		new->slots[i] = EMPTY_SLOT;
+	new->arena_blocks = NULL;
+	new->nb_arena_blocks = 0;
+	new->arena_free = NULL;
+	new->arena_left = 0;
+	intern_symbol(new, "");
 	return new;
 }
 
 void free_symboltable(symboltable_t *table) {
 	int i;
-	rbfree(table->name_to_number);
-	for (i=0; i < table->numentries; i++)
-		free(table->number_to_name[i]);
+	for (i=0; i < table->nb_arena_blocks; i++)
+		free(table->arena_blocks[i]);
+	free(table->arena_blocks);
+	free(table->slots);
+	free(table->hashes);
 	free(table->number_to_name);
 	free(table);
 }
 
-symbolnumber_t intern_symbol(symboltable_t *table, symbolname_t key) {
-	rbnode_t *node = rbinsert(table->name_to_number, key, table->numentries);
-	if (node->value == table->numentries) {
-		if (table->numentries >= table->allocated_entries) {
-			resize_alloc(table->number_to_name,
-			             table->allocated_entries + SYMBOL_ENTRY_ALLOC_CHUNK,
-			             symbolname_t);
-			table->allocated_entries += SYMBOL_ENTRY_ALLOC_CHUNK;
-		}
-		table->number_to_name[table->numentries] = key;
-		table->numentries++;
+/* FNV-1a hash of a symbol name. */
+static unsigned int hash_symbol(const char *key) {
+	unsigned int hash = 2166136261u;
+	for (; *key; key++) {
+		hash ^= (unsigned char) *key;
+		hash *= 16777619u;
 	}
-	else {
-		free(key);
+	return hash;
+}
+
+/* Copies `key` into the string arena. Names are never freed one by one, so
+ * they are packed in big blocks instead of being malloc'ed each. */
+static symbolname_t arena_copy(symboltable_t *table, const char *key) {
+	size_t size = strlen(key) + 1;
+	symbolname_t copy;
+
+	if (size > table->arena_left) {
+		size_t block_size = size > SYMBOL_STRINGS_ALLOC_CHUNK ?
+		                    size : SYMBOL_STRINGS_ALLOC_CHUNK;
+		resize_alloc(table->arena_blocks, table->nb_arena_blocks + 1, char *);
+		table->arena_blocks[table->nb_arena_blocks++] = alloc(block_size, char);
+		table->arena_free = table->arena_blocks[table->nb_arena_blocks - 1];
+		table->arena_left = block_size;
 	}
-	return node->value;
+	copy = table->arena_free;
+	memcpy(copy, key, size);
+	table->arena_free += size;
+	table->arena_left -= size;
+	return copy;
+}
+
+/* Doubles the number of hash slots and reinserts all symbols. */
+static void grow_slots(symboltable_t *table) {
+	int i, slot;
+	unsigned int mask;
+
+	free(table->slots);
+	table->nb_slots *= 2;
+	mask = table->nb_slots - 1;
+	table->slots = alloc(table->nb_slots, symbolnumber_t);
+	for (i=0; i < table->nb_slots; i++)
+		table->slots[i] = EMPTY_SLOT;
+	for (i=0; i < table->numentries; i++) {
+		slot = table->hashes[i] & mask;
+		while (table->slots[slot] != EMPTY_SLOT)
+			slot = (slot + 1) & mask;
+		table->slots[slot] = i;
+	}
+}
+
+/* Returns the number of symbol `key`, adding it to the table if it is new.
+ * `key` is copied, so the caller may reuse it. */
+symbolnumber_t intern_symbol(symboltable_t *table, const char *key) {
+	unsigned int hash = hash_symbol(key);
+	unsigned int mask = table->nb_slots - 1;
+	int slot = hash & mask;
+	symbolnumber_t number;
+
+	// Linear probing.
+	while ((number = table->slots[slot]) != EMPTY_SLOT) {
+		if (table->hashes[number] == hash &&
+		    strcmp(table->number_to_name[number], key) == 0)
+			return number;
+		slot = (slot + 1) & mask;
+	}
+
+	if (table->numentries >= table->allocated_entries) {
+		table->allocated_entries = table->allocated_entries ?
+		                           2 * table->allocated_entries :
+		                           SYMBOL_ENTRY_ALLOC_CHUNK;
+		resize_alloc(table->number_to_name, table->allocated_entries,
+		             symbolname_t);
+		resize_alloc(table->hashes, table->allocated_entries, unsigned int);
+	}
+	number = table->numentries++;
+	table->number_to_name[number] = arena_copy(table, key);
+	table->hashes[number] = hash;
+	table->slots[slot] = number;
+
+	// Keep the load factor at most 1/2.
+	if (2 * table->numentries > table->nb_slots)
+		grow_slots(table);
+	return number;
 }
 
 void write_symbols(symboltable_t *table, FILE *file) {
@@ -85,13 +150,10 @@ void write_symbols(symboltable_t *table, FILE *file) {
 }
 
 void read_symbols(symboltable_t *table, FILE *file) {
-	char *line, *newname;
-	/*int length;*/
+	char *line;
 
-	while (line = readline(file)) {
-		newname = copystring(line);
-		intern_symbol(table, newname);
-	}
+	while (line = readline(file))
+		intern_symbol(table, line);
 }
 
 void load_symbols_from_file(symboltable_t *table, char *basepath) {